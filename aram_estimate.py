@@ -0,0 +1,155 @@
+# aram_estimate
+#
+# Copyright (c) 2025 NovaSquirrel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Estimates how much audio RAM a Terrific Audio Driver project will need, so going over budget shows up right after converting
+# instead of when the project gets compiled. Everything here is an estimate; Terrific Audio Driver has the final say.
+import argparse, json, math, os, re, sys, wave
+from compress_mml import estimate_bytes
+from pitch_table import pitch_table_usage, PITCH_TABLE_SIZE
+
+# Sample data, and the instruments and samples that use it
+BRR_BLOCK_BYTES = 9
+BRR_BLOCK_SAMPLES = 16
+SOURCE_DIRECTORY_ENTRY_BYTES = 4 # Start address and loop address
+INSTRUMENT_BYTES = 4             # Sample number, pitch offset and envelope
+
+# Pitch table
+PITCH_TABLE_ENTRY_BYTES = 2
+
+# Songs
+SONG_HEADER_BYTES = 16       # Pointers to each channel's bytecode and some settings
+SUBROUTINE_TABLE_BYTES = 2   # Pointer to each subroutine
+ECHO_BUFFER_BYTES_PER_EDL = 2048
+EMPTY_ECHO_BUFFER_BYTES = 4  # Echo with an EDL of 0 still writes to a few bytes
+CHANNEL_LINE = re.compile(r"^([A-H]+|![^\s]+)\s")
+ECHO_LENGTH = re.compile(r"^#EchoLength\s+(\d+)", re.MULTILINE) # In milliseconds; every 16 ms is one EDL step
+
+def brr_bytes(path):
+	if path.lower().endswith(".wav"): # Terrific Audio Driver encodes these itself
+		with wave.open(path) as f:
+			return math.ceil(f.getnframes() / BRR_BLOCK_SAMPLES) * BRR_BLOCK_BYTES
+	size = os.path.getsize(path)
+	if size % BRR_BLOCK_BYTES == 2: # Starts with a loop point, which goes in the source directory instead
+		size -= 2
+	return size
+
+# Each different sample is only stored once, even if more than one instrument uses it
+def estimate_samples(project, project_folder):
+	samples = {}
+	for instrument in project.get("instruments", []) + project.get("samples", []):
+		key = (instrument["source"], instrument.get("loop"), instrument.get("loop_setting"))
+		if key not in samples:
+			samples[key] = {"source": instrument["source"], "bytes": brr_bytes(os.path.join(project_folder, instrument["source"])), "instruments": []}
+		samples[key]["instruments"].append(instrument["name"])
+	return list(samples.values())
+
+def estimate_song(path, echo_edl):
+	with open(path) as f:
+		text = f.read()
+	bytecode = SONG_HEADER_BYTES
+	uses_echo = False
+	for line in text.splitlines():
+		match = CHANNEL_LINE.match(line)
+		if not match:
+			continue
+		tokens = line.split()[1:]
+		bytecode += estimate_bytes(tokens)
+		if match[1].startswith("!"):
+			bytecode += SUBROUTINE_TABLE_BYTES
+		uses_echo = uses_echo or "E1" in tokens
+	echo_length = ECHO_LENGTH.search(text)
+	if echo_length:
+		echo_edl = math.ceil(int(echo_length[1]) / 16)
+	echo = 0
+	if uses_echo:
+		echo = echo_edl * ECHO_BUFFER_BYTES_PER_EDL if echo_edl else EMPTY_ECHO_BUFFER_BYTES
+	return {"bytecode": bytecode, "echo_buffer": echo, "bytes": bytecode + echo}
+
+# Songs are loaded one at a time, so the total is everything the songs share plus the biggest song
+def estimate_project_aram(project_folder, echo_edl=0):
+	with open(os.path.join(project_folder, "project.terrificaudio")) as f:
+		project = json.load(f)
+
+	samples = estimate_samples(project, project_folder)
+	pitch_table = pitch_table_usage(project)
+	instrument_count = len(project.get("instruments", [])) + len(project.get("samples", []))
+	shared = {
+		"samples": sum(_["bytes"] for _ in samples),
+		"source_directory": len(samples) * SOURCE_DIRECTORY_ENTRY_BYTES,
+		"instruments": instrument_count * INSTRUMENT_BYTES,
+		"pitch_table": len(pitch_table) * PITCH_TABLE_ENTRY_BYTES,
+	}
+	songs = {_["name"]: estimate_song(os.path.join(project_folder, _["source"]), echo_edl) for _ in project.get("songs", [])}
+	biggest_song = max(songs, key=lambda _: songs[_]["bytes"]) if songs else None
+	return {
+		"shared": shared,
+		"sample_list": sorted(samples, key=lambda _: _["bytes"], reverse=True),
+		"pitch_table_entries": len(pitch_table),
+		"songs": songs,
+		"biggest_song": biggest_song,
+		"total": sum(shared.values()) + (songs[biggest_song]["bytes"] if songs else 0),
+	}
+
+# Returns a list of problems, which is empty if the project fits
+def check_aram_estimate(estimate, budget=None):
+	problems = []
+	if estimate["pitch_table_entries"] > PITCH_TABLE_SIZE:
+		problems.append("The pitch table needs %d entries, but only has room for %d" % (estimate["pitch_table_entries"], PITCH_TABLE_SIZE))
+	if budget != None and estimate["total"] > budget:
+		problems.append("Estimated %d bytes of audio RAM, which is %d bytes over the budget of %d" % (estimate["total"], estimate["total"] - budget, budget))
+	return problems
+
+def print_size(what, size):
+	print("%-30s %8d bytes (%.1f KiB)" % (what, size, size / 1024))
+
+def print_aram_estimate(estimate, budget=None):
+	shared = estimate["shared"]
+	print_size("Samples (%d)" % len(estimate["sample_list"]), shared["samples"])
+	for sample in estimate["sample_list"][:5]:
+		print_size("  " + sample["source"], sample["bytes"])
+	print_size("Source directory", shared["source_directory"])
+	print_size("Instruments", shared["instruments"])
+	print_size("Pitch table (%d entries)" % estimate["pitch_table_entries"], shared["pitch_table"])
+	for name, song in sorted(estimate["songs"].items(), key=lambda _: _[1]["bytes"], reverse=True):
+		print_size("Song %s%s" % (name, " (biggest)" if name == estimate["biggest_song"] else ""), song["bytecode"])
+		if song["echo_buffer"]:
+			print_size("  Echo buffer", song["echo_buffer"])
+	print_size("Total with the biggest song", estimate["total"])
+	if budget != None:
+		print_size("Budget", budget)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(prog='aram_estimate', description='Estimates how much audio RAM a Terrific Audio Driver project needs')
+	parser.add_argument('project_folder')
+	parser.add_argument('--aram-budget', type=int) # In bytes
+	parser.add_argument('--echo-edl', default=0, type=int)
+	parser.add_argument('--output', type=str) # JSON file to write the estimate to
+	args = parser.parse_args()
+
+	estimate = estimate_project_aram(args.project_folder, args.echo_edl)
+	print_aram_estimate(estimate, args.aram_budget)
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(estimate, f, indent="\t")
+	problems = check_aram_estimate(estimate, args.aram_budget)
+	if problems:
+		sys.exit("\n".join(problems))
@@ -0,0 +1,137 @@
+# batch2tad
+#
+# Copyright (c) 2025 NovaSquirrel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Converts a folder (or a glob) full of .fur and .it files into one Terrific Audio Driver project
+import time, copy
+import concurrent.futures
+from fur2tad import *
+
+def find_modules(path):
+	if os.path.isdir(path):
+		paths = glob.glob(os.path.join(path, "*"))
+	else:
+		paths = glob.glob(path)
+	return sorted(_ for _ in paths if os.path.splitext(_)[1].lower() in (".fur", ".it"))
+
+# Runs inside the worker processes; the timer and tempo caches stay filled from one module to the next
+def convert_module(path, project_folder, folder_name, options, cache):
+	start_time = time.perf_counter()
+	module_folder = os.path.join(project_folder, folder_name)
+	options = copy.copy(options)
+	options.project_name_prefix = folder_name + "_"
+	cache_hits = cache.hits if cache else 0
+	result = convert(path, options, cache)
+	tracker_file = result.tracker_file
+	if path.lower().endswith(".it"):
+		import it2tad # Only needed for .it files
+		it2tad.dump_wav_samples(tracker_file, module_folder)
+		if options.encode_brr or options.optimize_samples:
+			it2tad.encode_wav_samples(tracker_file, module_folder)
+		sample_filenames = glob.glob(os.path.join(module_folder, "*.wav"))
+	else:
+		dump_brr_samples(tracker_file, module_folder)
+		sample_filenames = glob.glob(os.path.join(module_folder, "*.brr"))
+
+	project = {"songs": [], "instruments": [], "samples": []}
+	mml_bytes = 0
+	for song_name, mml_text in result.songs:
+		mml_filename = "%s.mml" % song_name
+		write_file_if_changed(os.path.join(module_folder, mml_filename), mml_text.encode())
+		mml_bytes += len(mml_text)
+		project["songs"].append({"name": folder_name + "_" + song_name, "source": folder_name + "/" + mml_filename})
+	add_instruments_to_project(project, tracker_file, sample_filenames, folder_name)
+
+	stats = {
+		"input_bytes": os.path.getsize(path),
+		"mml_bytes": mml_bytes,
+		"sample_bytes": sum(os.path.getsize(_) for _ in sample_filenames),
+		"cached_songs": (cache.hits - cache_hits) if cache else 0,
+		"used_notes": used_note_counts(tracker_file),
+		"seconds": time.perf_counter() - start_time,
+	}
+	return project, stats
+
+def print_size(what, size):
+	print("%-14s %10d bytes (%.1f KiB)" % (what, size, size / 1024))
+
+if __name__ == "__main__": # Worker processes import this file again
+	args = parser.parse_args()
+	options = options_from_args(args)
+	options.jobs = 1 # Modules are spread across processes instead
+	cache = cache_from_args(args)
+	if not args.project_folder:
+		sys.exit("Batch conversion needs --project-folder")
+	paths = find_modules(args.filename)
+	if not paths:
+		sys.exit("No .fur or .it files found in %s" % args.filename)
+	os.makedirs(args.project_folder, exist_ok=True)
+
+	used_names = set()
+	folder_names = [module_folder_name(_, used_names) for _ in paths]
+
+	start_time = time.perf_counter()
+	if args.jobs > 1:
+		with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+			results = list(pool.map(convert_module, paths, [args.project_folder] * len(paths), folder_names, [options] * len(paths), [cache] * len(paths)))
+	else:
+		results = [convert_module(path, args.project_folder, folder_name, options, cache) for path, folder_name in zip(paths, folder_names)]
+	total_time = time.perf_counter() - start_time
+
+	# Put every module into one shared project, in the same order as the file list
+	project = start_project(args.project_folder, args.add_to_project)
+	totals = {"input_bytes": 0, "mml_bytes": 0, "sample_bytes": 0, "cached_songs": 0}
+	song_count = 0
+	note_counts = {}
+	songs = []
+	used_names = set(_["name"] for _ in project["instruments"] + project["samples"])
+	for path, (module_project, stats) in zip(paths, results):
+		# Only happens with --add-to-project, when a module that's already in the project changed one of its instruments
+		clashes = rename_clashing_instruments(module_project["instruments"] + module_project["samples"], used_names)
+		rename_instruments_in_songs(module_project, args.project_folder, clashes)
+		for key in ("instruments", "samples"):
+			project[key] += module_project[key]
+		songs += module_project["songs"]
+		for key in totals:
+			totals[key] += stats[key]
+		song_count += len(module_project["songs"])
+		note_counts.update(stats["used_notes"])
+		print("%s: %d songs, %d bytes of MML, %.2f s" % (path, len(module_project["songs"]), stats["mml_bytes"], stats["seconds"]))
+	# Modules often come with copies of the same samples and instruments, so only keep one of each and point the songs at it
+	renames = deduplicate_project(project, args.project_folder)
+	for song in songs:
+		mml_path = os.path.join(args.project_folder, song["source"])
+		with open(mml_path) as f:
+			mml_text = f.read()
+		write_file_if_changed(mml_path, rename_instruments_in_mml(mml_text, renames).encode())
+		add_song_to_project(project, song["name"], song["source"])
+	optimize_project_pitch_table(project, options, note_counts)
+	write_project(project, args.project_folder)
+
+	print()
+	print("Converted %d modules (%d songs, %d from the cache) in %.2f s" % (len(paths), song_count, totals["cached_songs"], total_time))
+	print("%.2f modules/s, %.2f songs/s, %.1f KiB/s of input" % (len(paths) / total_time, song_count / total_time, totals["input_bytes"] / 1024 / total_time))
+	print_size("Input", totals["input_bytes"])
+	print_size("MML", totals["mml_bytes"])
+	print_size("Samples", totals["sample_bytes"])
+	if args.aram_budget != None:
+		print()
+	check_aram_budget(args)
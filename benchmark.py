@@ -0,0 +1,164 @@
+# benchmark
+#
+# Copyright (c) 2025 NovaSquirrel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Times each stage of converting Furnace modules into a project, and writes the results as JSON so they can be compared between commits
+import time, tempfile, shutil, platform, subprocess, contextlib
+from fur2tad import *
+from synthetic_fur import SyntheticModuleSettings, write_furnace_module
+
+STAGES = ("parse", "flatten", "patterns", "compress", "write")
+
+# Synthetic modules used when no modules are given on the command line
+BENCHMARK_MODULES = {
+	"small":            {},
+	"long_orders":      {"order_length": 48},
+	"many_subsongs":    {"subsongs": 8},
+	"dense":            {"note_density": 0.9, "effect_density": 0.7},
+	"groove":           {"groove": True, "subsongs": 3},
+	"many_instruments": {"instruments": 32, "samples": 16},
+}
+
+# Converts one module into a project, the same way fur2tad --project-folder does, and returns the seconds spent in each stage
+def benchmark_conversion(path, options, project_folder):
+	times = dict.fromkeys(STAGES, 0.0)
+	with timer_choosers_lock:
+		timer_choosers.clear() # Every run picks its timers from scratch, like a new process would
+
+	start = time.perf_counter()
+	fur_file = FurnaceFile(path, options)
+	times["parse"] = time.perf_counter() - start
+
+	mml_texts = []
+	subroutine_count = 0
+	for song in fur_file.songs:
+		start = time.perf_counter()
+		timeline = song.flatten_orders()
+		times["flatten"] += time.perf_counter() - start
+
+		start = time.perf_counter()
+		header, mml_sequences = song.convert_timeline_to_mml_sequences(timeline)
+		times["patterns"] += time.perf_counter() - start
+
+		start = time.perf_counter()
+		mml_sequences, count = merge_compressed_channels(compress_song_sequences(mml_sequences, options), subroutine_count)
+		subroutine_count += count
+		mml_texts.append(render_mml(header, mml_sequences))
+		times["compress"] += time.perf_counter() - start
+
+	start = time.perf_counter()
+	dump_brr_samples(fur_file, project_folder)
+	project = start_project(project_folder)
+	for song, mml_text in zip(fur_file.songs, mml_texts):
+		mml_filename = "%s.mml" % song.name
+		write_file_if_changed(os.path.join(project_folder, mml_filename), mml_text.encode())
+		project["songs"].append({"name": song.name, "source": mml_filename})
+	add_instruments_to_project(project, fur_file, glob.glob(os.path.join(project_folder, '*.brr')))
+	write_project(project, project_folder)
+	times["write"] = time.perf_counter() - start
+
+	return times, len(fur_file.songs), sum(len(_) for _ in mml_texts)
+
+def benchmark_module(name, path, options, repeat, settings=None):
+	runs = []
+	for _ in range(repeat):
+		project_folder = tempfile.mkdtemp(prefix="fur2tad-benchmark-")
+		try:
+			with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull): # Conversion warnings aren't interesting here
+				times, song_count, mml_bytes = benchmark_conversion(path, options, project_folder)
+		finally:
+			shutil.rmtree(project_folder)
+		times["total"] = sum(times.values())
+		runs.append(times)
+
+	result = {
+		"name": name,
+		"input_bytes": os.path.getsize(path),
+		"songs": song_count,
+		"mml_bytes": mml_bytes,
+		"seconds": {stage: min(_[stage] for _ in runs) for stage in STAGES + ("total",)}, # The fastest run is the one with the least noise
+		"mean_seconds": {stage: sum(_[stage] for _ in runs) / repeat for stage in STAGES + ("total",)},
+	}
+	if settings:
+		result["settings"] = settings.to_dict()
+	return result
+
+def git_commit():
+	try:
+		return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def print_results(results, baseline=None):
+	baseline_modules = {_["name"]: _ for _ in baseline["modules"]} if baseline else {}
+	print("%-18s" % "Module" + "".join("%10s" % _ for _ in STAGES + ("total",)) + ("  vs. baseline" if baseline else ""))
+	for module in results["modules"]:
+		line = "%-18s" % module["name"] + "".join("%9.1fms" % (module["seconds"][_] * 1000) for _ in STAGES + ("total",))
+		old = baseline_modules.get(module["name"])
+		if old:
+			line += "  %.2fx" % (module["seconds"]["total"] / old["seconds"]["total"])
+		print(line)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(prog='benchmark', description='Times each stage of fur2tad on synthetic or real Furnace modules')
+	parser.add_argument('modules', nargs='*') # Furnace modules to use instead of the synthetic ones
+	parser.add_argument('--repeat', default=3, type=int)
+	parser.add_argument('--output', type=str) # JSON file to write the results to
+	parser.add_argument('--compare', type=str) # JSON file from an earlier run to compare against
+	parser.add_argument('--keep-modules', type=str) # Folder to keep the synthetic modules in
+	parser.add_argument('--disable-loop-compression', action='store_true')
+	parser.add_argument('--disable-sub-compression', action='store_true')
+	args = parser.parse_args()
+	options = ConversionOptions(disable_loop_compression=args.disable_loop_compression, disable_sub_compression=args.disable_sub_compression)
+
+	results = {
+		"commit": git_commit(),
+		"date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"repeat": args.repeat,
+		"options": {"disable_loop_compression": args.disable_loop_compression, "disable_sub_compression": args.disable_sub_compression},
+		"modules": [],
+	}
+	if args.modules:
+		for path in args.modules:
+			results["modules"].append(benchmark_module(os.path.splitext(os.path.basename(path))[0], path, options, args.repeat))
+	else:
+		module_folder = args.keep_modules or tempfile.mkdtemp(prefix="fur2tad-benchmark-")
+		os.makedirs(module_folder, exist_ok=True)
+		try:
+			for name, setting_values in BENCHMARK_MODULES.items():
+				settings = SyntheticModuleSettings(**setting_values)
+				path = os.path.join(module_folder, name + ".fur")
+				write_furnace_module(path, settings)
+				results["modules"].append(benchmark_module(name, path, options, args.repeat, settings))
+		finally:
+			if not args.keep_modules:
+				shutil.rmtree(module_folder)
+
+	baseline = None
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)
+	print_results(results, baseline)
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(results, f, indent="\t")
@@ -0,0 +1,264 @@
+# brr_encoder
+#
+# Copyright (c) 2025 NovaSquirrel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Turns 8 and 16-bit PCM samples into BRR, the format the SNES plays samples in.
+# Samples are 16-bit integers in lists, since that's what comes out of the modules.
+import array, concurrent.futures, itertools, math, sys, wave
+
+BRR_BLOCK_SAMPLES = 16
+BRR_BLOCK_BYTES = 9
+MAX_SAMPLE_RATE = 32000 # The SNES can't play anything back faster than this, so samples above it are resampled down
+MAX_SHIFT = 12
+SILENCE_LEVEL = 64 # With --optimize-samples, samples this close to 0 at the end of a one-shot sample get dropped
+
+# -------------------------------------------------------------------
+# Reading PCM
+
+# Returns a list of 16-bit samples from raw sample data
+def pcm_from_bytes(data, bits, signed=True, big_endian=False):
+	if bits == 8:
+		return [(_ - 256 if _ >= 128 else _) << 8 if signed else (_ - 128) << 8 for _ in data]
+	samples = array.array("h" if signed else "H")
+	samples.frombytes(data[:len(data) // 2 * 2]) # Works with memoryviews too
+	if big_endian != (sys.byteorder == "big"):
+		samples.byteswap()
+	return list(samples) if signed else [_ - 32768 for _ in samples]
+
+# Returns a list of 16-bit samples and the sample rate. Stereo is mixed down to mono.
+def read_wav(path):
+	with wave.open(path) as f:
+		channels, width, rate = f.getnchannels(), f.getsampwidth(), f.getframerate()
+		data = f.readframes(f.getnframes())
+	if width == 1:
+		samples = pcm_from_bytes(data, 8, signed=False)
+	elif width == 2:
+		samples = pcm_from_bytes(data, 16)
+	else:
+		raise ValueError("%s has %d-bit samples, only 8 and 16-bit are supported" % (path, width * 8))
+	if channels > 1:
+		samples = [sum(samples[i:i+channels]) // channels for i in range(0, len(samples), channels)]
+	return samples, rate
+
+# -------------------------------------------------------------------
+# Resampling and loop alignment
+
+# Linear interpolation to length samples
+def resample(samples, length):
+	if length == len(samples) or not samples:
+		return list(samples)
+	step = len(samples) / length
+	out = []
+	last = len(samples) - 1
+	for i in range(length):
+		position = i * step
+		index = int(position)
+		if index >= last:
+			out.append(samples[last])
+			continue
+		fraction = position - index
+		out.append(round(samples[index] + (samples[index+1] - samples[index]) * fraction))
+	return out
+
+# Drops the silence from the end of a one-shot sample
+def trim_silence(samples, level=SILENCE_LEVEL):
+	end = len(samples)
+	while end > 0 and abs(samples[end-1]) <= level:
+		end -= 1
+	return samples[:end]
+
+# How long a loop gets stretched or squashed to, so it's a whole number of blocks
+def aligned_loop_length(loop_length):
+	return max(BRR_BLOCK_SAMPLES, round(loop_length / BRR_BLOCK_SAMPLES) * BRR_BLOCK_SAMPLES)
+
+# Repeats the loop the fewest times that makes it a whole number of blocks, and moves the loop start forward to the next block,
+# which sounds the same since the part that got skipped gets played at the end of the loop instead. The loop is played back
+# exactly as it was, without being resampled. Returns the samples and the new loop start.
+def unroll_loop(samples, loop_start):
+	loop = samples[loop_start:]
+	repeats = BRR_BLOCK_SAMPLES // math.gcd(len(loop), BRR_BLOCK_SAMPLES)
+	new_loop_start = loop_start + (-loop_start % BRR_BLOCK_SAMPLES)
+	length = new_loop_start + len(loop) * repeats
+	return samples[:loop_start] + [loop[_ % len(loop)] for _ in range(length - loop_start)], new_loop_start
+
+# BRR loops have to start on a block and be a whole number of blocks long. Looped samples get stretched so the loop is a whole number of blocks,
+# and then silence is added to the start so the loop starts on a block. Returns the samples, the new sample rate and the new loop start.
+# With optimize, loops are unrolled instead of stretched when that doesn't make them longer (like loops that are 4 or 8 samples long),
+# and one-shot samples lose their silent ending.
+def align_samples(samples, rate, loop_start=None, max_rate=MAX_SAMPLE_RATE, optimize=False):
+	if rate > max_rate:
+		length = max(1, round(len(samples) * max_rate / rate))
+		if loop_start != None:
+			loop_start = round(loop_start * length / len(samples))
+		rate = rate * length / len(samples)
+		samples = resample(samples, length)
+
+	if optimize:
+		if loop_start == None:
+			samples = trim_silence(samples)
+		elif 0 <= loop_start < len(samples):
+			loop_length = len(samples) - loop_start
+			if loop_length * BRR_BLOCK_SAMPLES // math.gcd(loop_length, BRR_BLOCK_SAMPLES) <= aligned_loop_length(loop_length):
+				samples, loop_start = unroll_loop(samples, loop_start)
+				return samples, rate, loop_start
+
+	if loop_start != None and 0 <= loop_start < len(samples):
+		loop_length = len(samples) - loop_start
+		aligned_length = aligned_loop_length(loop_length)
+		if aligned_length != loop_length:
+			ratio = aligned_length / loop_length
+			loop_start = round(loop_start * ratio)
+			samples = resample(samples, loop_start + aligned_length)
+			rate *= ratio
+		padding = -loop_start % BRR_BLOCK_SAMPLES
+		return [0] * padding + samples, rate, loop_start + padding
+
+	samples = samples or [0]
+	return samples + [0] * (-len(samples) % BRR_BLOCK_SAMPLES), rate, None
+
+# -------------------------------------------------------------------
+# Encoding
+
+# Decodes one BRR nibble the way the SNES does. Previous samples are stored doubled, like the SNES does.
+def decode_nibble(nibble, shift, brr_filter, p1, p2):
+	s = (nibble << shift) >> 1 if shift <= MAX_SHIFT else (-2048 if nibble < 0 else 0)
+	p2 >>= 1
+	if brr_filter == 1:
+		s += (p1 >> 1) + ((-p1) >> 5)
+	elif brr_filter == 2:
+		s += p1 - p2 + (p2 >> 4) + ((p1 * -3) >> 6)
+	elif brr_filter == 3:
+		s += p1 - p2 + ((p1 * -13) >> 7) + ((p2 * 3) >> 4)
+	s = -32768 if s < -32768 else 32767 if s > 32767 else s
+	s = (s << 1) & 0xFFFF
+	return s - 0x10000 if s & 0x8000 else s
+
+# What a filter predicts the next sample will be, in the same units as the nibble after shifting
+def filter_prediction(brr_filter, p1, p2):
+	return decode_nibble(0, 0, brr_filter, p1, p2) >> 1
+
+# Tries one filter and shift on a block, and returns the total squared error, the nibbles and the last two decoded samples.
+# Gives up early and returns None if the error gets bigger than give_up_at.
+def try_block(block, shift, brr_filter, p1, p2, give_up_at):
+	error = 0
+	nibbles = []
+	step = 1 << shift
+	for x in block:
+		nibble = round(((x >> 1) - filter_prediction(brr_filter, p1, p2)) * 2 / step)
+		nibble = -8 if nibble < -8 else 7 if nibble > 7 else nibble
+		y = decode_nibble(nibble, shift, brr_filter, p1, p2)
+		error += (x - y) * (x - y)
+		if error > give_up_at:
+			return None
+		nibbles.append(nibble)
+		p1, p2 = y, p1
+	return error, nibbles, p1, p2
+
+# The shift that the biggest difference from the filter's prediction needs, based on the original samples
+def smallest_shift(block, brr_filter, p1, p2):
+	biggest = 0
+	for x in block:
+		biggest = max(biggest, abs((x >> 1) - filter_prediction(brr_filter, p1, p2)) * 2)
+		p1, p2 = x, p1
+	shift = 0
+	while shift < MAX_SHIFT and (7 << shift) < biggest:
+		shift += 1
+	return shift
+
+# Returns the BRR data for samples, which has to be a whole number of blocks. loop_start is in samples and has to start a block.
+def encode_brr(samples, loop_start=None):
+	out = bytearray()
+	p1 = p2 = 0
+	loop_block = loop_start // BRR_BLOCK_SAMPLES if loop_start != None else None
+	block_count = len(samples) // BRR_BLOCK_SAMPLES
+	for block_index in range(block_count):
+		block = samples[block_index * BRR_BLOCK_SAMPLES : (block_index + 1) * BRR_BLOCK_SAMPLES]
+		# The first block and the loop's first block can be reached with anything in the filter's history, so they don't use a filter
+		filters = (0,) if block_index == 0 or block_index == loop_block else (0, 1, 2, 3)
+		best = None
+		for brr_filter in filters:
+			guess = smallest_shift(block, brr_filter, p1, p2)
+			for shift in range(max(0, guess - 1), min(MAX_SHIFT, guess + 1) + 1):
+				result = try_block(block, shift, brr_filter, p1, p2, best[0] if best else float("inf"))
+				if result != None and (best == None or result[0] < best[0]):
+					best = (result[0], shift, brr_filter, result[1], result[2], result[3])
+		error, shift, brr_filter, nibbles, p1, p2 = best
+
+		header = (shift << 4) | (brr_filter << 2)
+		if block_index == block_count - 1:
+			header |= 1 # End
+			if loop_start != None:
+				header |= 2 # Loop
+		out.append(header)
+		for i in range(0, BRR_BLOCK_SAMPLES, 2):
+			out.append(((nibbles[i] & 15) << 4) | (nibbles[i+1] & 15))
+	return bytes(out)
+
+# Resamples, aligns and encodes one sample. Returns the BRR data, the new sample rate and the new loop start.
+def encode_sample(samples, rate, loop_start=None, max_rate=MAX_SAMPLE_RATE, optimize=False):
+	samples, rate, loop_start = align_samples(samples, rate, loop_start, max_rate, optimize)
+	return encode_brr(samples, loop_start), rate, loop_start
+
+# Encodes several samples, each one as (samples, rate, loop start), spread over jobs processes
+def encode_samples(samples, jobs=1, optimize=False):
+	if jobs <= 1 or len(samples) <= 1:
+		return [encode_sample(*_, optimize=optimize) for _ in samples]
+	with concurrent.futures.ProcessPoolExecutor(min(jobs, len(samples))) as pool:
+		return list(pool.map(encode_sample, *zip(*samples), itertools.repeat(MAX_SAMPLE_RATE), itertools.repeat(optimize)))
+
+# How many bytes of BRR data a sample would take without optimize, to compare against
+def unoptimized_size(samples, rate, loop_start=None, max_rate=MAX_SAMPLE_RATE):
+	return len(align_samples(samples, rate, loop_start, max_rate)[0]) // BRR_BLOCK_SAMPLES * BRR_BLOCK_BYTES
+
+# -------------------------------------------------------------------
+# Samples that are already BRR
+
+# Decodes BRR data the way the SNES does. Like decode_nibble(), the results are doubled.
+def decode_brr(data):
+	out = []
+	p1 = p2 = 0
+	for i in range(0, len(data) - BRR_BLOCK_BYTES + 1, BRR_BLOCK_BYTES):
+		shift, brr_filter = data[i] >> 4, (data[i] >> 2) & 3
+		for byte in data[i+1 : i+BRR_BLOCK_BYTES]:
+			for nibble in (byte >> 4, byte & 15):
+				y = decode_nibble(nibble - 16 if nibble >= 8 else nibble, shift, brr_filter, p1, p2)
+				out.append(y)
+				p1, p2 = y, p1
+	return out
+
+# Drops the blocks after the one the loop ends in, or the silent blocks at the end of a one-shot sample. Loop points are in samples.
+def trim_brr(data, loop_start=None, loop_end=None):
+	blocks = len(data) // BRR_BLOCK_BYTES
+	if loop_start != None:
+		if loop_end != None and loop_end > loop_start:
+			blocks = min(blocks, max(loop_start // BRR_BLOCK_SAMPLES + 1, math.ceil(loop_end / BRR_BLOCK_SAMPLES)))
+	else:
+		decoded = decode_brr(data)
+		while blocks > 1 and all(abs(_) <= SILENCE_LEVEL for _ in decoded[(blocks-1) * BRR_BLOCK_SAMPLES : blocks * BRR_BLOCK_SAMPLES]):
+			blocks -= 1
+	return data[:blocks * BRR_BLOCK_BYTES]
+
+# savings is a list of (sample name, bytes before, bytes after). This can happen while the MML is going to stdout, so the table goes to stderr.
+def print_sample_savings(savings, file=sys.stderr):
+	print("%-32s %8s %8s %8s" % ("Sample", "Before", "After", "Saved"), file=file)
+	for name, before, after in savings:
+		print("%-32s %8d %8d %8d" % (name, before, after, before - after), file=file)
+	print("%-32s %8d %8d %8d" % ("Total", sum(_[1] for _ in savings), sum(_[2] for _ in savings), sum(_[1] - _[2] for _ in savings)), file=file)
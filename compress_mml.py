@@ -20,6 +20,10 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import hashlib, json, re, sys
+from collections import Counter
+from profiling import profile
+
 # Loop optimization
 LOOP_PASSES = 4
 MAX_LOOP_INSTRUCTIONS = 35
@@ -27,7 +31,6 @@ MAX_LOOP_INSTRUCTIONS = 35
 # Subroutine optimization
 MAX_SUBROUTINE_LENGTH = 30
 MIN_SUBROUTINE_LENGTH = 4
-subroutine_count = 0
 
 def token_is_note(token):
 	return token.startswith("o") or token.startswith("{")
@@ -115,8 +118,8 @@ def replace_with_loops(input):
 	return out
 
 def replace_with_subroutines(channel, mml_sequences):
-	global subroutine_count
 	sequence = mml_sequences[channel]
+	subroutine_count = sum(1 for _ in mml_sequences if _.startswith("!sub")) # Number after any subroutines already in mml_sequences
 
 	# Find where every token type is
 	token_locations = {}
@@ -239,11 +242,256 @@ def optimize_subroutines(mml_sequences):
 	# TODO
 	pass
 
+def count_tokens(mml_sequences):
+	return sum(len(_) for _ in mml_sequences.values())
+
+def estimate_sequences_bytes(mml_sequences):
+	return sum(estimate_bytes(_) for _ in mml_sequences.values())
+
 def compress_mml(channel, mml_sequences, loop_compression, sub_compression):
 	if loop_compression:
 		# Find loops
-		for _ in range(LOOP_PASSES):
-			mml_sequences[channel] = replace_with_loops(mml_sequences[channel])
+		for pass_number in range(LOOP_PASSES):
+			with profile("loop pass %d" % (pass_number+1), "compress pass", channel=channel, tokens_in=len(mml_sequences[channel])) as span:
+				if span.recording:
+					span.args["bytes_in"] = estimate_bytes(mml_sequences[channel])
+				mml_sequences[channel] = replace_with_loops(mml_sequences[channel])
+				span.args["tokens_out"] = len(mml_sequences[channel])
+				if span.recording:
+					span.args["bytes_out"] = estimate_bytes(mml_sequences[channel])
 	if sub_compression:
-		replace_with_subroutines(channel, mml_sequences)
-		optimize_subroutines(mml_sequences)
+		with profile("subroutines", "compress pass", channel=channel, tokens_in=count_tokens(mml_sequences)) as span:
+			if span.recording:
+				span.args["bytes_in"] = estimate_sequences_bytes(mml_sequences)
+			replace_with_subroutines(channel, mml_sequences)
+			optimize_subroutines(mml_sequences)
+			span.args["tokens_out"] = count_tokens(mml_sequences) # Including the subroutines
+			span.args["subroutines"] = sum(1 for _ in mml_sequences if _.startswith("!sub"))
+			if span.recording:
+				span.args["bytes_out"] = estimate_sequences_bytes(mml_sequences)
+
+# Compress one channel with its own set of subroutines, numbered from !sub0.
+# Channels don't depend on each other, so this can run in a separate process.
+def compress_channel(channel, sequence, loop_compression, sub_compression):
+	with profile("compress %s" % channel, "compress", channel=channel, tokens_in=len(sequence)) as span:
+		if span.recording:
+			span.args["bytes_in"] = estimate_bytes(sequence)
+		mml_sequences = {channel: sequence}
+		compress_mml(channel, mml_sequences, loop_compression, sub_compression)
+		span.args["tokens_out"] = count_tokens(mml_sequences)
+		if span.recording:
+			span.args["bytes_out"] = estimate_sequences_bytes(mml_sequences)
+	return mml_sequences
+
+# Remembers compress_channel() results between conversions, so channels that didn't change don't get compressed again.
+# Results that weren't used during a round are forgotten when the next round starts, to keep memory use from growing.
+class CompressionMemo(object):
+	def __init__(self):
+		self.previous_round = {}
+		self.this_round = {}
+
+	def start_round(self):
+		self.previous_round = self.this_round
+		self.this_round = {}
+
+	def key(self, channel, sequence, loop_compression, sub_compression):
+		return hashlib.sha256(("%s %d %d\n" % (channel, loop_compression, sub_compression) + "\n".join(sequence)).encode()).digest()
+
+	def get(self, key):
+		result = self.this_round.get(key) or self.previous_round.get(key)
+		if result != None:
+			self.this_round[key] = result
+		return result
+
+	def put(self, key, result):
+		self.this_round[key] = result
+
+# Give the subroutines in mml_sequences new numbers starting at first_number, in the order they were created
+def renumber_subroutines(mml_sequences, first_number):
+	new_names = {}
+	for name in mml_sequences:
+		if name.startswith("!sub"):
+			new_names[name] = "!sub%d" % (first_number + len(new_names))
+	renumbered = {new_names.get(k, k):[new_names.get(_, _) for _ in v] for k,v in mml_sequences.items()}
+	return renumbered, len(new_names)
+
+# Combine the results of compress_channel() into one set of sequences, with the channels first and then the subroutines.
+# Subroutines are numbered in channel order starting at first_subroutine_number, which is the same as compressing the channels one after another.
+def merge_compressed_channels(compressed_channels, first_subroutine_number=0):
+	channels = {}
+	subroutines = {}
+	for mml_sequences in compressed_channels:
+		mml_sequences, _ = renumber_subroutines(mml_sequences, first_subroutine_number + len(subroutines))
+		for k,v in mml_sequences.items():
+			if k.startswith("!sub"):
+				subroutines[k] = v
+			else:
+				channels[k] = v
+	channels.update(subroutines)
+	return channels, len(subroutines)
+
+# -------------------------------------------------------------------
+# Size estimates
+
+# Roughly how many bytes of bytecode the driver needs for each kind of token. Most commands are an opcode and one argument.
+TOKEN_BYTES = {
+	"[":    2, # Start loop and its count
+	":":    2, # Skip last loop and its offset
+	"]":    1, # End loop
+	"L":    0, # The loop point is stored in the song header
+	"!":    2, # Call subroutine
+	"?":    0, # Hints for the compiler
+	"@":    2, # Set instrument
+	"MP":   3, # Vibrato depth and speed
+	"{":    4, # Portamento: note, speed and length
+}
+DEFAULT_TOKEN_BYTES = 2 # Notes, rests, waits, volume, panning and the rest
+MAX_TICKS_PER_COMMAND = 256 # Longer notes and waits need another wait after them
+TICKS = re.compile(r"%(\d+)")
+
+def estimate_token_bytes(token):
+	if not token:
+		return 0
+	size = TOKEN_BYTES.get(token[:2], TOKEN_BYTES.get(token[0], DEFAULT_TOKEN_BYTES))
+	ticks = TICKS.search(token)
+	if ticks and size:
+		size += int(ticks[1]) // MAX_TICKS_PER_COMMAND * DEFAULT_TOKEN_BYTES
+	return size
+
+# Estimated bytecode size of a list of tokens. This also works on MML that was split on spaces, where a portamento is more than one word.
+def estimate_bytes(tokens):
+	total = 0
+	in_portamento = False
+	for token in tokens:
+		if in_portamento:
+			in_portamento = "}" not in token
+			continue
+		total += estimate_token_bytes(token)
+		in_portamento = token.startswith("{") and "}" not in token
+	return total
+
+# -------------------------------------------------------------------
+# --compression-report
+
+COMPRESSION_REPORT_TOP_SPANS = 5
+COMPRESSION_REPORT_PREVIEW_TOKENS = 8
+
+# How many times each subroutine gets called from all of the sequences
+def subroutine_calls(mml_sequences):
+	return Counter(token for sequence in mml_sequences.values() for token in sequence if token.startswith("!sub"))
+
+# Runs of tokens that aren't in a loop and don't call a subroutine, as (start index, length), biggest first
+def uncompressed_spans(sequence):
+	spans = []
+	loop_level = 0
+	start = None
+	for index, token in enumerate(sequence + ["L"]):
+		if token == "[":
+			loop_level += 1
+		elif token.startswith("]"):
+			loop_level -= 1
+		if loop_level or token == "[" or token.startswith("]") or token == "L" or token.startswith("!sub"):
+			if start != None:
+				spans.append((start, index - start))
+				start = None
+		elif start == None:
+			start = index
+	return sorted(spans, key=lambda _: estimate_bytes(sequence[_[0]:_[0]+_[1]]), reverse=True)
+
+class CompressionReport(object):
+	def __init__(self):
+		self.songs = []
+
+	# Called with every song's sequences after the channels have been compressed and merged
+	def add_song(self, song_name, mml_sequences):
+		calls = subroutine_calls(mml_sequences)
+		channels = [_ for _ in mml_sequences if not _.startswith("!sub")]
+		subroutines = []
+		for name, sequence in mml_sequences.items():
+			if name.startswith("!sub"):
+				subroutines.append({
+					"name": name,
+					"channel": next((_ for _ in channels if name in mml_sequences[_]), None),
+					"tokens": len(sequence),
+					"bytes": estimate_bytes(sequence),
+					"calls": calls[name],
+				})
+		spans = []
+		for channel in channels:
+			sequence = mml_sequences[channel]
+			for start, length in uncompressed_spans(sequence)[:COMPRESSION_REPORT_TOP_SPANS]:
+				tokens = sequence[start:start+length]
+				spans.append({"channel": channel, "start": start, "tokens": length, "bytes": estimate_bytes(tokens), "mml": " ".join(tokens[:COMPRESSION_REPORT_PREVIEW_TOKENS]) + (" ..." if length > COMPRESSION_REPORT_PREVIEW_TOKENS else "")})
+		spans.sort(key=lambda _: _["bytes"], reverse=True)
+		self.songs.append({
+			"song": song_name,
+			"bytes": estimate_sequences_bytes(mml_sequences),
+			"channels": [{
+				"channel": _,
+				"tokens_out": len(mml_sequences[_]) + sum(s["tokens"] for s in subroutines if s["channel"] == _), # Subroutines are only used by the channel they came from
+				"bytes_out": estimate_bytes(mml_sequences[_]) + sum(s["bytes"] for s in subroutines if s["channel"] == _),
+				"subroutines": sum(1 for s in subroutines if s["channel"] == _),
+				"passes": [],
+			} for _ in channels],
+			"subroutines": subroutines,
+			"largest_uncompressed_spans": spans[:COMPRESSION_REPORT_TOP_SPANS],
+		})
+
+	# Fills in the channel sizes before compression and the results of each pass from the profiler's spans
+	def add_passes(self, events):
+		channels = {(song["song"], channel["channel"]): channel for song in self.songs for channel in song["channels"]}
+		for event in events:
+			channel = channels.get((event["args"].get("song"), event["args"].get("channel")))
+			if channel == None or "bytes_in" not in event["args"]:
+				continue
+			if event["category"] == "compress":
+				channel["tokens_in"] = event["args"]["tokens_in"]
+				channel["bytes_in"] = event["args"]["bytes_in"]
+			elif event["category"] == "compress pass":
+				channel["passes"].append({_: event["args"][_] for _ in ("tokens_in", "tokens_out", "bytes_in", "bytes_out")})
+				channel["passes"][-1]["pass"] = event["name"]
+
+	def report(self):
+		return {"bytes": sum(_["bytes"] for _ in self.songs), "songs": self.songs}
+
+	# The MML can be going to stdout, so the table goes to stderr
+	def print_report(self, file=sys.stderr):
+		pass_names = []
+		for song in self.songs:
+			for channel in song["channels"]:
+				for p in channel["passes"]:
+					if p["pass"] not in pass_names:
+						pass_names.append(p["pass"])
+		# Each pass shows how many estimated bytes of bytecode it changed the channel by, so a pass that made it bigger is positive
+		print("%-20s %-7s %15s " % ("Song", "Channel", "Bytes") + "".join("%20s" % ("%s (bytes)" % _) for _ in pass_names), file=file)
+		for song in self.songs:
+			for channel in song["channels"]:
+				saved = {_["pass"]: _["bytes_in"] - _["bytes_out"] for _ in channel["passes"]}
+				before = "%d -> " % channel["bytes_in"] if "bytes_in" in channel else ""
+				print("%-20s %-7s %15s " % (song["song"], channel["channel"], before + str(channel["bytes_out"])) + "".join("%20s" % ("%+d" % -saved[_] if saved.get(_) else "0" if _ in saved else "") for _ in pass_names), file=file)
+			subroutines = song["subroutines"]
+			print("%-20s %d bytes, %d subroutines using %d bytes and called %d times" % (song["song"], song["bytes"], len(subroutines), sum(_["bytes"] for _ in subroutines), sum(_["calls"] for _ in subroutines)), file=file)
+			for span in song["largest_uncompressed_spans"][:1]:
+				print("%-20s Largest uncompressed run: %d bytes in channel %s at token %d: %s" % ("", span["bytes"], span["channel"], span["start"], span["mml"]), file=file)
+		print("Estimated bytecode for every song: %d bytes" % self.report()["bytes"], file=file)
+
+	def write(self, path):
+		with open(path, "w") as f:
+			json.dump(self.report(), f, indent="\t")
+
+active_compression_report = None
+
+def start_compression_report():
+	global active_compression_report
+	active_compression_report = CompressionReport()
+	return active_compression_report
+
+def stop_compression_report():
+	global active_compression_report
+	report = active_compression_report
+	active_compression_report = None
+	return report
+
+def report_song_compression(song_name, mml_sequences):
+	if active_compression_report:
+		active_compression_report.add_song(song_name, mml_sequences)
@@ -0,0 +1,242 @@
+# compression_benchmark
+#
+# Copyright (c) 2025 NovaSquirrel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Measures how the MML compressor's time and output size grow with the length of a channel, and fails if
+# either got worse than the baseline stored in compression_baseline.json. Times are compared as multiples of a
+# calibration loop timed right next to them, so a baseline recorded on a faster or slower computer still works.
+# The scaling exponents are printed to show where the time goes, but they move around too much from run to run to fail on.
+import argparse, json, math, os, random, sys, time
+from compress_mml import compress_channel
+
+BASELINE_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "compression_baseline.json")
+DEFAULT_SIZES = [500, 1000, 2000, 4000] # Tokens in the channel
+MIN_MEASURE_SECONDS = 0.02 # Fast cases are run several times in a row so the timer's resolution doesn't matter
+MIN_EXPONENT_SECONDS = 0.005 # Cases faster than this at the largest size are mostly timer noise, so they don't get an exponent or a time check
+BASELINE_RUNS = 3 # --update-baseline keeps the slowest of this many runs, so a lucky fast run doesn't make the check fail later
+
+# Compression passes to measure: (loop compression, subroutine compression)
+MODES = {
+	"loops":       (True, False),
+	"subroutines": (False, True),
+	"both":        (True, True),
+}
+
+NOTE_NAMES = ["c", "c+", "d", "d+", "e", "f", "f+", "g", "g+", "a", "a+", "b"]
+
+# -------------------------------------------------------------------
+# Token streams, shaped like what FurnacePattern.convert_to_tad() makes
+
+def random_token(r):
+	x = r.random()
+	if x < 0.05:
+		return "@Inst%d" % r.randrange(4)
+	if x < 0.15:
+		return "w%%%d" % r.choice([3, 6])
+	return "o%d%s%%%d" % (r.randrange(2, 6), r.choice(NOTE_NAMES), r.choice([3, 6, 12]))
+
+def random_tokens(r, length):
+	return [random_token(r) for _ in range(length)]
+
+def repeat_to_length(phrase, length):
+	return [phrase[i % len(phrase)] for i in range(length)]
+
+# Nothing repeats, so neither pass finds anything, and every position gets searched
+def random_stream(r, length):
+	return random_tokens(r, length)
+
+# One short phrase over and over
+def periodic_stream(r, length):
+	return repeat_to_length(random_tokens(r, 16), length)
+
+# Phrases built out of repeated smaller phrases, like a verse made of repeated bars
+def nested_periodic_stream(r, length):
+	bar_a, bar_b, fill = random_tokens(r, 4), random_tokens(r, 4), random_tokens(r, 6)
+	phrase = bar_a * 3 + bar_b
+	return repeat_to_length(phrase * 2 + fill + bar_a * 2, length)
+
+# A repeating phrase where a few tokens are different each time, which breaks up most of the matches
+def near_duplicate_stream(r, length):
+	return [random_token(r) if r.random() < 0.05 else _ for _ in repeat_to_length(random_tokens(r, 32), length)]
+
+STREAMS = {
+	"random":          random_stream,
+	"periodic":        periodic_stream,
+	"nested_periodic": nested_periodic_stream,
+	"near_duplicate":  near_duplicate_stream,
+}
+
+# -------------------------------------------------------------------
+
+# Returns the fastest time for one compression, the number of tokens it made including subroutines, and the fastest time for the
+# calibration loop. The calibration loop runs right before each try, so anything else slowing the computer down slows both of them.
+def measure(sequence, loop_compression, sub_compression, repeat):
+	best = None
+	best_calibration = None
+	for _ in range(repeat):
+		calibration = time_calibration()
+		best_calibration = calibration if best_calibration == None else min(best_calibration, calibration)
+		iterations = 1
+		while True:
+			copies = [list(sequence) for _ in range(iterations)] # The compressor changes the list it's given
+			start = time.perf_counter()
+			for copy in copies:
+				result = compress_channel("A", copy, loop_compression, sub_compression)
+			seconds = time.perf_counter() - start
+			if seconds >= MIN_MEASURE_SECONDS or iterations >= 1000:
+				break
+			iterations *= 10
+		seconds /= iterations
+		best = seconds if best == None else min(best, seconds)
+	return best, sum(len(_) for _ in result.values()), best_calibration
+
+# Work that's a lot like what the compressor does (finding where tokens are, and comparing slices of the token list)
+# but doesn't call it, so it runs at the same speed no matter what changes in the compressor
+def calibration_workload():
+	tokens = random_tokens(random.Random(0), 2000)
+	locations = {}
+	for index, token in enumerate(tokens):
+		locations.setdefault(token, []).append(index)
+	matches = 0
+	for index in range(0, len(tokens), 2):
+		for other in locations[tokens[index]]:
+			if tokens[other:other+4] == tokens[index:index+4]:
+				matches += 1
+	return matches
+
+# The benchmark's times are divided by this before they're compared
+def time_calibration():
+	start = time.perf_counter()
+	calibration_workload()
+	return time.perf_counter() - start
+
+# Slope of the least squares line through (log size, log seconds), so 1 is linear and 2 is quadratic
+def scaling_exponent(sizes, seconds):
+	xs = [math.log(_) for _ in sizes]
+	ys = [math.log(max(_, 1e-9)) for _ in seconds]
+	x_mean = sum(xs) / len(xs)
+	y_mean = sum(ys) / len(ys)
+	return sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys)) / sum((x - x_mean) ** 2 for x in xs)
+
+def run_benchmarks(sizes, repeat, seed=1):
+	results = {}
+	for stream_name, make_stream in STREAMS.items():
+		results[stream_name] = {}
+		for mode_name, (loop_compression, sub_compression) in MODES.items():
+			seconds, tokens = [], []
+			for size in sizes:
+				sequence = make_stream(random.Random(seed), size)
+				s, t, calibration_seconds = measure(sequence, loop_compression, sub_compression, repeat)
+				seconds.append(s)
+				tokens.append(t)
+			exponent = scaling_exponent(sizes, seconds) if seconds[-1] >= MIN_EXPONENT_SECONDS else None
+			# Only the calibration time from the largest size is kept, since that's the only time that gets compared
+			results[stream_name][mode_name] = {"seconds": seconds, "tokens": tokens, "exponent": exponent, "calibration_seconds": calibration_seconds}
+	return results
+
+def relative_time(result):
+	return result["seconds"][-1] / result["calibration_seconds"]
+
+# Combines several runs into one by keeping each case's slowest run, relative to its calibration loop
+def slowest_of(runs):
+	return {stream_name: {mode_name: max((run[stream_name][mode_name] for run in runs), key=relative_time) for mode_name in modes} for stream_name, modes in runs[0].items()}
+
+# Returns a list of problems. Token counts don't depend on the computer, so any increase is a problem. Time is compared at the largest
+# size only, because that's where super-linear behavior shows up, and as a multiple of the calibration time measured along with it.
+def compare_with_baseline(results, baseline, time_tolerance):
+	problems = []
+	for stream_name, modes in results.items():
+		for mode_name, now in modes.items():
+			before = baseline["results"].get(stream_name, {}).get(mode_name)
+			if before == None:
+				continue
+			what = "%s/%s" % (stream_name, mode_name)
+			relative_now = relative_time(now)
+			relative_before = relative_time(before)
+			if now["seconds"][-1] >= MIN_EXPONENT_SECONDS and relative_now > relative_before * time_tolerance:
+				problems.append("%s: %.1f calibration loops at %d tokens, was %.1f" % (what, relative_now, baseline["sizes"][-1], relative_before))
+			for size, tokens, old_tokens in zip(baseline["sizes"], now["tokens"], before["tokens"]):
+				if tokens > old_tokens:
+					problems.append("%s: %d tokens became %d, was %d" % (what, size, tokens, old_tokens))
+	return problems
+
+def format_exponent(result):
+	return "-" if result == None or result["exponent"] == None else "%.2f" % result["exponent"]
+
+# With a baseline, its exponents get a column too, so a change in how something scales is easy to spot
+def print_results(sizes, results, baseline=None):
+	print("%-16s %-12s %8s" % ("Stream", "Pass", "Exponent") + ("%8s" % "Was" if baseline else "") + "".join("%16s" % ("%d tokens" % _) for _ in sizes))
+	for stream_name, modes in results.items():
+		for mode_name, result in modes.items():
+			line = "%-16s %-12s %8s" % (stream_name, mode_name, format_exponent(result))
+			if baseline:
+				line += "%8s" % format_exponent(baseline["results"].get(stream_name, {}).get(mode_name))
+			line += "".join("%9.2fms %5d" % (s * 1000, t) for s, t in zip(result["seconds"], result["tokens"]))
+			print(line)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(prog='compression_benchmark', description='Checks how the MML compressor scales with channel length')
+	parser.add_argument('--sizes', nargs="+", type=int, default=DEFAULT_SIZES)
+	parser.add_argument('--repeat', default=3, type=int)
+	parser.add_argument('--baseline', default=BASELINE_FILENAME, type=str)
+	parser.add_argument('--update-baseline', action='store_true')
+	parser.add_argument('--time-tolerance', default=2.0, type=float) # How many times slower the largest size can get, relative to the calibration loop
+	parser.add_argument('--output', type=str) # JSON file to write the results to
+	args = parser.parse_args()
+
+	sizes = sorted(args.sizes)
+	if len(sizes) < 2:
+		sys.exit("Need at least two sizes to measure scaling")
+	baseline = None
+	if not args.update_baseline:
+		if not os.path.exists(args.baseline):
+			sys.exit("No baseline at %s; run with --update-baseline to make one" % args.baseline)
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		if baseline["sizes"] != sizes:
+			sys.exit("The baseline was measured with --sizes %s" % " ".join(str(_) for _ in baseline["sizes"]))
+		if any("calibration_seconds" not in result for modes in baseline["results"].values() for result in modes.values()):
+			sys.exit("The baseline doesn't have calibration times; run with --update-baseline to make a new one")
+
+	if args.update_baseline:
+		results = slowest_of([run_benchmarks(sizes, args.repeat) for _ in range(BASELINE_RUNS)])
+	else:
+		results = run_benchmarks(sizes, args.repeat)
+	print_results(sizes, results, baseline)
+	calibrations = [result["calibration_seconds"] for modes in results.values() for result in modes.values()]
+	print("Calibration loop: %.2f to %.2f ms" % (min(calibrations) * 1000, max(calibrations) * 1000))
+
+	report = {"sizes": sizes, "repeat": args.repeat, "results": results}
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(report, f, indent="\t")
+	if args.update_baseline:
+		with open(args.baseline, "w") as f:
+			json.dump(report, f, indent="\t")
+		print("Updated %s" % args.baseline)
+		sys.exit(0)
+
+	problems = compare_with_baseline(results, baseline, args.time_tolerance)
+	for problem in problems:
+		print(problem)
+	if problems:
+		sys.exit(1)
+	print("No regressions compared to %s" % args.baseline)
@@ -0,0 +1,110 @@
+# fur2tad
+#
+# Copyright (c) 2025 NovaSquirrel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# On-disk cache for converted songs, so songs that haven't changed don't need to be converted again.
+# Entries are named after a hash of everything that affects the output (see song_cache_key() in fur2tad.py)
+# and the least recently used entries are removed when the cache gets too big.
+import os, json, tempfile
+
+DEFAULT_CACHE_FOLDER = ".fur2tad-cache"
+DEFAULT_CACHE_MAX_SIZE = 256*1024*1024
+CACHE_FILE_EXTENSIONS = (".json", ".ir") # Converted songs, and parsed modules from fur2tad's FurnaceFile.ir_bytes()
+
+# mkstemp() only gives the owner access, so files need their permissions set to what open() would have used
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+# Write to a temporary file first and then rename it, so other processes never see a half-written file
+def write_file_atomically(path, data):
+	folder = os.path.dirname(path) or "."
+	os.makedirs(folder, exist_ok=True)
+	fd, temporary_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+	try:
+		with os.fdopen(fd, "wb") as f:
+			f.write(data)
+		os.chmod(temporary_path, 0o666 & ~UMASK)
+		os.replace(temporary_path, path)
+	except:
+		os.remove(temporary_path)
+		raise
+
+class ConversionCache(object):
+	def __init__(self, folder=DEFAULT_CACHE_FOLDER, max_size=DEFAULT_CACHE_MAX_SIZE):
+		self.folder = folder
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+		self.total_size = None # Only scan the folder when it might be over the limit
+
+	def path_for_key(self, key, extension=".json"):
+		return os.path.join(self.folder, key[0:2], key + extension)
+
+	def get(self, key):
+		path = self.path_for_key(key)
+		try:
+			with open(path) as f:
+				entry = json.load(f)
+			os.utime(path) # Mark it as recently used
+		except (OSError, ValueError):
+			self.misses += 1
+			return None
+		self.hits += 1
+		return entry
+
+	def put(self, key, entry):
+		self.put_bytes(key, json.dumps(entry).encode())
+
+	def put_bytes(self, key, data, extension=".json"):
+		path = self.path_for_key(key, extension)
+		write_file_atomically(path, data)
+
+		if self.total_size == None:
+			self.evict()
+		else:
+			self.total_size += os.path.getsize(path)
+			if self.total_size > self.max_size:
+				self.evict()
+
+	# Remove the least recently used entries until the cache fits in max_size
+	def evict(self):
+		entries = []
+		for root, dirs, files in os.walk(self.folder):
+			for name in files:
+				if not name.endswith(CACHE_FILE_EXTENSIONS):
+					continue
+				path = os.path.join(root, name)
+				try:
+					stat = os.stat(path)
+				except OSError: # Another process may have removed it already
+					continue
+				entries.append((stat.st_mtime, stat.st_size, path))
+
+		total_size = sum(_[1] for _ in entries)
+		for mtime, size, path in sorted(entries):
+			if total_size <= self.max_size:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+			total_size -= size
+		self.total_size = total_size
@@ -21,8 +21,14 @@
 # SOFTWARE.
 
 # https://github.com/tildearrow/furnace/blob/master/papers/format.md
-import zlib, io, struct, math, argparse, sys, os, glob, json
-from compress_mml import compress_mml
+import zlib, io, struct, math, argparse, sys, os, glob, json, re, threading, hashlib, mmap, time
+import concurrent.futures
+from compress_mml import compress_channel, merge_compressed_channels, CompressionMemo, start_compression_report, stop_compression_report, report_song_compression
+from brr_encoder import pcm_from_bytes, encode_samples, unoptimized_size, trim_brr, print_sample_savings
+from pitch_table import transpose_frequency, optimize_pitch_table, print_pitch_table_report
+from aram_estimate import estimate_project_aram, check_aram_estimate, print_aram_estimate
+from conversion_cache import ConversionCache, DEFAULT_CACHE_FOLDER, DEFAULT_CACHE_MAX_SIZE, write_file_atomically
+from profiling import profile, profile_context, profiled_map, start_profiling, stop_profiling, track_memory, start_memory_tracking, stop_memory_tracking
 from enum import IntEnum
 CHANNELS = 8
 
@@ -87,34 +93,27 @@ def bytes_to_float(b):
 	return struct.unpack('f', b)[0]
 
 possible_timer_milliseconds = [(_, _*0.125) for _ in range(64, 256+1)]
-cached_timer_and_multiplier = {}
-def find_timer_and_multiplier_for_tempo_and_speed(ticks_per_second, ticks_per_row):
-	if (ticks_per_second, ticks_per_row) in cached_timer_and_multiplier:
-		return cached_timer_and_multiplier[(ticks_per_second, ticks_per_row)]
-	milliseconds_per_tempo_tick = 1 / ticks_per_second * 1000
-	actual_row_milliseconds = milliseconds_per_tempo_tick * ticks_per_row # Actual duration of each row
-
-	if auto_timer_mode == "lowest_error":
-		options = sorted(timer_and_multiplier_search(actual_row_milliseconds))
-		best_timer = options[0][1]
-		best_multiply = options[0][2]
-
-	else: # low_error
-		best_timer     = None
-		best_multiply  = None
-		lowest_error   = None
-
-		for timer_value, timer_ms in possible_timer_milliseconds:
-			fractional_part, integer_part = math.modf(actual_row_milliseconds / timer_ms)
-			milliseconds_with_this_timer_option = timer_ms * integer_part
-			error = abs(actual_row_milliseconds - milliseconds_with_this_timer_option)
-			if lowest_error == None or lowest_error > error:
-				lowest_error  = error
-				best_timer    = timer_value
-				best_multiply = int(integer_part)
 
-	cached_timer_and_multiplier[(ticks_per_second, ticks_per_row)] = (best_timer, best_multiply)
-	return (best_timer, best_multiply)
+# "balanced" timer mode: the driver's work is TAD ticks per second, multiplied by one plus the average number of channels running
+# a per-tick effect. The weight is how many milliseconds of row duration error are worth accepting to save 100 of those a second.
+# The slowest and fastest timers are about 94 ticks a second apart, and timers are only picked from ones within 2 ms of the right
+# row duration. So with the default of 0.25, a song with no effects running only trades about 0.25 ms of error for the slowest timer,
+# and it takes about 7 busy channels before the load can outweigh the whole 2 ms window.
+DEFAULT_BALANCED_TIMER_WEIGHT = 0.25
+PER_TICK_EFFECTS = {0x00, 0x01, 0x02, 0x03, 0x04, 0x0A, 0x83, 0xE1, 0xE2, 0xF3, 0xF4, 0xFA} # Arpeggio, slides, portamento, vibrato
+EFFECTS_STOPPED_BY_NOTES = {0x03, 0xE1, 0xE2}
+
+def tad_timer_load(timer_value, busy_channels):
+	return 1000 / (timer_value * 0.125) * (1 + busy_channels)
+
+def balanced_timer_cost(error, timer_value, busy_channels, weight):
+	return error + weight * tad_timer_load(timer_value, busy_channels) / 100
+
+# Goes to stderr, because the MML goes to stdout when there's no --project-folder
+def report_balanced_timer_choice(what, busy_channels, chosen, lowest_error):
+	# chosen and lowest_error are (error, timer value)
+	print("Balanced timer for %s with %.2f busy channels: T%d (%.3f ms error, %.0f load) instead of T%d (%.3f ms error, %.0f load)" % (what, busy_channels,
+		chosen[1], chosen[0], tad_timer_load(chosen[1], busy_channels), lowest_error[1], lowest_error[0], tad_timer_load(lowest_error[1], busy_channels)), file=sys.stderr)
 
 def timer_and_multiplier_search(actual_row_milliseconds, maximum_error=2):
 	low_error_options = set() # Indexed by multiplier
@@ -126,43 +125,164 @@ def timer_and_multiplier_search(actual_row_milliseconds, maximum_error=2):
 				low_error_options.add((error, timer_option[0], multiply))
 	return low_error_options
 
-cached_timer_and_multipliers_for_speed_pattern = {}
-def find_timer_and_multipliers_for_speed_pattern(ticks_per_second, speed_pattern):
-	cached = cached_timer_and_multipliers_for_speed_pattern.get((ticks_per_second, tuple(speed_pattern)))
-	if cached != None:
-		return cached
-	maximum_error = 2
-	speeds_used = set(speed_pattern)
-	milliseconds_per_tempo_tick = 1 / ticks_per_second * 1000
+# Picks TAD timer values for Furnace tempos and speeds, and remembers the results.
+# Results only depend on the timer mode and overrides, so one of these is shared by every conversion using the same settings.
+class TimerChooser(object):
+	def __init__(self, auto_timer_mode="low_error", timer_override=None, balanced_timer_weight=DEFAULT_BALANCED_TIMER_WEIGHT):
+		self.auto_timer_mode = (auto_timer_mode or "low_error").lower()
+		self.balanced_timer_weight = balanced_timer_weight
+		if self.auto_timer_mode not in ("low_error", "lowest_error", "balanced"):
+			raise ValueError("Invalid --auto-timer-mode setting: %s" % self.auto_timer_mode)
+		self.cached_timer_and_multiplier = {}
+		self.cached_timer_and_multipliers_for_speed_pattern = {}
+
+		for timer_override_string in timer_override or []:
+			timer_override_split = timer_override_string.split("=")
+			assert len(timer_override_split) == 2
+			timer_override_split_input  = timer_override_split[0].split(",")
+			timer_override_split_output = timer_override_split[1].split(",")
+			furnace_tempo = int(timer_override_split_input[0])
+			furnace_speed = int(timer_override_split_input[1])
+			if "." in timer_override_split_output[0]:
+				tad_rate = int(round(float(timer_override_split_output[0]) / 0.125))
+			else:
+				tad_rate = int(timer_override_split_output[0])
+			if tad_rate < 64 or tad_rate > 256:
+				raise ValueError("Invalid TAD timer rate in --timer-override: %s" % timer_override_string)
+			tad_ticks = int(timer_override_split_output[1])
+
+			self.cached_timer_and_multiplier[(furnace_tempo/2.5, furnace_speed)] = (tad_rate, tad_ticks)
+
+	def find_timer_and_multiplier_for_tempo_and_speed(self, ticks_per_second, ticks_per_row, busy_channels=0):
+		cache_key = (ticks_per_second, ticks_per_row)
+		if cache_key in self.cached_timer_and_multiplier: # Also where --timer-override values go, so check it first for every mode
+			return self.cached_timer_and_multiplier[cache_key]
+		if self.auto_timer_mode == "balanced":
+			cache_key = (ticks_per_second, ticks_per_row, busy_channels)
+			if cache_key in self.cached_timer_and_multiplier:
+				return self.cached_timer_and_multiplier[cache_key]
+		milliseconds_per_tempo_tick = 1 / ticks_per_second * 1000
+		actual_row_milliseconds = milliseconds_per_tempo_tick * ticks_per_row # Actual duration of each row
+
+		if self.auto_timer_mode == "balanced":
+			options = sorted(timer_and_multiplier_search(actual_row_milliseconds))
+			best = min(options, key=lambda _:balanced_timer_cost(_[0], _[1], busy_channels, self.balanced_timer_weight))
+			best_timer = best[1]
+			best_multiply = best[2]
+			report_balanced_timer_choice("%g BPM speed %d" % (ticks_per_second * 2.5, ticks_per_row), busy_channels, best, options[0])
+
+		elif self.auto_timer_mode == "lowest_error":
+			options = sorted(timer_and_multiplier_search(actual_row_milliseconds))
+			best_timer = options[0][1]
+			best_multiply = options[0][2]
+
+		else: # low_error
+			best_timer     = None
+			best_multiply  = None
+			lowest_error   = None
+
+			for timer_value, timer_ms in possible_timer_milliseconds:
+				fractional_part, integer_part = math.modf(actual_row_milliseconds / timer_ms)
+				milliseconds_with_this_timer_option = timer_ms * integer_part
+				error = abs(actual_row_milliseconds - milliseconds_with_this_timer_option)
+				if lowest_error == None or lowest_error > error:
+					lowest_error  = error
+					best_timer    = timer_value
+					best_multiply = int(integer_part)
+
+		self.cached_timer_and_multiplier[cache_key] = (best_timer, best_multiply)
+		return (best_timer, best_multiply)
+
+	def find_timer_and_multipliers_for_speed_pattern(self, ticks_per_second, speed_pattern, busy_channels=0):
+		cache_key = (ticks_per_second, tuple(speed_pattern))
+		if self.auto_timer_mode == "balanced":
+			cache_key += (busy_channels,)
+		cached = self.cached_timer_and_multipliers_for_speed_pattern.get(cache_key)
+		if cached != None:
+			return cached
+		maximum_error = 2
+		speeds_used = set(speed_pattern)
+		milliseconds_per_tempo_tick = 1 / ticks_per_second * 1000
 
-	while True:
-		options_for_speeds = []
-		for ticks_per_row in speeds_used:
-			actual_row_milliseconds = milliseconds_per_tempo_tick * ticks_per_row
-			options_for_speeds.append(timer_and_multiplier_search(actual_row_milliseconds, maximum_error=maximum_error))
-
-		# Which timer values are available to all speed settings?
-		available_timer_values = set.intersection(*[ {_[1] for _ in speed} for speed in options_for_speeds ])
-		if len(available_timer_values) == 0:
-			if maximum_error == 5:
-				return None
-			maximum_error = 5
-			continue
+		while True:
+			options_for_speeds = []
+			for ticks_per_row in speeds_used:
+				actual_row_milliseconds = milliseconds_per_tempo_tick * ticks_per_row
+				options_for_speeds.append(timer_and_multiplier_search(actual_row_milliseconds, maximum_error=maximum_error))
+
+			# Which timer values are available to all speed settings?
+			available_timer_values = set.intersection(*[ {_[1] for _ in speed} for speed in options_for_speeds ])
+			if len(available_timer_values) == 0:
+				if maximum_error == 5:
+					return None
+				maximum_error = 5
+				continue
 
-		# Decide on which timer value to use
-		best_timer_value = None
-		best_error = None
-		options_for_speeds = [{_[1]:_ for _ in speed} for speed in options_for_speeds]
-		for timer_value in sorted(available_timer_values):
-			total_error = sum([_[timer_value][0] for _ in options_for_speeds])
-			if best_error == None or best_error > total_error:
-				best_error = total_error
-				best_timer_value = timer_value
-
-		multiplier_for_speed_value = {_[0]:_[1][best_timer_value][2] for _ in zip(speeds_used, options_for_speeds)}
-		out = [multiplier_for_speed_value[_] for _ in speed_pattern]
-		cached_timer_and_multipliers_for_speed_pattern[(ticks_per_second, tuple(speed_pattern))] = (best_timer_value, out)
-		return (best_timer_value, out)
+			# Decide on which timer value to use
+			best_timer_value = None
+			best_error = None
+			options_for_speeds = [{_[1]:_ for _ in speed} for speed in options_for_speeds]
+			for timer_value in sorted(available_timer_values):
+				total_error = sum([_[timer_value][0] for _ in options_for_speeds])
+				if best_error == None or best_error > total_error:
+					best_error = total_error
+					best_timer_value = timer_value
+
+			if self.auto_timer_mode == "balanced":
+				lowest_error = (best_error, best_timer_value)
+				for timer_value in sorted(available_timer_values):
+					total_error = sum([_[timer_value][0] for _ in options_for_speeds])
+					if balanced_timer_cost(total_error, timer_value, busy_channels, self.balanced_timer_weight) < balanced_timer_cost(best_error, best_timer_value, busy_channels, self.balanced_timer_weight):
+						best_error = total_error
+						best_timer_value = timer_value
+				report_balanced_timer_choice("%g BPM speed pattern %s" % (ticks_per_second * 2.5, " ".join(str(_) for _ in speed_pattern)), busy_channels, (best_error, best_timer_value), lowest_error)
+
+			multiplier_for_speed_value = {_[0]:_[1][best_timer_value][2] for _ in zip(speeds_used, options_for_speeds)}
+			out = [multiplier_for_speed_value[_] for _ in speed_pattern]
+			self.cached_timer_and_multipliers_for_speed_pattern[cache_key] = (best_timer_value, out)
+			return (best_timer_value, out)
+
+timer_choosers = {}
+timer_choosers_lock = threading.Lock()
+def get_timer_chooser(options):
+	key = ((options.auto_timer_mode or "low_error").lower(), tuple(options.timer_override or ()), options.balanced_timer_weight)
+	with timer_choosers_lock:
+		if key not in timer_choosers:
+			timer_choosers[key] = TimerChooser(options.auto_timer_mode, options.timer_override, options.balanced_timer_weight)
+		return timer_choosers[key]
+
+# -------------------------------------------------------------------
+# Conversion options
+
+# Same names and defaults as the command line arguments
+class ConversionOptions(object):
+	def __init__(self, **kwargs):
+		self.auto_timer_mode = "low_error"
+		self.timer_override = []
+		self.balanced_timer_weight = DEFAULT_BALANCED_TIMER_WEIGHT # Milliseconds of row duration error worth 100 fewer driver ticks a second
+		self.ignore_arp_macro = False
+		self.ignore_volume_macro = False
+		self.disable_loop_compression = False
+		self.disable_sub_compression = False
+		self.remove_instrument_names = False
+		self.keep_all_instruments = False
+		self.default_instrument_first_octave = 1
+		self.default_instrument_last_octave = 6
+		self.encode_brr = False # it2tad: encode the WAV files into BRR files instead of using ones made by hand
+		self.optimize_samples = False # Trim samples and line their loops up with BRR blocks, to save audio RAM
+		self.allocate_voices = True # it2tad: fit notes from more than 8 channels into the 8 voices
+		self.voice_stealing = False # it2tad: let notes on channels further left take voices from notes further right
+		self.optimize_pitch_table = None # How many cents instruments can be retuned by to share pitch table entries, or None to leave them alone
+		self.jobs = 1
+		self.project_name_prefix = "" # Added to instrument and sample names in the project file
+		for k, v in kwargs.items():
+			if not hasattr(self, k):
+				raise TypeError("Unknown conversion option: %s" % k)
+			setattr(self, k, v)
+
+	@staticmethod
+	def from_args(args):
+		return ConversionOptions(**{k:getattr(args, k) for k in vars(ConversionOptions()) if getattr(args, k, None) != None})
 
 def furnace_ticks_to_tad_ticks(furnace_ticks, furnace_ticks_per_second, tad_timer):
 	milliseconds_per_tempo_tick = 1 / furnace_ticks_per_second * 1000
@@ -325,17 +445,21 @@ def FurnaceSampleBlock(furnace_file, name, data, s):
 	sample.loop_start         = bytes_to_int(s.read(4), signed=True)
 	sample.loop_end           = bytes_to_int(s.read(4), signed=True)
 	s.read(16) # "sample presence bitfields"
-	sample.data               = s.read(sample.length)
 	sample.is_brr = sample.depth == 9
+	sample.pcm = None # 16-bit samples to encode into BRR later, if the sample is PCM
+
+	if sample.is_brr:
+		sample.data = s.read(sample.length)
+	elif sample.depth in (8, 16):
+		pcm = pcm_from_bytes(s.read(sample.length * sample.depth // 8), sample.depth)
+		if sample.loop_start != -1 and sample.loop_end > sample.loop_start:
+			pcm = pcm[:sample.loop_end] # Nothing after the loop gets played
+		sample.pcm = pcm
+	else:
+		print("Sample %s is not in BRR or 8/16-bit PCM format" % sample.name)
 
-	if not sample.is_brr:
-		print("Sample %s is not in BRR format" % sample.name)
-
-instrument_counter = 0
 @block_handler("INS2")
 def FurnaceInstrumentBlock(furnace_file, name, data, s):
-	global instrument_counter
-
 	format_version = bytes_to_int(s.read(2))
 	instrument_type = bytes_to_int(s.read(2))
 	assert instrument_type == 29 # SNES
@@ -371,9 +495,9 @@ def FurnaceInstrumentBlock(furnace_file, name, data, s):
 
 			# Clean up the instrument name
 			instrument.name = make_alphanumeric(instrument_name.strip())
-			if args.remove_instrument_names:
-				instrument.name = "instrument%d" % instrument_counter
-				instrument_counter += 1
+			if furnace_file.options.remove_instrument_names:
+				instrument.name = "instrument%d" % furnace_file.instrument_counter
+				furnace_file.instrument_counter += 1
 		elif feature == b'SM':
 			instrument.initial_sample = bytes_to_int(sf.read(2))
 			b = bytes_to_int(sf.read(1)) # flags
@@ -440,10 +564,10 @@ def FurnaceInstrumentBlock(furnace_file, name, data, s):
 					macro_data.append(bytes_to_int(sf.read(word_size), signed=signed))
 
 				if macro_code[0] == 0: #Volume
-					if args.ignore_volume_macro != True:
+					if furnace_file.options.ignore_volume_macro != True:
 						instrument.volume_scale = macro_data[0]/127
 				elif macro_code[0] == 1: # Arpeggio
-					if args.ignore_arp_macro != True:
+					if furnace_file.options.ignore_arp_macro != True:
 						instrument.semitone_offset = macro_data[-1]
 				else:
 					print("Unsupported macro type", macro_code[0])
@@ -455,8 +579,8 @@ def FurnaceInstrumentBlock(furnace_file, name, data, s):
 	for other_instrument in furnace_file.tracker_instruments:
 		if other_instrument is not instrument:
 			if other_instrument.name == instrument.name:
-				instrument.name = "instrument%d" % instrument_counter
-				instrument_counter += 1
+				instrument.name = "instrument%d" % furnace_file.instrument_counter
+				furnace_file.instrument_counter += 1
 				break
 
 	# Create on or more TAD instruments and/or samples
@@ -511,7 +635,8 @@ def FurnaceInstrumentBlock(furnace_file, name, data, s):
 
 @block_handler("PATN")
 def FurnacePatternBlock(furnace_file, name, data, s):
-	song          = furnace_file.songs[bytes_to_int(s.read(1))]
+	song_index    = bytes_to_int(s.read(1))
+	song          = furnace_file.songs[song_index]
 	channel       = bytes_to_int(s.read(1))
 	pattern_index = bytes_to_int(s.read(2))
 	pattern_name  = read_string(s)
@@ -565,28 +690,46 @@ def FurnacePatternBlock(furnace_file, name, data, s):
 
 	song.empty = empty_pattern
 	song.patterns[channel][pattern_index] = pattern
+	furnace_file.pattern_list.append((song_index, channel, pattern_index, empty_pattern, pattern))
 
 # -------------------------------------------------------------------
 
 class TerrificInstrument(object):
 	def __init__(self, tracker_instrument):
 		self.tracker_instrument = tracker_instrument
+		self.use_shortened_name = False
+		self.reset_usage()
+
+	def reset_usage(self):
 		self.lowest_used_note = None             # Furnace note index, with semitone offset applied
 		self.highest_used_note = None            # Furnace note index, with semitone offset applied
 		self.all_used_notes = set()              # All used notes, with semitone offset applied
 		self.is_used = False
-		self.use_shortened_name = False
+
+	def get_usage(self):
+		return (self.is_used, sorted(self.all_used_notes))
+
+	def merge_usage(self, usage):
+		is_used, notes = usage
+		self.is_used = self.is_used or is_used
+		for note in notes:
+			self.record_note_as_used(note)
 
 	@property
 	def name(self):
 		return self.tracker_instrument.name if self.use_shortened_name else (self.tracker_instrument.name + "_" + self.tracker_file.tracker_samples[self.tracker_sample].name)
 
-	def to_dict(self, sample_filenames):
-		d = self.tracker_instrument.to_dict(sample_filenames, sample_num=self.tracker_sample)
+	@property
+	def project_name(self): # Name in the project file, which can be different from the name the MML uses
+		return self.tracker_file.project_name_prefix + self.name
+
+	def to_dict(self, sample_files):
+		d = self.tracker_instrument.to_dict(sample_files, sample_num=self.tracker_sample)
 		if d:
-			d["name"] = self.name
-			first_note = self.lowest_used_note or 12*(5+args.default_instrument_first_octave)
-			last_note  = self.highest_used_note or 12*(5+args.default_instrument_last_octave)+11
+			d["name"] = self.project_name
+			options = self.tracker_file.options
+			first_note = self.lowest_used_note or 12*(5+options.default_instrument_first_octave)
+			last_note  = self.highest_used_note or 12*(5+options.default_instrument_last_octave)+11
 			d["first_octave"] = first_note // 12 - 5
 			d["last_octave"] = last_note // 12 - 5
 		return d
@@ -603,18 +746,41 @@ class TerrificInstrument(object):
 class TerrificSample(object):
 	def __init__(self, tracker_instrument):
 		self.tracker_instrument = tracker_instrument
+		self.use_shortened_name = False
+		self.reset_usage()
+
+	def reset_usage(self):
 		self.note_list = []  # All used notes, with semitone offset applied
 		self.is_used = False
-		self.use_shortened_name = False
+
+	def get_usage(self):
+		return (self.is_used, list(self.note_list))
+
+	def merge_usage(self, usage):
+		is_used, notes = usage
+		self.is_used = self.is_used or is_used
+		for note in notes: # Keep the order the notes were first used in, because the MML refers to them by index
+			self.record_note_as_used(note)
+
+	def note_name(self, note, arpeggio=False):
+		note_index = self.note_list.index(note)
+		if arpeggio:
+			return note_name_from_index(note_index + 12*5, 0)
+		else:
+			return "s%d," % note_index
 
 	@property
 	def name(self):
 		return self.tracker_instrument.name if self.use_shortened_name else (self.tracker_instrument.name + "_" + self.tracker_file.tracker_samples[self.tracker_sample].name)
 
-	def to_dict(self, sample_filenames):
-		d = self.tracker_instrument.to_dict(sample_filenames, sample_num=self.tracker_sample)
+	@property
+	def project_name(self): # Name in the project file, which can be different from the name the MML uses
+		return self.tracker_file.project_name_prefix + self.name
+
+	def to_dict(self, sample_files):
+		d = self.tracker_instrument.to_dict(sample_files, sample_num=self.tracker_sample)
 		if d:
-			d["name"] = self.name
+			d["name"] = self.project_name
 
 			sample = self.tracker_file.tracker_samples[self.tracker_sample]
 			sample_rates = []
@@ -653,12 +819,10 @@ class TrackerInstrument(object):
 
 		if isinstance(instrument_or_sample, TerrificInstrument):
 			return note_name_from_index(note, self.semitone_offset)
+		elif instrument_or_sample.tracker_file.defer_sample_note_names: # The final note list isn't known yet, so leave a placeholder for resolve_sample_note_names()
+			return "\0%d,%d,%d\0" % (instrument_or_sample.tracker_file.tad_samples.index(instrument_or_sample), note + self.semitone_offset, arpeggio)
 		else:
-			note_index = instrument_or_sample.note_list.index(note + self.semitone_offset)
-			if arpeggio:
-				return note_name_from_index(note_index + 12*5)
-			else:
-				return "s%d," % note_index
+			return instrument_or_sample.note_name(note + self.semitone_offset, arpeggio)
 
 	def tad_instrument_or_sample_for_note(self, note):
 		if note < NoteValue.FIRST or note > NoteValue.LAST:
@@ -686,15 +850,15 @@ class TrackerInstrument(object):
 			return None
 		return ref.name
 
-	def get_all_tad_instrument_names(self):
+	def get_all_tad_instruments(self):
 		if self.tad_sample_for_note:
-			return set(_.name for _ in self.tad_sample_for_note.values() if _ != None)# and _.is_used)
+			return list({_.name:_ for _ in self.tad_sample_for_note.values() if _ != None}.values()) # One per name, in the same order every run
 		elif self.tad_instrument_for_note:
-			return set(_.name for _ in self.tad_instrument_for_note.values() if _ != None)# and _.is_used)
+			return list({_.name:_ for _ in self.tad_instrument_for_note.values() if _ != None}.values())
 		elif self.tad_sample:
-			return (self.tad_sample.name,)
+			return (self.tad_sample,)
 		else:
-			return (self.tad_instrument.name,)
+			return (self.tad_instrument,)
 
 class FurnaceInstrument(TrackerInstrument):
 	def __init__(self):
@@ -706,64 +870,56 @@ class FurnaceInstrument(TrackerInstrument):
 		self.gain_mode = None
 		self.gain = None
 
-	def to_dict(self, sample_filenames, sample_num=None):
+	# sample_files is from index_sample_files()
+	def to_dict(self, sample_files, sample_num=None):
 		sample_num = self.initial_sample if sample_num == None else sample_num
-		look_for = "%.2d - " % sample_num
 		sample = self.furnace_file.tracker_samples[sample_num]
+		filename = sample_files.get("%.2d" % find_duplicate_samples(self.furnace_file).get(sample_num, sample_num)) # Samples with the same data share a file
+		if filename == None:
+			return None
+		brr_basename = os.path.basename(filename)
+
+		c5_freq = 261.626
+		wavelength = sample.c4_rate / c5_freq
+		tuning_freq = 32000 / wavelength
 
-		for filename in sample_filenames:
-			brr_basename = os.path.basename(filename)
-			if brr_basename.startswith(look_for):
-				c5_freq = 261.626
-				wavelength = sample.c4_rate / c5_freq
-				tuning_freq = 32000 / wavelength
-
-				instrument_entry = {
-					"source": brr_basename,
-					"freq": tuning_freq,
-					"loop": "override_brr_loop_point" if sample.loop_start != -1 else "none",
-					"envelope": "gain F127",
-				}
-
-				if self.envelope_on:
-					instrument_entry["envelope"] = "adsr %d %d %d %d" % (self.attack, self.decay, self.sustain, self.release)
+		instrument_entry = {
+			"source": brr_basename,
+			"freq": tuning_freq,
+			"loop": "override_brr_loop_point" if sample.loop_start != -1 else "none",
+			"envelope": "gain F127",
+		}
+
+		if self.envelope_on:
+			instrument_entry["envelope"] = "adsr %d %d %d %d" % (self.attack, self.decay, self.sustain, self.release)
+		else:
+			if self.gain_mode != None:
+				if self.gain_mode == 0: # Direct
+					instrument_entry["envelope"] = "gain F%d" % self.gain
+				elif self.gain_mode == 4: # Decreasing
+					instrument_entry["envelope"] = "gain D%d" % self.gain
+				elif self.gain_mode == 5: # Exponential decrease
+					instrument_entry["envelope"] = "gain E%d" % self.gain
+				elif self.gain_mode == 6: # Increasing
+					instrument_entry["envelope"] = "gain I%d" % self.gain
+				elif self.gain_mode == 7: # Bent
+					instrument_entry["envelope"] = "gain B%d" % self.gain
 				else:
-					if self.gain_mode != None:
-						if self.gain_mode == 0: # Direct
-							instrument_entry["envelope"] = "gain F%d" % self.gain
-						elif self.gain_mode == 4: # Decreasing
-							instrument_entry["envelope"] = "gain D%d" % self.gain
-						elif self.gain_mode == 5: # Exponential decrease
-							instrument_entry["envelope"] = "gain E%d" % self.gain
-						elif self.gain_mode == 6: # Increasing
-							instrument_entry["envelope"] = "gain I%d" % self.gain
-						elif self.gain_mode == 7: # Bent
-							instrument_entry["envelope"] = "gain B%d" % self.gain
-						else:
-							instrument_entry["envelope"] = "gain F127"
-					else:
-						instrument_entry["envelope"] = "gain F127"
+					instrument_entry["envelope"] = "gain F127"
+			else:
+				instrument_entry["envelope"] = "gain F127"
 
-				if sample.loop_start != -1:
-					instrument_entry["loop_setting"] = sample.loop_start
-				return instrument_entry
-		return None
+		if sample.loop_start != -1:
+			instrument_entry["loop_setting"] = sample.loop_start
+		return instrument_entry
 
 class TrackerSample(object):
 	def __init__(self):
 		pass
 
 	def frequency_for_note(self, note):
-		c4_rate = self.c4_rate
 		c4_note = (12*5) + 12*4
-		note_difference = note - c4_note
-		twelfth_root_of_2 = 2 ** (1/12)
-
-		if note_difference == 0:
-			return c4_rate
-		elif note_difference > 0:
-			return c4_rate * (twelfth_root_of_2 ** note_difference)
-		return c4_rate / (twelfth_root_of_2 ** (-note_difference))
+		return transpose_frequency(self.c4_rate, note - c4_note)
 
 class FurnaceSample(TrackerSample):
 	def __init__(self):
@@ -1214,16 +1370,54 @@ class TrackerSong(object):
 		self.instruments_used = set()
 		self.patterns = [{} for _ in range(CHANNELS)] # self.patterns[channel][pattern_id]
 		self.empty_patterns = set()                   # each entry is (channel, pattern_id)
-
-	def convert_to_tad(self, impulse_tracker = False):
+		self.first_order = 0                          # where the song starts in the file's order list, which 0x0B effects count from
+
+	# Average number of channels that have an effect running every tick, over every row in the order list
+	def count_busy_channels(self, impulse_tracker = False):
+		busy_channel_rows = 0
+		total_rows = 0
+		active_effects = [set() for _ in range(CHANNELS)]
+		for order_index in range(self.orders_length):
+			channel_patterns = [self.patterns[channel][self.orders[channel][order_index]] for channel in range(CHANNELS)]
+			for row_index in range(len(channel_patterns[0].rows)): # Assume all channels' patterns are the same size as the first one
+				for channel in range(CHANNELS):
+					note = channel_patterns[channel].rows[row_index]
+					if impulse_tracker: # Impulse Tracker effects only last for the row they're on
+						active_effects[channel] = set()
+					elif note.note != None:
+						active_effects[channel] -= EFFECTS_STOPPED_BY_NOTES
+					for effect_type, effect_value in note.effects:
+						if effect_type in PER_TICK_EFFECTS:
+							if effect_value:
+								active_effects[channel].add(effect_type)
+							else:
+								active_effects[channel].discard(effect_type)
+					if active_effects[channel]:
+						busy_channel_rows += 1
+				total_rows += 1
+		return round(busy_channel_rows / total_rows, 2) if total_rows else 0
+
+	# Convert to one uncompressed list of MML tokens per channel, plus the text that goes before the channels
+	def convert_to_mml_sequences(self, impulse_tracker = False):
+		with profile_context(song=getattr(self, "name", None)):
+			with profile("flatten", "flatten"), track_memory("flatten"):
+				timeline = self.flatten_orders(impulse_tracker)
+			return self.convert_timeline_to_mml_sequences(timeline)
+
+	# Follow the orders and jumps, and put together one long pattern per channel along with the speed of every row.
+	# This changes the notes in the song's patterns, so it can only happen once per parsed file.
+	# Returns (combined patterns, speed at each row, loop point, TAD timer value at the end)
+	def flatten_orders(self, impulse_tracker = False):
 		groove_mode = len(self.speed_pattern) > 1
 		multiple_groove_patterns = self.furnace_file.groove_patterns != []
+		timer_chooser = self.furnace_file.timer_chooser
+		busy_channels = self.count_busy_channels(impulse_tracker) if timer_chooser.auto_timer_mode == "balanced" else 0
 
 		# Convert the speed/tempo to TAD ticks
 		if groove_mode:
-			tad_timer_value, tad_ticks_per_row = find_timer_and_multipliers_for_speed_pattern(self.ticks_per_second, self.speed_pattern)
+			tad_timer_value, tad_ticks_per_row = timer_chooser.find_timer_and_multipliers_for_speed_pattern(self.ticks_per_second, self.speed_pattern, busy_channels)
 		else:
-			tad_timer_value, tad_ticks_per_row = find_timer_and_multiplier_for_tempo_and_speed(self.ticks_per_second, self.speed1)
+			tad_timer_value, tad_ticks_per_row = timer_chooser.find_timer_and_multiplier_for_tempo_and_speed(self.ticks_per_second, self.speed1, busy_channels)
 			tad_ticks_per_row = [tad_ticks_per_row]
 		self.tad_timer_value_at_start = tad_timer_value
 
@@ -1275,12 +1469,13 @@ class TrackerSong(object):
 						next_row_index = effect_value
 						new_order = True
 					elif effect_type == 0x0B: # Jump to order row
-						if effect_value > order_index: # Skip forward
-							order_index = effect_value
+						jump_order = max(0, effect_value - self.first_order)
+						if jump_order > order_index: # Skip forward
+							order_index = jump_order
 							next_row_index = 0
 							new_order = True
 						else: # If jumping backwards, set loop point
-							loop_point = combined_pattern_offset_for_order_row[effect_value]
+							loop_point = combined_pattern_offset_for_order_row[jump_order]
 							stop_order_processing = True
 					elif effect_type == 0xFF: # Don't loop
 						loop_point = None
@@ -1339,9 +1534,9 @@ class TrackerSong(object):
 
 			if need_to_remake_tad_ticks_per_row:
 				if groove_mode:
-					tad_timer_value, tad_ticks_per_row = find_timer_and_multipliers_for_speed_pattern(self.ticks_per_second, current_speed_pattern)
+					tad_timer_value, tad_ticks_per_row = timer_chooser.find_timer_and_multipliers_for_speed_pattern(self.ticks_per_second, current_speed_pattern, busy_channels)
 				else:
-					tad_timer_value, tad_ticks_per_row = find_timer_and_multiplier_for_tempo_and_speed(self.ticks_per_second, current_speed_pattern[0])
+					tad_timer_value, tad_ticks_per_row = timer_chooser.find_timer_and_multiplier_for_tempo_and_speed(self.ticks_per_second, current_speed_pattern[0], busy_channels)
 					tad_ticks_per_row = [tad_ticks_per_row]
 				need_to_remake_tad_ticks_per_row = False
 			speed_at_each_row.append( (current_ticks_per_second, current_speed_pattern[speed_pattern_index % len(current_speed_pattern)], tad_timer_value, tad_ticks_per_row[speed_pattern_index % len(tad_ticks_per_row)]) )
@@ -1363,7 +1558,11 @@ class TrackerSong(object):
 					for effect_type in EFFECTS_WITH_IT_AUTO_CANCEL.union( set((0x80,)) ):
 						if effect_type in effects_used_by_channel[channel] and effect_type not in effect_types_at_loop_point:
 							combined_patterns[channel].rows[loop_point].effects.append(IT_EFFECT_CANCEL_OVERRIDE.get(effect_type, (effect_type, 0)) )
+		return combined_patterns, speed_at_each_row, loop_point, tad_timer_value
 
+	# Takes the result of flatten_orders()
+	def convert_timeline_to_mml_sequences(self, timeline):
+		combined_patterns, speed_at_each_row, loop_point, tad_timer_value = timeline
 		out = ""
 		if hasattr(self, 'name') and self.name:
 			out += "#Title %s\n" % self.name
@@ -1375,18 +1574,32 @@ class TrackerSong(object):
 		# Define the instruments
 		out += "; Instrument definitions\n"
 		for instrument_index in self.instruments_used:
-			for name in self.furnace_file.tracker_instruments[instrument_index].get_all_tad_instrument_names():
-				out += "@%s %s\n" % (name, name)
+			for tad_instrument in self.furnace_file.tracker_instruments[instrument_index].get_all_tad_instruments():
+				out += "@%s %s\n" % (tad_instrument.name, tad_instrument.project_name)
 		out += "\n"
 
 		# Now we have one long pattern for each channel
-		mml_sequences = {"ABCDEFGH"[channel]:pattern.convert_to_tad(self, speed_at_each_row, loop_point) for channel,pattern in enumerate(combined_patterns)}
-		for k in "ABCDEFGH":
-			compress_mml(k, mml_sequences, not args.disable_loop_compression, not args.disable_sub_compression)
-		for k,v in mml_sequences.items():
-			if any(not _.startswith("w%") and _ != "L" for _ in v): # Sequence must not consist entirely of waits
-				out += k + " " + " ".join([_ for _ in v if _]).replace("%0 r%", "%") + "\n"
-		return out
+		mml_sequences = {}
+		with track_memory("patterns"):
+			for channel, pattern in enumerate(combined_patterns):
+				channel_name = "ABCDEFGH"[channel]
+				with profile("patterns %s" % channel_name, "patterns", channel=channel_name) as span:
+					mml_sequences[channel_name] = pattern.convert_to_tad(self, speed_at_each_row, loop_point)
+					span.args["tokens"] = len(mml_sequences[channel_name])
+		return out, mml_sequences
+
+	# Returns the MML, or writes it to output instead if that's an open text stream
+	def convert_to_tad(self, impulse_tracker = False, jobs = 1, output = None):
+		header, mml_sequences = self.convert_to_mml_sequences(impulse_tracker)
+		if jobs > 1:
+			with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+				mml_sequences, _ = merge_compressed_channels(compress_song_sequences(mml_sequences, self.furnace_file.options, pool.map))
+		else:
+			mml_sequences, _ = merge_compressed_channels(compress_song_sequences(mml_sequences, self.furnace_file.options))
+		if output != None:
+			write_mml(output, header, mml_sequences)
+			return None
+		return render_mml(header, mml_sequences)
 
 class FurnaceSong(TrackerSong):
 	def __init__(self, furnace_file, stream):
@@ -1423,13 +1636,12 @@ class FurnaceSong(TrackerSong):
 			self.short_channel_names.append(read_string(stream))
 
 class FurnaceFile(object):
-	def __init__(self, filename):
-		# Storage for things defined in the file
-		self.songs = []
-		self.tracker_instruments = []
-		self.tracker_samples = []
-		self.tad_instruments = []
-		self.tad_samples = []
+	def __init__(self, filename, options=None, cache=None):
+		self.options = options or ConversionOptions()
+		self.timer_chooser = get_timer_chooser(self.options)
+		self.defer_sample_note_names = False
+		self.project_name_prefix = self.options.project_name_prefix
+		self.reset_parsed_state()
 
 		# Open the file
 		f = open(filename, "rb")
@@ -1437,6 +1649,10 @@ class FurnaceFile(object):
 		f.close()
 		if self.bytes[0] == 0x78: # zlib magic byte
 			self.bytes = zlib.decompress(self.bytes)
+
+		# Parsing the patterns is most of the work, so reuse an earlier parse if there is one
+		if cache and self.load_ir(cache.path_for_key(ir_cache_key(self), ".ir")):
+			return
 		s = io.BytesIO(self.bytes) # Set it up as a stream
 		
 		header = s.read(32)
@@ -1452,17 +1668,660 @@ class FurnaceFile(object):
 			if len(block_name) == 0:
 				break
 			block_size = bytes_to_int(s.read(4))
+			block_offset = s.tell()
 			block_data = s.read(block_size)
+			if block_name != "PATN":
+				self.other_blocks.append((block_name, block_offset, block_size))
 			
 			if block_name in block_handlers:
 				block_handlers[block_name](self, block_name, block_data, io.BytesIO(block_data))
 			else:
 				print("Unrecognized block: ", block_name)
 
+		if cache:
+			cache.put_bytes(ir_cache_key(self), self.ir_bytes(), ".ir")
+
+	# Storage for things defined in the file
+	def reset_parsed_state(self):
+		self.instrument_counter = 0 # For naming instruments that don't have a usable name
+		self.songs = []
+		self.tracker_instruments = []
+		self.tracker_samples = []
+		self.tad_instruments = []
+		self.tad_samples = []
+		self.pattern_list = [] # (song index, channel, pattern index, empty, FurnacePattern) in the order they were in the file
+		self.other_blocks = [] # (name, offset, size) of every block that isn't a pattern
+
+	# The binary IR has every block except the patterns as-is, and the patterns as fixed size records.
+	# Only the patterns are stored already parsed, because the other blocks are quick to parse and depend on the conversion options.
+	def ir_bytes(self):
+		blocks = b"".join(self.bytes[offset:offset+size] for name, offset, size in self.other_blocks)
+		row_records = []
+		effect_records = []
+		pattern_records = []
+		for song_index, channel, pattern_index, empty, pattern in self.pattern_list:
+			first_row = len(row_records)
+			for row_index, note in enumerate(pattern.rows):
+				if note.is_empty(): # Only rows with something in them are stored
+					continue
+				row_records.append(IR_ROW.pack(row_index, IR_NONE_8 if note.note == None else note.note, IR_NONE_16 if note.instrument == None else note.instrument,
+					IR_NONE_16 if note.volume == None else note.volume, len(effect_records), len(note.effects)))
+				for effect_type, effect_value in note.effects:
+					effect_records.append(IR_EFFECT.pack(IR_NONE_16 if effect_type == None else effect_type, effect_value))
+			pattern_records.append(IR_PATTERN.pack(song_index, channel, pattern_index, empty, len(pattern.rows), first_row, len(row_records) - first_row))
+
+		out = io.BytesIO()
+		out.write(IR_HEADER.pack(IR_MAGIC, IR_VERSION, self.format_version, len(self.other_blocks), len(pattern_records), len(row_records), len(effect_records)))
+		offset = 0
+		for name, _, size in self.other_blocks:
+			out.write(IR_BLOCK.pack(name.encode(), offset, size))
+			offset += size
+		out.write(b"".join(pattern_records))
+		out.write(b"".join(row_records))
+		out.write(b"".join(effect_records))
+		out.write(blocks)
+		return out.getvalue()
+
+	# Returns False if there isn't a usable IR file at the path. A cache file that got cut short or damaged is treated
+	# the same as a missing one, so the module just gets parsed again.
+	def load_ir(self, path):
+		try:
+			with open(path, "rb") as f:
+				mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		except (OSError, ValueError): # ValueError if the file is empty
+			return False
+		try:
+			loaded = self.decode_ir(mapped)
+		except (struct.error, IndexError, ValueError):
+			return False
+		finally:
+			mapped.close()
+		if loaded == None:
+			return False
+
+		# Nothing in self has been changed yet, so if the blocks can't be handled the normal parse still starts from scratch
+		format_version, blocks, patterns = loaded
+		self.format_version = format_version
+		try:
+			for name, data in blocks:
+				self.other_blocks.append((name, None, len(data)))
+				if name in block_handlers:
+					block_handlers[name](self, name, data, io.BytesIO(data))
+			for song_index, channel, pattern_index, empty, pattern, instruments in patterns:
+				song = self.songs[song_index]
+				song.instruments_used.update(instruments)
+				song.empty = empty
+				song.patterns[channel][pattern_index] = pattern
+				self.pattern_list.append((song_index, channel, pattern_index, empty, pattern))
+		except Exception: # The blocks are the module's own, but a damaged copy could fail anywhere in the block handlers
+			self.reset_parsed_state()
+			return False
+		return True
+
+	# Reads everything out of an IR file into new objects without changing self, checking that every table and record is
+	# inside the file. Returns (format version, [(block name, data)], [(song index, channel, pattern index, empty, FurnacePattern,
+	# instruments used)]), or None if it isn't an IR file for this version.
+	def decode_ir(self, mapped):
+		if len(mapped) < IR_HEADER.size:
+			return None
+		magic, version, format_version, block_count, pattern_count, row_count, effect_count = IR_HEADER.unpack_from(mapped, 0)
+		if magic != IR_MAGIC or version != IR_VERSION:
+			return None
+
+		# Find where each table starts
+		offset = IR_HEADER.size
+		block_table = offset
+		offset += IR_BLOCK.size * block_count
+		pattern_table = offset
+		offset += IR_PATTERN.size * pattern_count
+		row_table = offset
+		offset += IR_ROW.size * row_count
+		effect_table = offset
+		offset += IR_EFFECT.size * effect_count
+		block_data = offset
+		if block_data > len(mapped):
+			raise ValueError("IR tables go past the end of the file")
+
+		blocks = []
+		for name, block_offset, block_size in IR_BLOCK.iter_unpack(mapped[block_table:pattern_table]):
+			if block_data + block_offset + block_size > len(mapped):
+				raise ValueError("IR block goes past the end of the file")
+			blocks.append((name.decode(), mapped[block_data+block_offset:block_data+block_offset+block_size]))
+
+		effects = [(None if t == IR_NONE_16 else t, v) for t, v in IR_EFFECT.iter_unpack(mapped[effect_table:block_data])]
+		rows = list(IR_ROW.iter_unpack(mapped[row_table:effect_table]))
+		patterns = []
+		for song_index, channel, pattern_index, empty, pattern_length, first_row, pattern_row_count in IR_PATTERN.iter_unpack(mapped[pattern_table:row_table]):
+			if first_row + pattern_row_count > len(rows) or channel >= CHANNELS:
+				raise IndexError("IR pattern points outside the row table")
+			pattern = FurnacePattern()
+			pattern.rows = [FurnaceNote() for _ in range(pattern_length)]
+			instruments = set()
+			for row_index, note_value, instrument, volume, first_effect, note_effect_count in rows[first_row:first_row+pattern_row_count]:
+				if first_effect + note_effect_count > len(effects):
+					raise IndexError("IR row points outside the effect table")
+				note = pattern.rows[row_index]
+				if note_value != IR_NONE_8:
+					note.note = note_value
+				if instrument != IR_NONE_16:
+					note.instrument = instrument
+					instruments.add(instrument)
+				if volume != IR_NONE_16:
+					note.volume = volume
+				note.effects = effects[first_effect:first_effect+note_effect_count]
+			patterns.append((song_index, channel, pattern_index, bool(empty), pattern, instruments))
+		return format_version, blocks, patterns
+
+# Binary IR format; see FurnaceFile.ir_bytes()
+IR_MAGIC = b"F2TIR"
+IR_VERSION = 1
+IR_HEADER  = struct.Struct("<5sHHIIII") # Magic, IR version, Furnace format version, block count, pattern count, row count, effect count
+IR_BLOCK   = struct.Struct("<4sII")     # Name, offset into the block data, size
+IR_PATTERN = struct.Struct("<BBHBHII")  # Song, channel, pattern index, empty, pattern length, first stored row, stored row count
+IR_ROW     = struct.Struct("<HBHHIB")   # Row index, note, instrument, volume, first effect, effect count
+IR_EFFECT  = struct.Struct("<HB")       # Type, value
+IR_NONE_8  = 0xFF
+IR_NONE_16 = 0xFFFF
+
+# -------------------------------------------------------------------
+# Song conversion, optionally spread across multiple processes
+
+# Returns an iterable of compressed channels for merge_compressed_channels(); map_function can be a process pool's map()
+# If memo is a CompressionMemo, only channels it doesn't already have are compressed.
+def compress_song_sequences(mml_sequences, options, map_function=map, memo=None):
+	channels = list(mml_sequences)
+	loop_compression = not options.disable_loop_compression
+	sub_compression = not options.disable_sub_compression
+	if memo == None:
+		return profiled_map(map_function, compress_channel, channels, [mml_sequences[_] for _ in channels], [loop_compression] * len(channels), [sub_compression] * len(channels))
+
+	keys = [memo.key(_, mml_sequences[_], loop_compression, sub_compression) for _ in channels]
+	remembered = [memo.get(_) for _ in keys]
+	missing = [channel for channel, result in zip(channels, remembered) if result == None]
+	compressed = profiled_map(map_function, compress_channel, missing, [mml_sequences[_] for _ in missing], [loop_compression] * len(missing), [sub_compression] * len(missing))
+	def results():
+		for key, result in zip(keys, remembered):
+			if result == None:
+				result = next(compressed)
+				memo.put(key, result)
+			yield result
+	return results()
+
+# A note that's zero ticks long followed by a rest becomes one note that's as long as the rest, like "c%0 r%12" into "c%12".
+# A token that had a rest joined onto it can't have the next one joined onto it too.
+def join_zero_length_notes(tokens):
+	previous = None
+	for token in tokens:
+		if not token:
+			continue
+		if previous != None and previous.endswith("%0") and token.startswith("r%"):
+			yield previous[:-1] + token[2:]
+			previous = None
+			continue
+		if previous != None:
+			yield previous
+		previous = token
+	if previous != None:
+		yield previous
+
+# Writes the song to an open text stream one token at a time, so the whole song never has to be in memory as one string
+def write_mml(stream, header, mml_sequences):
+	stream.write(header)
+	for k,v in mml_sequences.items():
+		if any(not _.startswith("w%") and _ != "L" for _ in v): # Sequence must not consist entirely of waits
+			stream.write(k)
+			for token in join_zero_length_notes(v):
+				stream.write(" ")
+				stream.write(token)
+			stream.write("\n")
+
+def render_mml(header, mml_sequences):
+	out = io.StringIO()
+	write_mml(out, header, mml_sequences)
+	return out.getvalue()
+
+SAMPLE_NOTE_NAME_PLACEHOLDER = re.compile(r"\x00(\d+),(\d+),(\d)\x00")
+def resolve_sample_note_names(tracker_file, mml_sequences):
+	def replace(match):
+		return tracker_file.tad_samples[int(match[1])].note_name(int(match[2]), bool(int(match[3])))
+	for v in mml_sequences.values():
+		for i, token in enumerate(v):
+			if "\0" in token:
+				v[i] = SAMPLE_NOTE_NAME_PLACEHOLDER.sub(replace, token)
+
+def get_usage_snapshot(tracker_file):
+	return [_.get_usage() for _ in tracker_file.tad_instruments], [_.get_usage() for _ in tracker_file.tad_samples]
+
+def restore_usage_snapshot(tracker_file, snapshot):
+	instrument_usage, sample_usage = snapshot
+	for instrument, usage in zip(tracker_file.tad_instruments + tracker_file.tad_samples, instrument_usage + sample_usage):
+		instrument.reset_usage()
+		instrument.merge_usage(usage)
+
+# Options that change the MML or the instrument usage; the rest only affect the project file
+CACHE_KEY_OPTIONS = ("auto_timer_mode", "timer_override", "ignore_arp_macro", "ignore_volume_macro", "disable_loop_compression", "disable_sub_compression", "remove_instrument_names", "project_name_prefix", "allocate_voices", "voice_stealing", "balanced_timer_weight")
+
+# Changes whenever the converter's source code changes, so old cache entries aren't used with a newer converter
+converter_version_stamp = None
+def converter_version():
+	global converter_version_stamp
+	if converter_version_stamp == None:
+		h = hashlib.sha256()
+		for filename in ("fur2tad.py", "compress_mml.py", "it2tad.py"):
+			path = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+			if os.path.exists(path):
+				with open(path, "rb") as f:
+					h.update(f.read())
+		converter_version_stamp = h.hexdigest()
+	return converter_version_stamp
+
+def module_hash(tracker_file):
+	if getattr(tracker_file, "bytes_hash", None) == None:
+		tracker_file.bytes_hash = hashlib.sha256(tracker_file.bytes).hexdigest()
+	return tracker_file.bytes_hash
+
+# A song's MML depends on every song before it in the same file (subroutine numbers, sample note lists), and that's all covered by the file's hash
+def song_cache_key(tracker_file, song_index):
+	options = {_:getattr(tracker_file.options, _) for _ in CACHE_KEY_OPTIONS}
+	h = hashlib.sha256()
+	h.update(json.dumps([converter_version(), module_hash(tracker_file), song_index, options], sort_keys=True).encode())
+	return h.hexdigest()
+
+# The IR doesn't depend on any options
+def ir_cache_key(tracker_file):
+	return hashlib.sha256(json.dumps([converter_version(), module_hash(tracker_file), "ir"]).encode()).hexdigest()
+
+worker_file = None # Only set in worker processes
+def start_conversion_worker(file_class, filename, options, cache):
+	global worker_file
+	worker_file = file_class(filename, options, cache)
+	worker_file.defer_sample_note_names = True
+
+# Instrument usage is kept separately for each song, so the main process can merge it in the same order as a serial conversion
+def convert_song_without_compression(song_index, impulse_tracker):
+	for _ in worker_file.tad_instruments + worker_file.tad_samples:
+		_.reset_usage()
+	header, mml_sequences = worker_file.songs[song_index].convert_to_mml_sequences(impulse_tracker)
+	return header, mml_sequences, get_usage_snapshot(worker_file)
+
+# If a cache is provided, songs found in it are used as-is, and the other songs are added to it.
+# If output is an open text stream, each song is written to it as soon as it's done and None is yielded instead of its MML.
+def convert_songs(tracker_file, filename, jobs=1, impulse_tracker=False, cache=None, compression_memo=None, output=None):
+	song_count = len(tracker_file.songs)
+	cache_keys = [song_cache_key(tracker_file, _) for _ in range(song_count)] if cache else [None] * song_count
+	cached_songs = [cache.get(_) for _ in cache_keys] if cache else [None] * song_count
+	songs_to_convert = [_ for _ in range(song_count) if cached_songs[_] == None]
+	subroutine_count = 0 # Subroutine numbers keep counting up across songs
+
+	def finish_song(song_index, header, compressed_channels, usage):
+		nonlocal subroutine_count
+		with profile_context(song=tracker_file.songs[song_index].name):
+			with track_memory("compress"):
+				mml_sequences, count = merge_compressed_channels(compressed_channels, subroutine_count) # Serial compression happens in here
+			with profile("merge", "merge"), track_memory("merge"):
+				report_song_compression(tracker_file.songs[song_index].name, mml_sequences)
+				subroutine_count += count
+				if output != None and not cache: # The cache needs the MML as a string
+					write_mml(output, header, mml_sequences)
+					return None
+				mml_text = render_mml(header, mml_sequences)
+		if cache:
+			cache.put(cache_keys[song_index], {"mml": mml_text, "usage": usage, "subroutine_count": subroutine_count})
+		return send_to_output(mml_text)
+
+	def use_cached_song(song_index):
+		nonlocal subroutine_count
+		restore_usage_snapshot(tracker_file, cached_songs[song_index]["usage"])
+		subroutine_count = cached_songs[song_index]["subroutine_count"]
+		return send_to_output(cached_songs[song_index]["mml"])
+
+	def send_to_output(mml_text):
+		if output == None:
+			return mml_text
+		output.write(mml_text)
+		return None
+
+	if jobs <= 1:
+		for song_index, song in enumerate(tracker_file.songs):
+			if cached_songs[song_index]:
+				yield use_cached_song(song_index)
+				continue
+			header, mml_sequences = song.convert_to_mml_sequences(impulse_tracker)
+			yield finish_song(song_index, header, compress_song_sequences(mml_sequences, tracker_file.options, memo=compression_memo), get_usage_snapshot(tracker_file))
+		return
+
+	with concurrent.futures.ProcessPoolExecutor(jobs, initializer=start_conversion_worker, initargs=(type(tracker_file), filename, tracker_file.options, cache)) as pool:
+		converted = profiled_map(pool.map, convert_song_without_compression, songs_to_convert, [impulse_tracker] * len(songs_to_convert))
+
+		# Sample note indices depend on every song before this one, so merge the usage in song order before compressing
+		compressed = []
+		for song_index in range(song_count):
+			if cached_songs[song_index]:
+				restore_usage_snapshot(tracker_file, cached_songs[song_index]["usage"])
+				compressed.append(None)
+				continue
+			header, mml_sequences, (instrument_usage, sample_usage) = next(converted)
+			for instrument, usage in zip(tracker_file.tad_instruments, instrument_usage):
+				instrument.merge_usage(usage)
+			for sample, usage in zip(tracker_file.tad_samples, sample_usage):
+				sample.merge_usage(usage)
+			resolve_sample_note_names(tracker_file, mml_sequences)
+			with profile_context(song=tracker_file.songs[song_index].name):
+				compressed.append((header, compress_song_sequences(mml_sequences, tracker_file.options, pool.map, compression_memo), get_usage_snapshot(tracker_file))) # Every channel gets its own task
+
+		for song_index, song in enumerate(compressed):
+			if song == None:
+				yield use_cached_song(song_index)
+			else:
+				yield finish_song(song_index, *song)
+
+# -------------------------------------------------------------------
+# Conversion API; nothing in here depends on the command line, so it can be called from other programs
+
+class ConversionResult(object):
+	def __init__(self, tracker_file, mml_texts):
+		self.tracker_file = tracker_file
+		self.songs = [(song.name, mml_text) for song, mml_text in zip(tracker_file.songs, mml_texts)] # (name, MML) for each song
+
+	@property
+	def instruments(self):
+		return [_ for _ in self.tracker_file.tad_instruments if _.is_used]
+
+	@property
+	def samples(self):
+		return [_ for _ in self.tracker_file.tad_samples if _.is_used]
+
+# Converts every song in a .fur or .it file. Each call gets its own file state, but timer choices are shared between calls with the same options.
+# cache can be a ConversionCache to reuse songs converted earlier.
+def convert(path, options=None, cache=None):
+	options = options or ConversionOptions()
+	impulse_tracker = path.lower().endswith(".it")
+	with profile("parse", "parse", file=os.path.basename(path)), track_memory("parse", file=os.path.basename(path)):
+		if impulse_tracker:
+			import it2tad # Only needed for .it files
+			tracker_file = it2tad.ImpulseTrackerFile(path, options, cache)
+		else:
+			tracker_file = FurnaceFile(path, options, cache)
+	return ConversionResult(tracker_file, list(convert_songs(tracker_file, path, options.jobs, impulse_tracker, cache)))
+
+# -------------------------------------------------------------------
+# Project files
+
+# Only writes the file if its contents are different, so tools watching the project folder don't rebuild things that haven't changed.
+# Returns True if the file was written.
+def write_file_if_changed(path, data):
+	try:
+		if os.path.getsize(path) == len(data):
+			with open(path, "rb") as f:
+				if hashlib.sha256(f.read()).digest() == hashlib.sha256(data).digest():
+					return False
+	except OSError:
+		pass
+	write_file_atomically(path, data)
+	return True
+
+# Sample files are named "NN - name", so index them by that number once instead of searching the whole list for every instrument
+def index_sample_files(sample_filenames):
+	sample_files = {}
+	for filename in sample_filenames:
+		sample_files.setdefault(os.path.basename(filename).split(" - ", 1)[0], filename)
+	return sample_files
+
+# Contents of the BRR file for a sample, which includes its loop point
+def brr_file_data(sample):
+	assert sample.is_brr
+
+	# Seems that Furnace can create BRR files that don't have the last block set correctly
+	data = bytearray(sample.data)
+	data[-9] |= 1 # End marker
+	if sample.loop_start != -1:
+		data[-9] |= 2 # Loop marker
+		brr_loop_start = sample.loop_start // 16 * 9
+		data = bytes((brr_loop_start & 255, (brr_loop_start >> 8) & 255)) + data # Add loop point to BRR file
+	return bytes(data)
+
+# Turns PCM samples into BRR, spread over jobs processes. The loop and the rate can change so the loop lines up with BRR's blocks.
+# Returns a list of (sample name, bytes before, bytes after) if optimize is on.
+def encode_pcm_samples(tracker_file, jobs=1, optimize=False):
+	pcm_samples = [_ for _ in tracker_file.tracker_samples if not _.is_brr and getattr(_, "pcm", None) != None]
+	to_encode = [(_.pcm, _.c4_rate, _.loop_start if _.loop_start != -1 else None) for _ in pcm_samples]
+	encoded = encode_samples(to_encode, jobs, optimize)
+	savings = []
+	for sample, original, (data, rate, loop_start) in zip(pcm_samples, to_encode, encoded):
+		if optimize:
+			savings.append((sample.name, unoptimized_size(*original), len(data)))
+		sample.data = data
+		sample.c4_rate = rate
+		sample.loop_start = -1 if loop_start == None else loop_start
+		sample.is_brr = True
+		sample.pcm = None
+	return savings
+
+# Drops the data after the loop from looped BRR samples, and the silence at the end of one-shot ones
+def trim_brr_samples(tracker_file):
+	savings = []
+	for sample in tracker_file.tracker_samples:
+		if not sample.is_brr or getattr(sample, "pcm", None) != None:
+			continue
+		before = len(sample.data) // 9 * 9
+		if sample.loop_start != -1:
+			sample.data = trim_brr(sample.data, sample.loop_start, sample.loop_end)
+		else:
+			sample.data = trim_brr(sample.data)
+		savings.append((sample.name, before, len(sample.data)))
+	return savings
+
+# Gets every sample ready to be written as BRR, once. With --optimize-samples, samples also get trimmed and the bytes saved get printed.
+def prepare_samples(tracker_file, jobs=1):
+	if getattr(tracker_file, "samples_prepared", False):
+		return
+	tracker_file.samples_prepared = True
+	optimize = tracker_file.options.optimize_samples
+	savings = trim_brr_samples(tracker_file) if optimize else []
+	savings += encode_pcm_samples(tracker_file, jobs, optimize)
+	if optimize:
+		print_sample_savings(savings)
+
+# Finds samples whose data and loop point are the same as an earlier sample's, and returns {sample number: earlier sample number}
+def find_duplicate_samples(tracker_file):
+	if getattr(tracker_file, "duplicate_samples", None) == None:
+		prepare_samples(tracker_file)
+		first_with_data = {}
+		tracker_file.duplicate_samples = {}
+		for i, sample in enumerate(tracker_file.tracker_samples):
+			if not sample.is_brr:
+				continue
+			first = first_with_data.setdefault(hashlib.sha256(brr_file_data(sample)).digest(), i)
+			if first != i:
+				tracker_file.duplicate_samples[i] = first
+	return tracker_file.duplicate_samples
+
+# Returns the files that were written. Samples that are the same as an earlier one don't get their own file.
+def dump_brr_samples(tracker_file, folder, jobs=1):
+	os.makedirs(folder, exist_ok=True)
+	written = []
+	prepare_samples(tracker_file, jobs)
+	duplicates = find_duplicate_samples(tracker_file)
+	for i, sample in enumerate(tracker_file.tracker_samples):
+		if i in duplicates:
+			continue
+		brr_path = os.path.join(folder, "%.2d - %s.brr" % (i, sample.name))
+		if write_file_if_changed(brr_path, brr_file_data(sample)):
+			written.append(brr_path)
+	return written
+
+# Start a new project, keeping the sound effect settings from the project that's already in the folder if there is one.
+# With add_to_project, its instruments, samples and songs are kept too, so more than one module can be put into the same project.
+def start_project(project_folder, add_to_project=False):
+	terrificaudio_path = os.path.join(project_folder, "project.terrificaudio")
+	original_project = {}
+	if os.path.exists(terrificaudio_path):
+		with open(terrificaudio_path) as f:
+			original_project = json.load(f)
+
+	project = {
+		"_about": {
+			"file_type": "Terrific Audio Driver project file",
+			"version": "0.1.1"
+		},
+		"instruments": [],
+		"samples": [],
+		"default_sfx_flags": original_project.get("default_sfx_flags", {"one_channel": True, "interruptible": True}),
+		"high_priority_sound_effects": original_project.get("high_priority_sound_effects", []),
+		"sound_effects": original_project.get("sound_effects", []),
+		"low_priority_sound_effects": original_project.get("low_priority_sound_effects", []),
+		"sound_effect_file": original_project.get("sound_effect_file", "sound-effects.txt"),
+		"songs": []
+	}
+	if add_to_project:
+		for key in ("instruments", "samples", "songs"):
+			project[key] = original_project.get(key, [])
+	return project
+
+# Each module added to a project gets its own folder, and its own prefix for instrument and song names so nothing collides
+def module_folder_name(path, used_names=None):
+	name = make_alphanumeric(os.path.splitext(os.path.basename(path))[0]) or "module"
+	if used_names == None:
+		return name
+	unique_name = name
+	n = 2
+	while unique_name in used_names:
+		unique_name = "%s_%d" % (name, n)
+		n += 1
+	used_names.add(unique_name)
+	return unique_name
+
+# Adding a song again, like when a module that's already in the project gets converted again, replaces the old one where it was
+def add_song_to_project(project, name, source):
+	for song in project["songs"]:
+		if song["name"] == name:
+			song["source"] = source
+			return
+	project["songs"].append({"name": name, "source": source})
+
+# sample_filenames are the sample files to look through; source_folder is where they are, relative to the project folder.
+# Returns {old name: new name} for the ones that had to be renamed because the project already had something with the same name.
+def add_instruments_to_project(project, tracker_file, sample_filenames, source_folder=None):
+	sample_files = index_sample_files(sample_filenames)
+	used_names = set(_["name"] for _ in project["instruments"] + project["samples"])
+	added = []
+	for key, tad_instruments in (("instruments", tracker_file.tad_instruments), ("samples", tracker_file.tad_samples)):
+		for instrument in tad_instruments:
+			if not instrument.is_used and not tracker_file.options.keep_all_instruments:
+				continue
+			d = instrument.to_dict(sample_files)
+			if d != None:
+				if source_folder:
+					d["source"] = source_folder + "/" + d["source"]
+				project[key].append(d)
+				added.append(d)
+	return rename_clashing_instruments(added, used_names)
+
+# Points instruments at the first sample file with the same contents, so modules that were given copies of the same sample only store it once
+def share_identical_sample_files(project, project_folder):
+	first_with_data = {}
+	for instrument in project["instruments"] + project["samples"]:
+		try:
+			with open(os.path.join(project_folder, instrument["source"]), "rb") as f:
+				data = f.read()
+		except OSError: # Something added to the project by hand that isn't there, so leave it alone
+			continue
+		instrument["source"] = first_with_data.setdefault(hashlib.sha256(data).digest(), instrument["source"])
+
+# Gives instruments and samples a number on the end of their name if it's one of used_names, which happens when a module that's
+# already in the project changed one of its instruments. Returns {old name: new name} for the ones that got renamed.
+def rename_clashing_instruments(instruments, used_names):
+	renames = {}
+	taken = used_names | set(_["name"] for _ in instruments)
+	for instrument in instruments:
+		name = instrument["name"]
+		if name not in used_names:
+			continue
+		n = 2
+		while "%s_%d" % (name, n) in taken:
+			n += 1
+		instrument["name"] = renames[name] = "%s_%d" % (name, n)
+		taken.add(instrument["name"])
+	return renames
+
+# Settings that don't have to match for two instruments to be combined
+MERGE_IGNORED_SETTINGS = {"name", "first_octave", "last_octave"}
+
+# Instruments and samples that use the same sample file, envelope, tuning and loop get combined under the first one's name.
+# Instruments can be combined even if they play different octaves, and the one that's kept covers all of them.
+# Returns {old name: new name}, for rename_instruments_in_mml().
+def merge_identical_instruments(project):
+	renames = {}
+	for key in ("instruments", "samples"):
+		first_with_settings = {}
+		merged = []
+		for instrument in project[key]:
+			settings = json.dumps({k:v for k,v in instrument.items() if k not in MERGE_IGNORED_SETTINGS}, sort_keys=True)
+			first = first_with_settings.setdefault(settings, instrument)
+			if first is instrument:
+				merged.append(instrument)
+				continue
+			renames[instrument["name"]] = first["name"]
+			if "first_octave" in first:
+				first["first_octave"] = min(first["first_octave"], instrument["first_octave"])
+				first["last_octave"] = max(first["last_octave"], instrument["last_octave"])
+		project[key] = merged
+	return renames
+
+# Changes which project instruments the "@name instrument" lines at the top of the MML point to
+def rename_instruments_in_mml(mml_text, renames):
+	if not renames:
+		return mml_text
+	return INSTRUMENT_DEFINITION.sub(lambda _: _[1] + renames.get(_[2], _[2]), mml_text)
+INSTRUMENT_DEFINITION = re.compile(r"^(@\S+ )(\S+)$", re.MULTILINE)
+
+# Points the instrument definitions in the .mml files of the songs in the project at the instruments they were merged into
+def rename_instruments_in_songs(project, project_folder, renames):
+	if not renames:
+		return
+	for song in project["songs"]:
+		mml_path = os.path.join(project_folder, song["source"])
+		if not os.path.exists(mml_path):
+			continue
+		with open(mml_path) as f:
+			mml_text = f.read()
+		write_file_if_changed(mml_path, rename_instruments_in_mml(mml_text, renames).encode())
+
+# Combines samples and instruments that are the same, and returns {old name: new name} for the songs that are about to be added,
+# including the renames from add_instruments_to_project() if they're given. Songs that are already in the project get pointed at
+# the instruments they were merged into here.
+def deduplicate_project(project, project_folder, clashes=None):
+	share_identical_sample_files(project, project_folder)
+	renames = merge_identical_instruments(project)
+	rename_instruments_in_songs(project, project_folder, renames)
+	return dict(renames, **{old: renames.get(new, new) for old, new in (clashes or {}).items()})
+
+# Number of different notes each used instrument plays, by its name in the project file
+def used_note_counts(tracker_file):
+	return {_.project_name: len(_.all_used_notes) for _ in tracker_file.tad_instruments if _.is_used}
+
+# Retunes instruments so they share pitch table entries, and explains which instruments use the most of them
+def optimize_project_pitch_table(project, options, note_counts):
+	if options.optimize_pitch_table == None:
+		return
+	print_pitch_table_report(optimize_pitch_table(project, options.optimize_pitch_table, note_counts))
+
+# Returns True if the project file changed
+def write_project(project, project_folder):
+	terrificaudio_path = os.path.join(project_folder, "project.terrificaudio")
+	changed = write_file_if_changed(terrificaudio_path, json.dumps(project, indent=2).encode())
+
+	sfx_path = os.path.join(project_folder, project.get("sound_effect_file"))
+	if not os.path.exists(sfx_path):
+		f = open(sfx_path, "w")
+		f.close()
+	return changed
+
 # -------------------------------------------------------------------
 parser = argparse.ArgumentParser(prog='fur2tad', description='Converts Furnace files to Terrific Audio Driver MML')
 parser.add_argument('filename')
-parser.add_argument('--auto-timer-mode', type=str) # Options: low_error lowest_error
+parser.add_argument('--auto-timer-mode', type=str) # Options: low_error lowest_error balanced
+parser.add_argument('--balanced-timer-weight', type=float) # Milliseconds of row duration error worth 100 fewer driver ticks a second
 parser.add_argument('--timer-override', action='extend', nargs="+", type=str) # Format: bpm,speed=tad timer rate, tad ticks
 parser.add_argument('--ignore-arp-macro', action='store_true')
 parser.add_argument('--ignore-volume-macro', action='store_true')
@@ -1473,105 +2332,180 @@ parser.add_argument('--keep-all-instruments', action='store_true')
 parser.add_argument('--default-instrument-first-octave', default=1, type=int)
 parser.add_argument('--default-instrument-last-octave', default=6, type=int)
 parser.add_argument('--project-folder', type=str)
+parser.add_argument('--add-to-project', action='store_true')
 parser.add_argument('--dump-samples', type=str)
-args = parser.parse_args()
-auto_timer_mode = (args.auto_timer_mode or "low_error").lower()
-if auto_timer_mode not in ("low_error", "lowest_error"):
-	sys.exit("Invalid --auto-timer-mode setting:" % auto_timer_mode)
-if args.timer_override != None:
-	for timer_override_string in args.timer_override:
-		timer_override_split = timer_override_string.split("=")
-		assert len(timer_override_split) == 2
-		timer_override_split_input  = timer_override_split[0].split(",")
-		timer_override_split_output = timer_override_split[1].split(",")
-		furnace_tempo = int(timer_override_split_input[0])
-		furnace_speed = int(timer_override_split_input[1])
-		if "." in timer_override_split_output[0]:
-			tad_rate = int(round(float(timer_override_split_output[0]) / 0.125))
+parser.add_argument('--jobs', default=1, type=int)
+parser.add_argument('--no-cache', action='store_true')
+parser.add_argument('--cache-folder', default=DEFAULT_CACHE_FOLDER, type=str)
+parser.add_argument('--cache-max-size', default=DEFAULT_CACHE_MAX_SIZE // (1024*1024), type=int) # In megabytes
+parser.add_argument('--watch', action='store_true')
+parser.add_argument('--profile', nargs='?', const='fur2tad-profile', type=str) # Where to write the profile, without the .json
+parser.add_argument('--memory-report', nargs='?', const='fur2tad-memory', type=str) # Where to write the memory report, without the .json
+parser.add_argument('--compression-report', nargs='?', const='fur2tad-compression', type=str) # Where to write the compression report, without the .json
+parser.add_argument('--encode-brr', action='store_true')
+parser.add_argument('--optimize-samples', action='store_true')
+parser.add_argument('--no-voice-allocation', dest='allocate_voices', action='store_false')
+parser.add_argument('--voice-stealing', action='store_true')
+parser.add_argument('--optimize-pitch-table', nargs='?', const=0.0, type=float) # Cents instruments can be retuned by
+parser.add_argument('--aram-budget', type=int) # In bytes
+parser.add_argument('--echo-edl', default=0, type=int) # Echo buffer size for songs that use echo, for --aram-budget
+
+# Exits with an error message if the options are invalid
+def options_from_args(args):
+	options = ConversionOptions.from_args(args)
+	if args.add_to_project:
+		if not args.project_folder:
+			sys.exit("--add-to-project needs --project-folder")
+		options.project_name_prefix = module_folder_name(args.filename) + "_"
+	if args.aram_budget != None and not args.project_folder: # Checked here so it fails before anything gets converted
+		sys.exit("--aram-budget needs --project-folder")
+	try:
+		get_timer_chooser(options)
+	except ValueError as e:
+		sys.exit(str(e))
+	return options
+
+def cache_from_args(args):
+	if args.no_cache or args.compression_report: # Cached songs skip compression, so there would be nothing to report
+		return None
+	return ConversionCache(args.cache_folder, args.cache_max_size * 1024*1024)
+
+# Starts --profile, --memory-report and --compression-report if they were asked for
+def start_reports(args):
+	if args.profile or args.compression_report: # The compression report gets the results of each pass from the profiler
+		start_profiling()
+	if args.compression_report:
+		start_compression_report()
+	if args.memory_report:
+		if args.jobs > 1:
+			print("--memory-report only sees the main process, so converting with --jobs 1")
+			args.jobs = 1
+		start_memory_tracking()
+
+def write_reports(args):
+	profiler = stop_profiling()
+	if profiler and args.profile:
+		profiler.write(args.profile + ".json", args.profile + ".trace.json")
+		print("Wrote the profile to %s.json and %s.trace.json" % (args.profile, args.profile), file=sys.stderr)
+	compression_report = stop_compression_report()
+	if compression_report:
+		compression_report.add_passes(profiler.events)
+		compression_report.print_report()
+		compression_report.write(args.compression_report + ".json")
+		print("Wrote the compression report to %s.json" % args.compression_report, file=sys.stderr)
+	memory_tracker = stop_memory_tracking()
+	if memory_tracker:
+		memory_tracker.print_report()
+		memory_tracker.write(args.memory_report + ".json")
+		print("Wrote the memory report to %s.json" % args.memory_report, file=sys.stderr)
+
+# Estimates the audio RAM the project needs, and exits with an error if it doesn't fit in --aram-budget
+def check_aram_budget(args):
+	if args.aram_budget == None:
+		return
+	estimate = estimate_project_aram(args.project_folder, args.echo_edl)
+	print_aram_estimate(estimate, args.aram_budget)
+	problems = check_aram_estimate(estimate, args.aram_budget)
+	if problems:
+		sys.exit("\n".join(problems))
+
+# Writes the samples, songs and project file for one Furnace module, and returns the files that changed.
+# With add_to_project, the module's files go in a folder of their own and the rest of the project is kept.
+def write_furnace_project(fur_file, filename, project_folder, jobs=1, cache=None, compression_memo=None, add_to_project=False):
+	source_folder = module_folder_name(filename) if add_to_project else None
+	module_folder = os.path.join(project_folder, source_folder) if add_to_project else project_folder
+	os.makedirs(module_folder, exist_ok=True)
+	with profile("write samples", "write"), track_memory("write samples"):
+		written = dump_brr_samples(fur_file, module_folder, jobs)
+	project = start_project(project_folder, add_to_project)
+	mml_texts = list(convert_songs(fur_file, filename, jobs, cache=cache, compression_memo=compression_memo))
+
+	# Instruments come first, so the songs can be pointed at the instruments they were merged into
+	with profile("write instruments", "write"), track_memory("write instruments"):
+		clashes = add_instruments_to_project(project, fur_file, glob.glob(os.path.join(module_folder, '*.brr')), source_folder)
+		renames = deduplicate_project(project, project_folder, clashes)
+		optimize_project_pitch_table(project, fur_file.options, used_note_counts(fur_file))
+
+	for song, mml_text in zip(fur_file.songs, mml_texts):
+		mml_filename = "%s.mml" % song.name
+		mml_path = os.path.join(module_folder, mml_filename)
+		with profile("write song", "write", song=song.name), track_memory("write", song=song.name):
+			if write_file_if_changed(mml_path, rename_instruments_in_mml(mml_text, renames).encode()):
+				written.append(mml_path)
+		if add_to_project:
+			add_song_to_project(project, fur_file.project_name_prefix + song.name, source_folder + "/" + mml_filename)
 		else:
-			tad_rate = int(timer_override_split_output[0])
-		if tad_rate < 64 or tad_rate > 256:
-			sys.exit("Invalid TAD timer rate in --timer-override: %s" % timer_override_string)
-		tad_ticks = int(timer_override_split_output[1])
-		
-		cached_timer_and_multiplier[(furnace_tempo/2.5, furnace_speed)] = (tad_rate, tad_ticks)
+			add_song_to_project(project, song.name, mml_filename)
 
-if __name__ == "__main__":
-	fur_file = FurnaceFile(args.filename)
-	dump_folder = args.dump_samples or args.project_folder
-	if dump_folder:
-		os.makedirs(dump_folder, exist_ok=True)
-		for i, sample in enumerate(fur_file.tracker_samples):
-			brr_path = os.path.join(dump_folder, "%.2d - %s.brr" % (i, sample.name))
-			assert sample.is_brr
-
-			# Seems that Furnace can create BRR files that don't have the last block set correctly
-			sample.data = bytearray(sample.data)
-			sample.data[-9] |= 1 # End marker
-			if sample.loop_start != -1:
-				sample.data[-9] |= 2 # Loop marker
-				brr_loop_start = sample.loop_start // 16 * 9
-				sample.data = bytes((brr_loop_start & 255, (brr_loop_start >> 8) & 255)) + sample.data # Add loop point to BRR file
-
-			with open(brr_path, 'wb') as f:
-				f.write(sample.data)
-	if args.project_folder:
-		os.makedirs(args.project_folder, exist_ok=True)
-
-		terrificaudio_path = os.path.join(args.project_folder, "project.terrificaudio")
-		original_project = {}
-		if os.path.exists(terrificaudio_path):
-			with open(terrificaudio_path) as f:
-				original_project = json.load(f)
-
-		project = {
-			"_about": {
-				"file_type": "Terrific Audio Driver project file",
-				"version": "0.1.1"
-			},
-			"instruments": [],
-			"samples": [],
-			"default_sfx_flags": original_project.get("default_sfx_flags", {"one_channel": True, "interruptible": True}),
-			"high_priority_sound_effects": original_project.get("high_priority_sound_effects", []),
-			"sound_effects": original_project.get("sound_effects", []),
-			"low_priority_sound_effects": original_project.get("low_priority_sound_effects", []),
-			"sound_effect_file": original_project.get("sound_effect_file", "sound-effects.txt"),
-			"songs": []
-		}
+	with profile("write project", "write"), track_memory("write project"):
+		if write_project(project, project_folder):
+			written.append(os.path.join(project_folder, "project.terrificaudio"))
+	return written
 
-		for song in fur_file.songs:
-			filename = "%s.mml" % song.name
-			mml_path = os.path.join(args.project_folder, filename)
-			mml_text = song.convert_to_tad()
-			with open(mml_path, 'w') as f:
-				f.write(mml_text)
-			project["songs"].append({"name": song.name, "source": filename})
-
-		# Write the instruments and samples
-		brrs = glob.glob(os.path.join(args.project_folder, '*.brr'))
-		for instrument in fur_file.tad_instruments:
-			if not instrument.is_used and not args.keep_all_instruments:
-				continue
-			d = instrument.to_dict(brrs)
-			if d != None:
-				project["instruments"].append(d)
-		for sample in fur_file.tad_samples:
-			if not sample.is_used and not args.keep_all_instruments:
-				continue
-			d = sample.to_dict(brrs)
-			if d != None:
-				project["samples"].append(d)
+# -------------------------------------------------------------------
+# --watch
 
-		# Write the final project file
-		with open(terrificaudio_path, 'w') as f:
-			json.dump(project, f, indent=2)
+WATCH_POLL_INTERVAL = 0.25 # Seconds
 
-		sfx_path = os.path.join(args.project_folder, project.get("sound_effect_file"))
-		if not os.path.exists(sfx_path):
-			f = open(sfx_path, "w")
-			f.close()
+def file_signature(filename):
+	try:
+		stat = os.stat(filename)
+		return (stat.st_mtime_ns, stat.st_size)
+	except OSError:
+		return None
+
+# Converts the module into the project folder every time it's saved. The cache, the parsed module IR and the compressed channels
+# from the last round are all kept, so after the first round only channels with changes in them need to be compressed again.
+def watch_furnace_project(filename, options, project_folder, jobs=1, cache=None, add_to_project=False):
+	compression_memo = CompressionMemo()
+	last_signature = None
+	print("Watching %s, press Ctrl+C to stop" % filename)
+	while True:
+		signature = file_signature(filename)
+		if signature == None or signature == last_signature:
+			time.sleep(WATCH_POLL_INTERVAL)
+			continue
+		time.sleep(WATCH_POLL_INTERVAL)
+		if file_signature(filename) != signature: # Still being written
+			continue
+		last_signature = signature
+
+		start_time = time.perf_counter()
+		compression_memo.start_round()
+		try:
+			fur_file = FurnaceFile(filename, options, cache)
+			written = write_furnace_project(fur_file, filename, project_folder, jobs, cache, compression_memo, add_to_project)
+		except Exception as e: # Keep watching, the next save might fix it
+			print("Couldn't convert %s: %s" % (filename, e))
+			continue
+		print("%s: updated %s in %.2f s" % (time.strftime("%H:%M:%S"), ", ".join(os.path.basename(_) for _ in written) or "nothing", time.perf_counter() - start_time))
 
-	if not args.project_folder:
-		for song in fur_file.songs:
-			print(song.convert_to_tad())
+if __name__ == "__main__":
+	args = parser.parse_args()
+	cache = cache_from_args(args)
+	if args.watch:
+		if not args.project_folder:
+			sys.exit("--watch needs --project-folder")
+		if args.profile or args.memory_report or args.compression_report:
+			sys.exit("--profile, --memory-report and --compression-report can't be used with --watch")
+		try:
+			watch_furnace_project(args.filename, options_from_args(args), args.project_folder, args.jobs, cache, args.add_to_project)
+		except KeyboardInterrupt:
+			pass
+		sys.exit()
+
+	options = options_from_args(args)
+	start_reports(args)
+	with profile("parse", "parse", file=os.path.basename(args.filename)), track_memory("parse"):
+		fur_file = FurnaceFile(args.filename, options, cache)
+	if args.dump_samples:
+		with profile("write samples", "write"), track_memory("write samples"):
+			dump_brr_samples(fur_file, args.dump_samples, args.jobs)
+	if args.project_folder:
+		write_furnace_project(fur_file, args.filename, args.project_folder, args.jobs, cache, add_to_project=args.add_to_project)
+	else:
+		for _ in convert_songs(fur_file, args.filename, args.jobs, cache=cache, output=sys.stdout):
+			print()
 			print()
+	write_reports(args)
+	check_aram_budget(args)
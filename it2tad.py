@@ -22,48 +22,486 @@
 
 # https://modland.com/pub/documents/format_documentation/Impulse%20Tracker%20v2.04%20(.it).html
 # https://fileformats.fandom.com/wiki/Impulse_tracker
-import io, os, json, glob
-import xmodits # pip install xmodits-py
+import io, os, json, glob, wave, copy, math
 from fur2tad import *
+from pitch_table import MAX_SEMITONES
+from brr_encoder import pcm_from_bytes, encode_samples, unoptimized_size, print_sample_savings
 
 IT_EFFECT_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ#\\" # 0x01 through 0x1C
+IT_CHANNELS = 64
+
+# -------------------------------------------------------------------
+# Pattern data
+
+# Turns an Impulse Tracker effect into a tuple of Furnace effects and a warning (or None), or returns None if the effect isn't supported
+def translate_it_effect(effect_char, effect_value):
+	effects = []
+	warning = None
+	if effect_char == "A": # Set Speed: Sets the module Speed (ticks per row)
+		effects.append((0x09, effect_value))
+	elif effect_char == "B": # Jump to different pattern
+		effects.append((0x0B, effect_value))
+	elif effect_char == "C": # Pattern Break: Jumps to row xx of the next pattern in the Order List. 
+		effects.append((0x0D, effect_value))
+	elif effect_char in ("D", "K", "L"): # Volume slide or fine volume slide
+		if effect_value == 0 or (effect_value & 0xF0) == 0 or (effect_value & 0x0F) == 0:
+			effects.append((0x0A, effect_value))
+			# TODO: Figure out if it actually goes up or down at the same rate as Furnace
+		elif (effect_value & 0xF0) == 0xF0: # Fine decrease
+			effects.append((0xF9, effect_value & 15))
+		elif (effect_value & 0x0F) == 0x0F: # Fine increase
+			effects.append((0xF8, effect_value >> 4))
+		else:
+			warning = "Invalid volume slide %x" % effect_value
+
+		if effect_char == "K":
+			effects.append((0x04, 0)) # Continue vibrato
+		elif effect_char == "L":
+			effects.append((0x03, 0)) # Continue portamento
+	elif effect_char == "E": # Portamento Down or Fine Portamento Down or Extra Fine Portamento Down  
+		if (effect_value & 0xF0) == 0xF0: # Fine: Only apply it on first tick of row, don't slide. Repeat it if E00 is used.
+			effects.append((0xf2, effect_value/2)) # Single tick pitch down
+		elif (effect_value & 0xF0) == 0xE0: # Extra fine: Four times the precision, but slide like normal
+			effects.append((0x02, effect_value/2))
+		else:
+			effects.append((0x02, effect_value*2))
+	elif effect_char == "F": # Portamento Up or Fine Portamento Up or Extra Fine Portamento  
+		effects.append((0x01, effect_value*2))
+		if (effect_value & 0xF0) == 0xF0: # Fine: Only apply it on first tick of row, don't slide. Repeat it if F00 is used.
+			effects.append((0xf1, effect_value/2)) # Single tick pitch up
+		elif (effect_value & 0xF0) == 0xE0: # Extra fine: Four times the precision, but slide like normal
+			effects.append((0x01, effect_value/2))
+		else:
+			effects.append((0x01, effect_value*2))
+	elif effect_char == "G": # Tone Portamento: Slides the pitch of the previous note towards the current note by xx units on every tick of the row except the first. 
+		effects.append((0x03, effect_value))
+	elif effect_char == "H": # Vibrato: Executes vibrato with speed x and depth y on the current note. 
+		effects.append((0x04, effect_value))
+	elif effect_char == "J": # Arpeggio
+		effects.append((0x00, effect_value))
+	elif effect_char == "P": # Pan slide
+		effects.append((0x83, effect_value))
+		if (effect_value & 0xF0) == 0xF0 or (effect_value & 0x0F) == 0x0F:
+			warning = "Fine pan slide not supported"
+	elif effect_char == "R": # Tremolo
+		effects.append((0x07, effect_value))
+	elif effect_char == "S" and (effect_value & 0xF0 == 0x80): # Panning; 8L to 1L, then 1R to 8R
+		value = effect_value & 0xF
+		if value >= 0 and value <= 0x7:
+			effects.append((0x80, effect_value*16))
+		else:
+			effects.append((0x80, 0x80 + (effect_value+1)*16))
+	elif effect_char == "S" and (effect_value & 0xF0 == 0xC0): # Note cut
+		if effect_value == 0:
+			effect_value = 1
+		effects.append((0xEC, effect_value))
+	elif effect_char == "S" and (effect_value & 0xF0 == 0xD0): # Note delay
+		if effect_value == 0:
+			effect_value = 1
+		effects.append((0xED, effect_value))
+	elif effect_char == "T" and effect_value >= 0x20: # Set Tempo: Sets the module Tempo if xx is greater than or equal to 20h.
+		effects.append((0xF0, effect_value))
+	elif effect_char == "X": # Set Panning
+		effects.append((0x80, effect_value))
+	elif effect_char == "Y": # Panbrello
+		effects.append((0x84, effect_value))
+	else:
+		return None
+	return tuple(effects), warning
+
+# Turns a value in the volume column into a volume (or None) and a tuple of effects
+def translate_it_volume_column(volume):
+	# Convert 0-63 volume to 0-255
+	if   volume >= 0   and volume <= 64:  # Volume
+		return volume * 4 + (volume & 3), ()
+	elif volume >= 65  and volume <= 74:  # Fine volume up
+		effect = ("D", ((volume - 65) << 4) | 0x0F) # DxF
+	elif volume >= 75  and volume <= 84:  # Fine volume down
+		effect = ("D", (volume - 75) | 0xF0) # DFy
+	elif volume >= 85  and volume <= 94:  # Volume slide up
+		effect = ("D", (volume - 85) << 4) #Dx0
+	elif volume >= 95  and volume <= 104: # Volume slide down
+		effect = ("D", volume - 95) # D0y
+	elif volume >= 105 and volume <= 114: # Pitch slide down
+		effect = ("E", (volume - 105) * 4)
+	elif volume >= 115 and volume <= 124: # Pitch slide up
+		effect = ("F", (volume - 115) * 4)
+	elif volume >= 128 and volume <= 192: # Pan
+		value = volume - 128 # -32L (0) to 0 (32) to 32R (64)
+		effect = ("X", value * 4) # 32R (64) will become 128R (256), outside the byte range
+	elif volume >= 193 and volume <= 202: # Portamento to note
+		effect = ("G", (0x00, 0x01, 0x04, 0x08, 0x10, 0x20, 0x40, 0x60, 0x80, 0xFF)[volume - 193])
+	elif volume >= 203 and volume <= 212: # Vibrato depth (keep the same vibrato speed and only change the depth)
+		effect = ("H", volume - 203) # 0 for speed, so it will be "continue"
+	else:
+		return None, ()
+	return None, translate_it_effect(*effect)[0]
+
+# Every combination of effect ID and value, worked out ahead of time: IT_EFFECT_TABLE[effect ID][value] is what translate_it_effect()
+# returns, or False if the effect ID isn't valid.
+IT_EFFECT_TABLE = [[False] * 256] + [[translate_it_effect(effect_char, value) for value in range(256)] for effect_char in IT_EFFECT_CHARS]
+IT_EFFECT_TABLE += [[False] * 256] * (256 - len(IT_EFFECT_TABLE))
+IT_VOLUME_COLUMN_TABLE = [translate_it_volume_column(_) for _ in range(256)]
+IT_NOTE_TABLE = [_ + 12*5 for _ in range(254)] + [NoteValue.RELEASE, NoteValue.OFF]
+
+# How many bytes of pattern data come after a channel's mask variable
+IT_MASK_DATA_SIZE = [(mask & 1) + ((mask >> 1) & 1) + ((mask >> 2) & 1) + ((mask >> 3) & 1) * 2 for mask in range(256)]
+
+def copy_note(note):
+	note = copy.copy(note)
+	note.effects = list(note.effects)
+	return note
+
+# -------------------------------------------------------------------
+# Voice allocation
+
+# Effects that change the whole song instead of one channel, so they're kept even if the rest of their row doesn't fit in a voice
+IT_SONG_EFFECTS = {0x09, 0x0B, 0x0D, 0x0F, 0xF0, 0xFF}
+IT_MIDDLE_C = 12*5 + 60 # C-5, after the 12*5 that every note gets moved up by
+
+# Puts the notes from every Impulse Tracker channel onto the SNES's 8 voices. A voice is busy from a note until the note is
+# released or cut, the same channel plays another note, or the sample runs out if it isn't looped. Channels further left get
+# voices first, and with voice_stealing, a note can take a voice away from a note on a channel further right.
+# Notes that don't fit anywhere are dropped, and reported afterwards.
+class VoiceAllocator(object):
+	def __init__(self, it_file, voice_stealing=False):
+		self.it_file = it_file
+		self.voice_stealing = voice_stealing
+		self.allocated = {} # (pattern number, state at the start of the pattern): (pattern ID, voice rows, state at the end, dropped rows, stolen rows)
+		self.dropped = []   # (channel, order index, row)
+		self.stolen = []    # (channel, order index, row) for notes that got cut off early
+
+	# The sample a note plays, and the note it plays it at
+	def sample_for_note(self, instrument_index, note):
+		it_file = self.it_file
+		if instrument_index == None or not 0 <= instrument_index < len(it_file.tracker_instruments):
+			return None, note
+		instrument = it_file.tracker_instruments[instrument_index]
+		if not it_file.use_instruments:
+			return instrument, note
+		sample_number = instrument.tracker_sample_number_for_note.get(note)
+		if sample_number == None or sample_number >= len(it_file.tracker_samples):
+			return None, note
+		return it_file.tracker_samples[sample_number], instrument.note_remap.get(note, note)
+
+	# How many rows a note sounds for, or None if it keeps going until it's stopped because the sample is looped
+	def note_length(self, instrument_index, note, speed, tempo):
+		sample, note = self.sample_for_note(instrument_index, note)
+		if sample == None or not sample.sample_length:
+			return 1
+		if sample.flags_looped or sample.flags_sustain_loop:
+			return None
+		seconds = sample.sample_length / transpose_frequency(sample.c4_rate or 8363, max(-MAX_SEMITONES, min(MAX_SEMITONES, note - IT_MIDDLE_C)))
+		seconds_per_row = speed * 2.5 / (tempo or 125)
+		return max(1, math.ceil(seconds / seconds_per_row))
+
+	# state is (voices, last instrument on each channel, speed, tempo), where voices has (channel, rows left or None) or None for each voice
+	def allocate_pattern(self, pattern, state):
+		row_count, channel_rows = pattern
+		voices, last_instrument, speed, tempo = state
+		last_instrument = dict(last_instrument)
+		owner      = [_[0] if _ else None for _ in voices]
+		busy_until = [(_[1] if _[1] != None else math.inf) if _ else 0 for _ in voices]
+		holder     = {channel: voice for voice, channel in enumerate(owner) if channel != None}
+		last_voice = {} # So a channel goes back to the same voice when it can
+		voice_rows = [[None] * row_count for _ in range(CHANNELS)]
+		dropped = []
+		stolen = []
+		channels = sorted(channel_rows)
+
+		for row_number in range(row_count):
+			for voice in range(CHANNELS): # Notes that ended by themselves
+				if owner[voice] != None and busy_until[voice] <= row_number:
+					del holder[owner[voice]]
+					owner[voice] = None
+			placed = [None] * CHANNELS
+			song_effects = []
+
+			for channel in channels:
+				note = channel_rows[channel][row_number]
+				if note is None:
+					continue
+				for effect_type, effect_value in note.effects:
+					if effect_type == 0x09 and effect_value:
+						speed = effect_value
+					elif effect_type == 0xF0:
+						tempo = effect_value
+				instrument = note.instrument if note.instrument != None else last_instrument.get(channel)
+				if note.instrument != None:
+					last_instrument[channel] = note.instrument
+
+				voice = holder.get(channel)
+				if note.note != None and note.note <= NoteValue.LAST: # New note
+					if voice == None:
+						free = [_ for _ in range(CHANNELS) if owner[_] == None and placed[_] is None]
+						if free:
+							voice = last_voice.get(channel) if last_voice.get(channel) in free else free[0]
+						elif self.voice_stealing:
+							victims = [_ for _ in range(CHANNELS) if placed[_] is None and owner[_] != None and owner[_] > channel]
+							if victims:
+								voice = max(victims, key=lambda _: owner[_])
+								stolen.append((owner[voice], row_number))
+								del holder[owner[voice]]
+					if voice == None:
+						dropped.append((channel, row_number))
+						song_effects += [_ for _ in note.effects if _[0] in IT_SONG_EFFECTS]
+						continue
+					if note.instrument == None and instrument != None: # The voice might have been playing something else
+						note = copy_note(note)
+						note.instrument = instrument
+					length = self.note_length(instrument, note.note, speed, tempo)
+					owner[voice] = channel
+					holder[channel] = voice
+					last_voice[channel] = voice
+					busy_until[voice] = row_number + length if length != None else math.inf
+				elif voice == None or placed[voice] is not None: # Nothing playing on this channel, or another note already took its voice on this row
+					song_effects += [_ for _ in note.effects if _[0] in IT_SONG_EFFECTS]
+					continue
+				elif note.note != None: # Released or cut, so the voice is free from the next row on
+					busy_until[voice] = row_number + 1
 
-class ImpulseTrackerInstrumentSampleMixin(object):
-	def to_dict(self, sample_filenames, sample_num=None):
-		if hasattr(self, "sample"):
-			look_for = "%.2d - " % (sample_num+1)
+				if any(_[0] == 0xEC for _ in note.effects): # Note cut
+					busy_until[voice] = row_number + 1
+				placed[voice] = note
+
+			if song_effects:
+				empty_voices = [_ for _ in range(CHANNELS) if placed[_] is None]
+				if empty_voices:
+					note = FurnaceNote()
+					placed[empty_voices[0]] = note
+				else:
+					note = copy_note(placed[0])
+					placed[0] = note
+				note.effects += song_effects
+
+			for voice in range(CHANNELS):
+				voice_rows[voice][row_number] = placed[voice] if placed[voice] is not None else FurnaceNote()
+
+		voices = tuple((owner[_], busy_until[_] - row_count if busy_until[_] != math.inf else None) if owner[_] != None and busy_until[_] > row_count else None for _ in range(CHANNELS))
+		return voice_rows, (voices, tuple(sorted(last_instrument.items())), speed, tempo), dropped, stolen
+
+	# source_patterns has (row count, {channel: rows}) for each pattern number. Replaces the song's patterns and orders with ones
+	# for each voice, where each pattern is made for the notes that are still playing when it starts.
+	def allocate(self, song, source_patterns, orders):
+		state = ((None,) * CHANNELS, (), song.speed1, round(song.ticks_per_second * 2.5))
+		song.patterns = [{} for _ in range(CHANNELS)]
+		song.orders = [[] for _ in range(CHANNELS)]
+		for order_index, pattern_number in enumerate(orders):
+			key = (pattern_number, state)
+			if key not in self.allocated:
+				pattern = source_patterns.get(pattern_number, (64, {})) # Patterns that aren't in the file are 64 empty rows
+				voice_rows, end_state, dropped, stolen = self.allocate_pattern(pattern, state)
+				pattern_id = len(self.allocated)
+				for voice in range(CHANNELS):
+					song.patterns[voice][pattern_id] = FurnacePattern()
+					song.patterns[voice][pattern_id].rows = voice_rows[voice]
+				self.allocated[key] = (pattern_id, end_state, dropped, stolen)
+			pattern_id, state, dropped, stolen = self.allocated[key]
+			for voice in range(CHANNELS):
+				song.orders[voice].append(pattern_id)
+			self.dropped += [(channel, order_index, row) for channel, row in dropped]
+			self.stolen += [(channel, order_index, row) for channel, row in stolen]
+
+	def print_report(self, channel_count):
+		print("Fit %d channels into %d voices" % (channel_count, CHANNELS))
+		for what, notes in (("didn't fit and were dropped", self.dropped), ("were cut off early to make room", self.stolen)):
+			for channel in sorted(set(_[0] for _ in notes)):
+				channel_notes = [_ for _ in notes if _[0] == channel]
+				print("Channel %d: %d notes %s, first at order %d row %d" % (channel + 1, len(channel_notes), what, channel_notes[0][1], channel_notes[0][2]))
+
+# -------------------------------------------------------------------
+# Sample data
+
+# Reads bits least significant first, the way IT214 and IT215 compressed samples store them
+class BitReader(object):
+	def __init__(self, data):
+		self.data = bytes(data) + bytes(4) # So reading near the end doesn't need a special case
+		self.position = 0
+
+	def read(self, bits):
+		index = self.position >> 3
+		value = int.from_bytes(self.data[index:index+4], byteorder="little") >> (self.position & 7)
+		self.position += bits
+		return value & ((1 << bits) - 1)
+
+# Decompresses one channel of an IT214 (or IT215 if it215 is true) sample, and returns it as 8 or 16-bit signed numbers.
+# The data is split into blocks, each starting with its size. Every value is the change from the previous one (or the change
+# in the change, for IT215), stored with a bit width that the data itself can change in three different ways.
+def decompress_it_sample(data, offset, length, is_16bit, it215):
+	bits = 16 if is_16bit else 8
+	block_samples = 0x4000 if is_16bit else 0x8000
+	top_bit = 1 << (bits - 1)
+	mask = (1 << bits) - 1
+	out = []
+	while len(out) < length:
+		block_size = int.from_bytes(data[offset:offset+2], byteorder="little")
+		reader = BitReader(data[offset+2:offset+2+block_size])
+		offset += 2 + block_size
+
+		width = bits + 1
+		delta = total = 0
+		block_end = min(length, len(out) + block_samples)
+		while len(out) < block_end:
+			value = reader.read(width)
+			if width < 7: # Method 1: one special value, followed by the new width
+				if value == 1 << (width - 1):
+					value = reader.read(4 if is_16bit else 3) + 1
+					width = value if value < width else value + 1
+					continue
+			elif width < bits + 1: # Method 2: a range of values at the top that are new widths
+				border = (mask >> (bits + 1 - width)) - (8 if is_16bit else 4)
+				if border < value <= border + bits:
+					value -= border
+					width = value if value < width else value + 1
+					continue
+			elif width == bits + 1: # Method 3: the top bit means the rest is a new width
+				if value & (1 << bits):
+					width = (value + 1) & 0xFF
+					continue
+			else:
+				raise ValueError("Compressed sample data has a bad bit width")
+
+			if width < bits: # Sign extend to the full size
+				shift = bits - width
+				value = (value << shift) & mask
+				value = (value - (1 << bits) if value & top_bit else value) >> shift
+			else:
+				value = value - (1 << bits) if value & top_bit else value
+			delta = (delta + value) & mask
+			total = (total + delta) & mask
+			result = total if it215 else delta
+			out.append(result - (1 << bits) if result & top_bit else result)
+	return out, offset
+
+# Returns a sample's data as a list of 16-bit numbers. Stereo samples get mixed down to mono.
+def decode_it_sample(it_file, sample):
+	if not sample.sample_length or not sample.sample_pointer:
+		return []
+	data = memoryview(it_file.bytes)
+	bits = 16 if sample.flags_is_16bit else 8
+	channels = 2 if sample.flags & 4 else 1
+	offset = sample.sample_pointer
+	decoded = []
+	for channel in range(channels):
+		if sample.flags_compressed:
+			pcm, offset = decompress_it_sample(data, offset, sample.sample_length, sample.flags_is_16bit, sample.data_is_delta_encoded)
+			pcm = [_ << (16 - bits) for _ in pcm]
 		else:
-			look_for = "%.2d - " % (sample_num+1)
-		sample = self.tracker_file.tracker_samples[sample_num]
+			size = sample.sample_length * bits // 8
+			raw = data[offset:offset+size]
+			offset += size
+			if sample.data_is_delta_encoded: # Each value is the change from the previous one
+				values = pcm_from_bytes(raw, bits, True, sample.data_is_big_endian)
+				pcm = []
+				total = 0
+				for value in values:
+					total = (total + value + 32768) % 65536 - 32768
+					pcm.append(total)
+			else:
+				pcm = pcm_from_bytes(raw, bits, sample.data_is_signed, sample.data_is_big_endian)
+		decoded.append(pcm)
+	if channels == 1:
+		return decoded[0]
+	return [(a + b) // 2 for a, b in zip(*decoded)]
+
+# Decodes every sample in the file into sample.pcm, unless that's already been done
+def decode_it_samples(it_file):
+	for sample in it_file.tracker_samples:
+		if getattr(sample, "pcm", None) == None:
+			sample.pcm = decode_it_sample(it_file, sample)
+
+def is_sample_filename(filename):
+	return len(filename) > 4 and filename[0:2].isdigit() and filename[2] == " " and filename[3] == "-"
+
+# Writes every sample to a WAV file named "NN - name.wav", where NN is the sample number. Only files that changed get written,
+# and WAV files named like that for samples that aren't in the module anymore are removed.
+def dump_wav_samples(it_file, folder):
+	os.makedirs(folder, exist_ok=True)
+	decode_it_samples(it_file)
+
+	new_wavs = set()
+	for sample_num, sample in enumerate(it_file.tracker_samples):
+		if not sample.pcm:
+			continue
+		wav_basename = "%.2d - %s.wav" % (sample_num+1, sample.name)
+		data = io.BytesIO()
+		with wave.open(data, "wb") as f:
+			f.setnchannels(1)
+			f.setsampwidth(2)
+			f.setframerate(max(1, round(sample.c4_rate)))
+			f.writeframes(struct.pack("<%dh" % len(sample.pcm), *sample.pcm))
+		write_file_if_changed(os.path.join(folder, wav_basename), data.getvalue())
+		new_wavs.add(wav_basename)
+
+	for wav_filename in glob.glob(os.path.join(folder, '*.wav')):
+		wav_basename = os.path.basename(wav_filename)
+		if is_sample_filename(wav_basename) and wav_basename not in new_wavs:
+			os.remove(wav_filename)
+
+# Encodes the samples into BRR files with the same names as the WAV files from dump_wav_samples(), which to_dict() uses instead of the WAV files.
+# Loops get lined up with BRR blocks here, so the project file uses the loop point written into each BRR file.
+# With --optimize-samples, the bytes each sample saved get printed.
+def encode_wav_samples(it_file, folder, jobs=1):
+	decode_it_samples(it_file)
+	wav_files = index_sample_files(glob.glob(os.path.join(folder, '*.wav')))
+	to_encode = []
+	for sample_num, sample in enumerate(it_file.tracker_samples):
+		filename = wav_files.get("%.2d" % (sample_num+1))
+		if filename == None or not sample.pcm:
+			continue
+		pcm = sample.pcm
+		loop_start = None
+		if sample.flags_looped and sample.loop_beginning < sample.loop_end:
+			pcm = pcm[:sample.loop_end]
+			loop_start = sample.loop_beginning
+		to_encode.append((sample, filename, (pcm, sample.c4_rate, loop_start)))
+
+	optimize = it_file.options.optimize_samples
+	encoded = encode_samples([_[2] for _ in to_encode], jobs, optimize)
+	if optimize:
+		print_sample_savings([(sample.name, unoptimized_size(*original), len(data)) for (sample, _, original), (data, _, _) in zip(to_encode, encoded)])
+	for (sample, filename, _), (data, rate, loop_start) in zip(to_encode, encoded):
+		header = (loop_start // 16 * 9).to_bytes(2, byteorder="little") if loop_start != None else b""
+		write_file_if_changed(os.path.splitext(filename)[0]+'.brr', header + data)
+		sample.c4_rate = rate
+		sample.brr_loop_start = loop_start
 
-		for filename in sample_filenames:
-			filename_to_use = filename
-			use_brr = False
-			brr_filename = os.path.splitext(filename)[0]+'.brr'
-			if os.path.exists(brr_filename):
-				filename_to_use = brr_filename
-				use_brr = True
-
-			wav_basename = os.path.basename(filename_to_use)
-			if wav_basename.startswith(look_for):
-				c4_rate = sample.c4_rate
-
-				c4_freq = 261.626
-				wavelength = c4_rate / c4_freq
-				tuning_freq = 32000 / wavelength
-
-				instrument_entry = {
-					"name": self.name,
-					"source": wav_basename,
-					"freq": tuning_freq,
-					"loop": "loop_with_filter" if (sample.flags_looped and not use_brr) else "none",
-					"envelope": self.envelope,
-				}
-				if sample.flags_looped:
-					instrument_entry["loop_setting"] = 0
-				return instrument_entry
-		print("Couldn't find file for sample number %d" % (sample_num+1))
-		return None
+class ImpulseTrackerInstrumentSampleMixin(object):
+	# sample_files is from index_sample_files()
+	def to_dict(self, sample_files, sample_num=None):
+		sample = self.tracker_file.tracker_samples[sample_num]
+		filename = sample_files.get("%.2d" % (sample_num+1))
+		if filename == None:
+			print("Couldn't find file for sample number %d" % (sample_num+1))
+			return None
+
+		# Use a BRR file with the same name instead, if there is one
+		use_brr = False
+		brr_filename = os.path.splitext(filename)[0]+'.brr'
+		if os.path.exists(brr_filename):
+			filename = brr_filename
+			use_brr = True
+
+		c4_rate = sample.c4_rate
+
+		c4_freq = 261.626
+		wavelength = c4_rate / c4_freq
+		tuning_freq = 32000 / wavelength
+
+		instrument_entry = {
+			"name": self.name,
+			"source": os.path.basename(filename),
+			"freq": tuning_freq,
+			"loop": "loop_with_filter" if (sample.flags_looped and not use_brr) else "none",
+			"envelope": self.envelope,
+		}
+		brr_loop_start = getattr(sample, "brr_loop_start", None) # Set by encode_wav_samples()
+		if use_brr and brr_loop_start != None:
+			instrument_entry["loop"] = "override_brr_loop_point"
+			instrument_entry["loop_setting"] = brr_loop_start
+		elif sample.flags_looped:
+			instrument_entry["loop_setting"] = 0
+		return instrument_entry
 
 	def apply_commands_from_name(self, filename):
 		self.envelope = "gain F127"
@@ -130,13 +568,18 @@ class ImpulseTrackerSample(TrackerSample, ImpulseTrackerInstrumentSampleMixin, T
 		self.instrument_is_used = False          # True if there is a note somewhere that uses this instrument
 
 class ImpulseTrackerFile(object):
-	def __init__(self, filename):
+	def __init__(self, filename, options=None, cache=None): # Impulse Tracker files are quick to parse, so there's no IR to cache
+		self.options = options or ConversionOptions()
+		self.timer_chooser = get_timer_chooser(self.options)
+		self.defer_sample_note_names = False
+
 		# Storage for things defined in the file
 		self.songs = []
 		self.tracker_instruments = []
 		self.tracker_samples = []
 		self.tad_instruments = []
 		self.tad_samples = []
+		self.project_name_prefix = self.options.project_name_prefix
 
 		# Variables that are expected but not used
 		self.groove_patterns = []
@@ -186,11 +629,19 @@ class ImpulseTrackerFile(object):
 		initial_channel_pan = s.read(64)
 		initial_channel_volume = s.read(64)
 
-		orders = []
+		# 254 is a separator and 255 is the end of a song, and modules can have more songs after either one.
+		# Each song remembers where it started, since pattern jumps count from the start of the whole order list.
+		song_orders = [(0, [])] # (position of the first order, orders)
 		for i in range(order_count):
 			o = bytes_to_int(s.read(1))
-			if o < 254: # 254 is separator and 255 is song end
-				orders.append(o)
+			if o < 254:
+				song_orders[-1][1].append(o)
+			elif song_orders[-1][1]:
+				song_orders.append((i + 1, []))
+			else:
+				song_orders[-1] = (i + 1, [])
+		if len(song_orders) > 1 and not song_orders[-1][1]:
+			song_orders.pop()
 
 		instrument_offsets = []
 		for i in range(instrument_count):
@@ -208,17 +659,21 @@ class ImpulseTrackerFile(object):
 		# Set up song structure
 		###################################################
 
-		song = TrackerSong()
-		song.name = song_name.replace(" ", "_").replace(chr(0), "")
-		song.speed_pattern = [initial_speed]
-		song.speed1 = initial_speed
-		song.ticks_per_second = initial_tempo / 2.5
-		song.orders = []
-		for channel in range(CHANNELS):
-			song.orders.append(orders)
-		song.orders_length = len(orders)
-		song.furnace_file = self
-		self.song = song
+		song_name = song_name.replace(" ", "_").replace(chr(0), "")
+		for song_number, (first_order, orders) in enumerate(song_orders):
+			song = TrackerSong()
+			song.name = song_name if len(song_orders) == 1 else "%s_%d" % (song_name or "song", song_number + 1)
+			song.speed_pattern = [initial_speed]
+			song.speed1 = initial_speed
+			song.ticks_per_second = initial_tempo / 2.5
+			song.orders = []
+			for channel in range(CHANNELS):
+				song.orders.append(orders)
+			song.orders_length = len(orders)
+			song.first_order = first_order
+			song.furnace_file = self
+			self.songs.append(song)
+		self.song = self.songs[0]
 
 		###################################################
 		# Samples
@@ -239,7 +694,7 @@ class ImpulseTrackerFile(object):
 
 			sample.default_volume = bytes_to_int(s.read(1))
 			sample.name           = s.read(26).decode().replace(" ", "_").replace(chr(0), "")
-			if args.remove_instrument_names:
+			if self.options.remove_instrument_names:
 				sample.name = "sample%d" % sample_number
 			sample.convert_flags  = bytes_to_int(s.read(1))
 			sample.data_is_signed     = bool(sample.convert_flags & 1)
@@ -297,7 +752,7 @@ class ImpulseTrackerFile(object):
 			instrument.sample_count = bytes_to_int(s.read(1))
 			s.read(1) # Reserved
 			instrument.name = s.read(26).decode().replace(" ", "_").replace(chr(0), "")
-			if args.remove_instrument_names:
+			if self.options.remove_instrument_names:
 				instrument.name = "instrument%d" % instrument_number
 			s.read(6) # Skip ahead
 
@@ -322,181 +777,94 @@ class ImpulseTrackerFile(object):
 		###################################################
 		# Song data
 		###################################################
+		# With voice allocation, every channel is kept and gets fit into the voices afterwards. Without it, only the first CHANNELS are.
+		kept_channels = IT_CHANNELS if self.options.allocate_voices else CHANNELS
+		source_patterns = {} # Pattern number: (row count, {channel: rows}), with None for rows without any data
+		pattern_instruments = {} # Pattern number: instruments used in it, in the order they're first used
+		skipped_channels = set()
+		data = memoryview(self.bytes)
 		for pattern_number in range(pattern_count):
 			if pattern_offsets[pattern_number] == 0: # Unused pattern
 				continue
-			s.seek(pattern_offsets[pattern_number]) # Start reading from pattern
-			packed_pattern_length = bytes_to_int(s.read(2))
-			row_count = bytes_to_int(s.read(2))
-			s.read(4) # Reserved
-			# Now reading packed pattern data
-
-			# Set up data structure
-			channel_patterns = [FurnacePattern() for _ in range(CHANNELS)]
-			for channel in range(CHANNELS):
-				channel_patterns[channel].rows = [FurnaceNote() for _ in range(row_count)]
-				song.patterns[channel][pattern_number] = channel_patterns[channel]
-
-			# State to keep track of reading this pattern
-			last_mask_variable = [0] * 64
-			last_note          = [0] * 64
-			last_instrument    = [0] * 64
-			last_volume        = [0] * 64
-			last_effect        = [0] * 64
+			position = pattern_offsets[pattern_number]
+			row_count = data[position+2] | (data[position+3] << 8)
+			position += 8 # Skip the packed length, row count and reserved bytes, to get to the packed pattern data
+
+			# Set up data structure. A channel's rows are made when it first has data in this pattern.
+			channel_rows = {}
+			source_patterns[pattern_number] = (row_count, channel_rows)
+			instruments_used = pattern_instruments[pattern_number] = {}
+
+			# State to keep track of reading this pattern. Channels that don't get converted only have their masks kept.
+			last_mask_variable = [0] * IT_CHANNELS
+			last_note          = [0] * kept_channels
+			last_instrument    = [0] * kept_channels
+			last_volume        = [0] * kept_channels
+			last_effect_id     = [0] * kept_channels
+			last_effect_value  = [0] * kept_channels
 
 			for row_number in range(row_count):
-				mask_variable = 0
 				while True:
-					channel_mask = bytes_to_int(s.read(1))
+					channel_mask = data[position]
+					position += 1
 					if channel_mask == 0:
 						break
 					channel = (channel_mask - 1) & 63
 					if channel_mask & 0x80:
-						last_mask_variable[channel] = bytes_to_int(s.read(1))
+						last_mask_variable[channel] = data[position]
+						position += 1
 					mask_variable = last_mask_variable[channel]
-
-					note = FurnaceNote()
+					if channel >= kept_channels:
+						position += IT_MASK_DATA_SIZE[mask_variable]
+						skipped_channels.add(channel)
+						continue
 
 					if mask_variable & 0x01:
-						last_note[channel]         = bytes_to_int(s.read(1))
+						last_note[channel] = data[position]
+						position += 1
 					if mask_variable & 0x02:
-						last_instrument[channel]   = bytes_to_int(s.read(1))
+						last_instrument[channel] = data[position]
+						position += 1
 					if mask_variable & 0x04:
-						last_volume[channel]       = bytes_to_int(s.read(1))
+						last_volume[channel] = data[position]
+						position += 1
 					if mask_variable & 0x08:
-						last_effect[channel]       = bytes_to_int(s.read(2)) # Effect byte, then effect value; will be read as little endian
+						last_effect_id[channel] = data[position]
+						last_effect_value[channel] = data[position+1]
+						position += 2
+
+					note = FurnaceNote()
 					if mask_variable & 0x11: # Note
-						if last_note[channel] == 255:
-							note.note = NoteValue.OFF
-						elif last_note[channel] == 254:
-							note.note = NoteValue.RELEASE
-						else:
-							note.note = last_note[channel] + 12*5
+						note.note = IT_NOTE_TABLE[last_note[channel]]
 
 					if mask_variable & 0x22: # Instrument
 						note.instrument = last_instrument[channel] - 1
-						song.instruments_used.add(note.instrument)
+						instruments_used[note.instrument] = True
 
-					effects = [] # Effects for this note
 					if mask_variable & 0x44: # Volume
-						# Convert 0-63 volume to 0-255
-						volume = last_volume[channel]
-						if   volume >= 0   and volume <= 64:  # Volume
-							note.volume = volume * 4 + (volume & 3)
-						elif volume >= 65  and volume <= 74:  # Fine volume up
-							value = volume - 65
-							effects.append(("D", (value << 4) | 0x0F)) # DxF
-						elif volume >= 75  and volume <= 84:  # Fine volume down
-							value = volume - 75
-							effects.append(("D", value | 0xF0)) # DFy
-						elif volume >= 85  and volume <= 94:  # Volume slide up
-							value = volume - 85
-							effects.append(("D", value << 4)) #Dx0
-						elif volume >= 95  and volume <= 104: # Volume slide down
-							value = volume - 95
-							effects.append(("D", value)) # D0y
-						elif volume >= 105 and volume <= 114: # Pitch slide down
-							value = volume - 105
-							effects.append(("E", value * 4))
-						elif volume >= 115 and volume <= 124: # Pitch slide up
-							value = volume - 115
-							effects.append(("F", value * 4))
-						elif volume >= 128 and volume <= 192: # Pan
-							value = volume - 128 # -32L (0) to 0 (32) to 32R (64)
-							effects.append(("X", value * 4)) # 32R (64) will become 128R (256), outside the byte range
-						elif volume >= 193 and volume <= 202: # Portamento to note
-							value = volume - 193
-							effects.append(("G", (0x00, 0x01, 0x04, 0x08, 0x10, 0x20, 0x40, 0x60, 0x80, 0xFF)[value]))
-						elif volume >= 203 and volume <= 212: # Vibrato depth (keep the same vibrato speed and only change the depth)
-							value = volume - 203
-							effects.append(("H", value)) # 0 for speed, so it will be "continue"
+						note.volume, effects = IT_VOLUME_COLUMN_TABLE[last_volume[channel]]
+						note.effects.extend(effects)
 					else:
 						note.volume = 255
 
 					if mask_variable & 0x88: # Effect
-						effect_id    = (last_effect[channel] & 255)
-						if effect_id == 0 or effect_id > 0x1C:
+						effect_id = last_effect_id[channel]
+						translated = IT_EFFECT_TABLE[effect_id][last_effect_value[channel]]
+						if translated == False:
 							print("Invalid effect ID:", effect_id)
+						elif translated == None:
+							note.it_effect = (IT_EFFECT_CHARS[effect_id - 1], last_effect_value[channel])
 						else:
-							effect_char  = IT_EFFECT_CHARS[effect_id - 1]
-							effect_value = last_effect[channel] >> 8
-							effects.append((effect_char, effect_value))
-
-					for effect_char, effect_value in effects:
-						if effect_char == "A": # Set Speed: Sets the module Speed (ticks per row)
-							note.effects.append((0x09, effect_value))
-						elif effect_char == "B": # Jump to different pattern
-							note.effects.append((0x0B, effect_value))
-						elif effect_char == "C": # Pattern Break: Jumps to row xx of the next pattern in the Order List. 
-							note.effects.append((0x0D, effect_value))
-						elif effect_char in ("D", "K", "L"): # Volume slide or fine volume slide
-							if effect_value == 0 or (effect_value & 0xF0) == 0 or (effect_value & 0x0F) == 0:
-								note.effects.append((0x0A, effect_value))
-								# TODO: Figure out if it actually goes up or down at the same rate as Furnace
-							elif (effect_value & 0xF0) == 0xF0: # Fine decrease
-								note.effects.append((0xF9, effect_value & 15))
-							elif (effect_value & 0x0F) == 0x0F: # Fine increase
-								note.effects.append((0xF8, effect_value >> 4))
-							else:
-								print("Invalid volume slide %x" % effect_value)
-
-							if effect_char == "K":
-								note.effects.append((0x04, 0)) # Continue vibrato
-							elif effect_char == "L":
-								note.effects.append((0x03, 0)) # Continue portamento
-						elif effect_char == "E": # Portamento Down or Fine Portamento Down or Extra Fine Portamento Down  
-							if (effect_value & 0xF0) == 0xF0: # Fine: Only apply it on first tick of row, don't slide. Repeat it if E00 is used.
-								note.effects.append((0xf2, effect_value/2)) # Single tick pitch down
-							elif (effect_value & 0xF0) == 0xE0: # Extra fine: Four times the precision, but slide like normal
-								note.effects.append((0x02, effect_value/2))
-							else:
-								note.effects.append((0x02, effect_value*2))
-						elif effect_char == "F": # Portamento Up or Fine Portamento Up or Extra Fine Portamento  
-							note.effects.append((0x01, effect_value*2))
-							if (effect_value & 0xF0) == 0xF0: # Fine: Only apply it on first tick of row, don't slide. Repeat it if F00 is used.
-								note.effects.append((0xf1, effect_value/2)) # Single tick pitch up
-							elif (effect_value & 0xF0) == 0xE0: # Extra fine: Four times the precision, but slide like normal
-								note.effects.append((0x01, effect_value/2))
-							else:
-								note.effects.append((0x01, effect_value*2))
-						elif effect_char == "G": # Tone Portamento: Slides the pitch of the previous note towards the current note by xx units on every tick of the row except the first. 
-							note.effects.append((0x03, effect_value))
-						elif effect_char == "H": # Vibrato: Executes vibrato with speed x and depth y on the current note. 
-							note.effects.append((0x04, effect_value))
-						elif effect_char == "J": # Arpeggio
-							note.effects.append((0x00, effect_value))
-						elif effect_char == "P": # Pan slide
-							note.effects.append((0x83, effect_value))
-							if (effect_value & 0xF0) == 0xF0 or (effect_value & 0x0F) == 0x0F:
-								print("Fine pan slide not supported")
-						elif effect_char == "R": # Tremolo
-							note.effects.append((0x07, effect_value))
-						elif effect_char == "S" and (effect_value & 0xF0 == 0x80): # Panning; 8L to 1L, then 1R to 8R
-							value = effect_value & 0xF
-							if value >= 0 and value <= 0x7:
-								note.effects.append((0x80, effect_value*16))
-							else:
-								note.effects.append((0x80, 0x80 + (effect_value+1)*16))
-						elif effect_char == "S" and (effect_value & 0xF0 == 0xC0): # Note cut
-							if effect_value == 0:
-								effect_value = 1
-							note.effects.append((0xEC, effect_value))
-						elif effect_char == "S" and (effect_value & 0xF0 == 0xD0): # Note delay
-							if effect_value == 0:
-								effect_value = 1
-							note.effects.append((0xED, effect_value))
-						elif effect_char == "T" and effect_value >= 0x20: # Set Tempo: Sets the module Tempo if xx is greater than or equal to 20h.
-							note.effects.append((0xF0, effect_value))
-						elif effect_char == "X": # Set Panning
-							note.effects.append((0x80, effect_value))
-						elif effect_char == "Y": # Panbrello
-							note.effects.append((0x84, effect_value))
-						else:
-							note.it_effect = (effect_char, effect_value)
+							effects, warning = translated
+							note.effects.extend(effects)
+							if warning:
+								print(warning)
 
 					# Write the note
-					if channel <= CHANNELS:
-						channel_patterns[channel].rows[row_number] = note
+					rows = channel_rows.get(channel)
+					if rows == None:
+						rows = channel_rows[channel] = [None] * row_count
+					rows[row_number] = note
 
 		if not self.use_instruments:
 			self.tracker_instruments = self.tracker_samples
@@ -544,73 +912,84 @@ class ImpulseTrackerFile(object):
 							_.use_shortened_name = True
 							break
 
-		#print(song.patterns[0][0].rows)
+		if skipped_channels:
+			print("Channels %s were left out, because only the first %d channels are converted without voice allocation" % (", ".join(str(_ + 1) for _ in sorted(skipped_channels)), CHANNELS))
+		for song_number, song in enumerate(self.songs):
+			# A module with a single song gets every pattern, even the ones that aren't in the order list
+			orders = song.orders[0]
+			pattern_numbers = sorted(source_patterns) if len(self.songs) == 1 else sorted(set(orders) & set(source_patterns))
+			for pattern_number in pattern_numbers:
+				for instrument in pattern_instruments[pattern_number]:
+					song.instruments_used.add(instrument)
+
+			# Converting a song changes its notes, so songs after the first get their own copies
+			song_patterns = source_patterns
+			if song_number:
+				song_patterns = {_: (source_patterns[_][0], {channel: [None if note is None else copy_note(note) for note in rows] for channel, rows in source_patterns[_][1].items()}) for _ in pattern_numbers}
+
+			used_channels = set(channel for _ in pattern_numbers for channel in song_patterns[_][1])
+			if used_channels and max(used_channels) >= CHANNELS:
+				allocator = VoiceAllocator(self, self.options.voice_stealing)
+				allocator.allocate(song, song_patterns, orders)
+				if len(self.songs) > 1:
+					print("%s:" % song.name)
+				allocator.print_report(len(used_channels))
+				continue
 
-it_file = ImpulseTrackerFile(args.filename)
-
-dump_folder = args.dump_samples or args.project_folder
-if dump_folder:
-	os.makedirs(dump_folder, exist_ok=True)
-
-	wavs = glob.glob(os.path.join(dump_folder, '*.wav'))
-	for filename in wavs:
-		wav_basename = os.path.basename(filename)
-		if len(wav_basename) > 4 and wav_basename[0:2].isdigit() and wav_basename[2] == " " and wav_basename[3] == "-":
-			os.remove(filename)
-
-	xmodits.dump(args.filename, dump_folder, index_raw=True)
-if args.project_folder:
-	os.makedirs(args.project_folder, exist_ok=True)
-
-	mml_path = os.path.join(args.project_folder, "song.mml")
-	mml_text = it_file.song.convert_to_tad(impulse_tracker = True)
-	with open(mml_path, 'w') as f:
-		f.write(mml_text)
-
-	terrificaudio_path = os.path.join(args.project_folder, "project.terrificaudio")
-	original_project = {}
-	if os.path.exists(terrificaudio_path):
-		with open(terrificaudio_path) as f:
-			original_project = json.load(f)
-
-	project = {
-		"_about": {
-			"file_type": "Terrific Audio Driver project file",
-			"version": "0.1.1"
-		},
-		"instruments": [],
-		"samples": [],
-		"default_sfx_flags": original_project.get("default_sfx_flags", {"one_channel": True, "interruptible": True}),
-		"high_priority_sound_effects": original_project.get("high_priority_sound_effects", []),
-		"sound_effects": original_project.get("sound_effects", []),
-		"low_priority_sound_effects": original_project.get("low_priority_sound_effects", []),
-		"sound_effect_file": original_project.get("sound_effect_file", "sound-effects.txt"),
-		"songs": [{"name": it_file.song.name, "source": "song.mml"}]
-	}
-
-	# Write the instruments
-	wavs = glob.glob(os.path.join(args.project_folder, '*.wav'))
-	for instrument in it_file.tad_instruments:
-		if not instrument.is_used and not args.keep_all_instruments:
-			continue
-		d = instrument.to_dict(wavs)
-		if d != None:
-			project["instruments"].append(d)
-	for sample in it_file.tad_samples:
-		if not sample.is_used and not args.keep_all_instruments:
-			continue
-		d = sample.to_dict(wavs)
-		if d != None:
-			project["samples"].append(d)
+			# Rows without any data get an empty note now, instead of making one for every row and replacing most of them
+			for pattern_number in pattern_numbers:
+				row_count, channel_rows = song_patterns[pattern_number]
+				for channel in range(CHANNELS):
+					pattern = FurnacePattern()
+					pattern.rows = [_ if _ is not None else FurnaceNote() for _ in channel_rows.get(channel, [None] * row_count)]
+					song.patterns[channel][pattern_number] = pattern
 
-	# Write the final project file
-	with open(terrificaudio_path, 'w') as f:
-		json.dump(project, f, indent=2)
+		#print(song.patterns[0][0].rows)
 
-	sfx_path = os.path.join(args.project_folder, project.get("sound_effect_file"))
-	if not os.path.exists(sfx_path):
-		f = open(sfx_path, "w")
-		f.close()
+if __name__ == "__main__": # Worker processes from --jobs import this file again
+	args = parser.parse_args()
+	cache = cache_from_args(args)
+	options = options_from_args(args)
+	start_reports(args)
+	with profile("parse", "parse", file=os.path.basename(args.filename)), track_memory("parse"):
+		it_file = ImpulseTrackerFile(args.filename, options, cache)
+
+	# With --add-to-project, the module's files go in a folder of their own and the rest of the project is kept
+	source_folder = module_folder_name(args.filename) if args.add_to_project else None
+	module_folder = os.path.join(args.project_folder, source_folder) if args.add_to_project else args.project_folder
+	dump_folder = args.dump_samples or module_folder
+	if dump_folder:
+		with profile("write samples", "write"), track_memory("write samples"):
+			dump_wav_samples(it_file, dump_folder)
+			if options.encode_brr or options.optimize_samples:
+				encode_wav_samples(it_file, dump_folder, args.jobs)
+	if args.project_folder:
+		os.makedirs(module_folder, exist_ok=True)
+
+		mml_texts = list(convert_songs(it_file, args.filename, args.jobs, impulse_tracker = True, cache = cache))
+		project = start_project(args.project_folder, args.add_to_project)
+
+		# Instruments come first, so the song can be pointed at the instruments they were merged into
+		with profile("write instruments", "write"), track_memory("write instruments"):
+			clashes = add_instruments_to_project(project, it_file, glob.glob(os.path.join(module_folder, '*.wav')), source_folder)
+			renames = deduplicate_project(project, args.project_folder, clashes)
+			optimize_project_pitch_table(project, options, used_note_counts(it_file))
+
+		# A module with just one song keeps the file name it always had
+		for song, mml_text in zip(it_file.songs, mml_texts):
+			mml_filename = "song.mml" if len(it_file.songs) == 1 else "%s.mml" % song.name
+			with profile("write song", "write", song=song.name), track_memory("write", song=song.name):
+				write_file_if_changed(os.path.join(module_folder, mml_filename), rename_instruments_in_mml(mml_text, renames).encode())
+			if args.add_to_project:
+				add_song_to_project(project, it_file.project_name_prefix + song.name, source_folder + "/" + mml_filename)
+			else:
+				add_song_to_project(project, song.name, mml_filename)
+
+		with profile("write project", "write"), track_memory("write project"):
+			write_project(project, args.project_folder)
 
-if not args.project_folder:
-	print(it_file.song.convert_to_tad(impulse_tracker = True))
+	if not args.project_folder:
+		for _ in convert_songs(it_file, args.filename, args.jobs, impulse_tracker = True, cache = cache, output = sys.stdout):
+			print()
+	write_reports(args)
+	check_aram_budget(args)
@@ -0,0 +1,164 @@
+# pitch_table
+#
+# Copyright (c) 2025 NovaSquirrel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Works out which pitch table entries the instruments and samples in a project need, and how to make them share more of them.
+# Terrific Audio Driver's pitch table is shared by every song, so this looks at the whole project at once.
+import math
+from collections import Counter
+
+PITCH_TABLE_SIZE = 256
+C4_FREQUENCY = 261.626
+SAMPLE_RATE = 32000
+OCTAVES = 8
+MAX_SEMITONES = 12 * 16 # Furthest apart two notes can be
+
+# Precomputed so nothing needs to call pow() for every note. Built the same way TrackerSample.frequency_for_note() used to work
+# it out, so the sample rates come out exactly the same.
+TWELFTH_ROOT_OF_2 = 2 ** (1/12)
+SEMITONE_RATIOS = [TWELFTH_ROOT_OF_2 ** _ for _ in range(MAX_SEMITONES + 1)]
+
+# Frequency of every note an instrument can play, by octave * 12 + semitone
+NOTE_FREQUENCIES = [C4_FREQUENCY * 2 ** (octave - 4 + semitone / 12) for octave in range(OCTAVES) for semitone in range(12)]
+
+# Frequency after moving the given number of semitones away from frequency
+def transpose_frequency(frequency, semitones):
+	if semitones >= 0:
+		return frequency * SEMITONE_RATIOS[semitones]
+	return frequency / SEMITONE_RATIOS[-semitones]
+
+def cents_between(a, b):
+	return 1200 * math.log2(b / a)
+
+# Pitch register values for every note of an instrument with the given tuning, from first_octave to last_octave
+def instrument_pitches(freq, first_octave, last_octave):
+	return [round(4096 * _ / freq) for _ in NOTE_FREQUENCIES[first_octave * 12 : (last_octave + 1) * 12]]
+
+def sample_pitches(sample_rates):
+	return [round(4096 * _ / SAMPLE_RATE) for _ in sample_rates]
+
+# Pitch register values for a project file's instrument or sample entry
+def entry_pitches(entry):
+	if "sample_rates" in entry:
+		return sample_pitches(entry["sample_rates"])
+	return instrument_pitches(entry["freq"], entry["first_octave"], entry["last_octave"])
+
+# Returns every pitch table entry the project needs, with the names of the instruments and samples that use it
+def pitch_table_usage(project):
+	usage = {}
+	for entry in project.get("instruments", []) + project.get("samples", []):
+		for pitch in set(entry_pitches(entry)):
+			usage.setdefault(pitch, []).append(entry["name"])
+	return usage
+
+# -------------------------------------------------------------------
+
+# Finds the tuning within tolerance_cents of the instrument's own that adds the fewest new entries to the ones already taken.
+# Instruments share entries when their tunings are a whole number of semitones apart, so every tuning already in use is a candidate.
+def best_shared_tuning(entry, taken, tunings, tolerance_cents):
+	def new_entries(freq):
+		return len(set(instrument_pitches(freq, entry["first_octave"], entry["last_octave"])) - taken)
+	best = (new_entries(entry["freq"]), 0.0, entry["freq"], None)
+	for name, freq in tunings:
+		semitones = round(12 * math.log2(entry["freq"] / freq))
+		if abs(semitones) > MAX_SEMITONES:
+			continue
+		candidate = transpose_frequency(freq, semitones)
+		cents = cents_between(entry["freq"], candidate)
+		if abs(cents) > tolerance_cents:
+			continue
+		option = (new_entries(candidate), abs(cents), candidate, name)
+		if option[:2] < best[:2]:
+			best = option
+	return best
+
+# How many entries an instrument would need as a sample instead, from the number of different notes it plays
+def entries_as_sample(entry, note_counts):
+	return note_counts.get(entry["name"])
+
+# And how many a sample would need as an instrument, from how many octaves its rates cover
+def entries_as_instrument(entry):
+	rates = [_ for _ in entry["sample_rates"] if _ > 0]
+	if not rates:
+		return None
+	return 12 * (math.floor(math.log2(max(rates) / min(rates))) + 1)
+
+# Retunes instruments by up to tolerance_cents so they share pitch table entries, and works out which instruments use the most entries
+# and which would use fewer as a sample or as an instrument. note_counts has the number of different notes each instrument plays, if known.
+# Changes the "freq" of the instruments in the project, and returns a report of what it did.
+def optimize_pitch_table(project, tolerance_cents=0.0, note_counts=None):
+	note_counts = note_counts or {}
+	entries_before = len(pitch_table_usage(project))
+
+	# Samples can't be retuned, so their entries are there no matter what. Instruments with the most notes go first, and the rest try to fit around them.
+	taken = set()
+	for entry in project.get("samples", []):
+		taken.update(sample_pitches(entry["sample_rates"]))
+	instruments = sorted(project.get("instruments", []), key=lambda _: _["last_octave"] - _["first_octave"], reverse=True)
+	tunings = []
+	retuned = []
+	for entry in instruments:
+		if tolerance_cents > 0:
+			before = len(set(entry_pitches(entry)) - taken)
+			after, cents, freq, shared_with = best_shared_tuning(entry, taken, tunings, tolerance_cents)
+			if shared_with != None and after < before:
+				retuned.append({"name": entry["name"], "from": entry["freq"], "to": freq, "cents": cents_between(entry["freq"], freq), "shares_with": shared_with, "entries_saved": before - after})
+				entry["freq"] = freq
+		taken.update(entry_pitches(entry))
+		tunings.append((entry["name"], entry["freq"]))
+
+	# Which instruments use the most entries, and what they could be instead
+	usage = pitch_table_usage(project)
+	users = Counter(len(names) for names in usage.values())
+	instrument_report = []
+	for form, key in (("instrument", "instruments"), ("sample", "samples")):
+		for entry in project.get(key, []):
+			pitches = set(entry_pitches(entry))
+			only_this = sum(1 for _ in pitches if len(usage[_]) == 1)
+			suggestion = None
+			if form == "instrument":
+				other = entries_as_sample(entry, note_counts)
+				if other != None and other < only_this:
+					suggestion = "Would use %d entries as a sample; add !sample to its name" % other
+			else:
+				other = entries_as_instrument(entry)
+				if other != None and other < only_this:
+					suggestion = "Would use about %d entries as an instrument; add !instr to its name" % other
+			instrument_report.append({"name": entry["name"], "form": form, "entries": len(pitches), "only_used_by_this": only_this, "suggestion": suggestion})
+	instrument_report.sort(key=lambda _: (_["only_used_by_this"], _["entries"]), reverse=True)
+
+	return {
+		"entries_before": entries_before,
+		"entries": len(usage),
+		"limit": PITCH_TABLE_SIZE,
+		"shared_entries": sum(count for users_count, count in users.items() if users_count > 1),
+		"retuned": retuned,
+		"instruments": instrument_report,
+	}
+
+def print_pitch_table_report(report, top=10):
+	print("Pitch table: %d of %d entries used%s, %d shared by more than one instrument" % (report["entries"], report["limit"],
+		" (was %d)" % report["entries_before"] if report["entries"] != report["entries_before"] else "", report["shared_entries"]))
+	for change in report["retuned"]:
+		print("Retuned %s by %+.2f cents to share entries with %s, saving %d" % (change["name"], change["cents"], change["shares_with"], change["entries_saved"]))
+	print("%-32s %-10s %8s %10s" % ("Instrument", "Form", "Entries", "Only used"))
+	for instrument in report["instruments"][:top]:
+		print("%-32s %-10s %8d %10d  %s" % (instrument["name"], instrument["form"], instrument["entries"], instrument["only_used_by_this"], instrument["suggestion"] or ""))
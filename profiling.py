@@ -0,0 +1,306 @@
+# profiling
+#
+# Copyright (c) 2025 NovaSquirrel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Records how long each stage of a conversion takes for --profile, and how much memory it uses for --memory-report.
+# When those aren't on, profile() and track_memory() hand back one shared object that does nothing, so leaving the calls in costs almost nothing.
+import os, sys, time, json, threading, itertools, gc, tracemalloc
+from collections import Counter
+
+# Stages, in the order they happen; spans in the "compress pass" category happen inside "compress" spans
+STAGES = ("parse", "flatten", "patterns", "compress", "merge", "write")
+
+class ProfileSpan(object):
+	recording = True
+
+	def __init__(self, profiler, name, category, args):
+		self.profiler = profiler
+		self.name = name
+		self.category = category
+		self.args = args # Can have more added to it before the span ends
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		self.cpu_start = time.thread_time()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.profiler.events.append({
+			"name": self.name,
+			"category": self.category,
+			"start": self.start,
+			"wall_seconds": time.perf_counter() - self.start,
+			"cpu_seconds": time.thread_time() - self.cpu_start,
+			"pid": os.getpid(),
+			"tid": threading.get_native_id(),
+			"args": self.args,
+		})
+
+class NullSpan(object):
+	recording = False # So arguments that take a while to work out can be skipped
+
+	def __init__(self):
+		self.args = {}
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		pass
+
+NULL_SPAN = NullSpan()
+
+class Profiler(object):
+	def __init__(self):
+		self.pid = os.getpid()
+		self.start = time.perf_counter()
+		self.events = []
+
+	def span(self, name, category, args):
+		return ProfileSpan(self, name, category, dict(current_context, **args))
+
+	# Wall and CPU seconds, added up for every combination of the given span arguments, and then by category
+	def totals(self, *keys):
+		out = {}
+		for event in self.events:
+			if any(_ not in event["args"] for _ in keys):
+				continue
+			place = out
+			for key in keys:
+				place = place.setdefault(str(event["args"][key]), {})
+			total = place.setdefault(event["category"], {"wall_seconds": 0.0, "cpu_seconds": 0.0, "count": 0})
+			total["wall_seconds"] += event["wall_seconds"]
+			total["cpu_seconds"] += event["cpu_seconds"]
+			total["count"] += 1
+		return out
+
+	def summary(self):
+		return {
+			"wall_seconds": time.perf_counter() - self.start,
+			"stages": self.totals(),
+			"songs": self.totals("song"),
+			"channels": self.totals("song", "channel"),
+			"compression_passes": [dict(_["args"], name=_["name"], wall_seconds=_["wall_seconds"], cpu_seconds=_["cpu_seconds"]) for _ in self.events if _["category"] == "compress pass"],
+		}
+
+	# Chrome's trace event format, which Perfetto and chrome://tracing can open
+	def chrome_trace(self):
+		trace = []
+		for pid in sorted(set(_["pid"] for _ in self.events) | {self.pid}):
+			trace.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "fur2tad" if pid == self.pid else "worker %d" % pid}})
+		for event in self.events:
+			trace.append({
+				"name": event["name"],
+				"cat": event["category"],
+				"ph": "X",
+				"ts": (event["start"] - self.start) * 1000000,
+				"dur": event["wall_seconds"] * 1000000,
+				"pid": event["pid"],
+				"tid": event["tid"],
+				"args": dict(event["args"], cpu_ms=event["cpu_seconds"] * 1000),
+			})
+		return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+	def write(self, summary_path, trace_path):
+		with open(summary_path, "w") as f:
+			json.dump(self.summary(), f, indent="\t")
+		with open(trace_path, "w") as f:
+			json.dump(self.chrome_trace(), f)
+
+active_profiler = None
+active_memory_tracker = None
+current_context = {} # Added to the arguments of every span, for things like the song name
+
+def start_profiling():
+	global active_profiler
+	active_profiler = Profiler()
+	return active_profiler
+
+def stop_profiling():
+	global active_profiler
+	profiler = active_profiler
+	active_profiler = None
+	return profiler
+
+# Use as "with profile(name, category, song=...) as span:", and put anything that's only known at the end in span.args
+def profile(name, category, **args):
+	if active_profiler == None:
+		return NULL_SPAN
+	return active_profiler.span(name, category, args)
+
+class ProfileContext(object):
+	def __init__(self, values):
+		self.values = values
+
+	def __enter__(self):
+		global current_context
+		self.saved = current_context
+		current_context = dict(self.saved, **self.values)
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		global current_context
+		current_context = self.saved
+
+# Every span and memory stage made inside "with profile_context(song=...):" gets those arguments too
+def profile_context(**values):
+	if active_profiler == None and active_memory_tracker == None:
+		return NULL_SPAN
+	return ProfileContext(values)
+
+# Runs function in a worker process with its own profiler, and hands its spans back along with the result
+def run_profiled(function, context, *args):
+	global active_profiler, current_context
+	if active_profiler and active_profiler.pid == os.getpid(): # Not actually in another process
+		return function(*args), []
+	active_profiler = Profiler() # Replaces any profiler copied over from the main process
+	current_context = context
+	try:
+		return function(*args), active_profiler.events
+	finally:
+		active_profiler = None
+		current_context = {}
+
+# Same as map_function(function, *iterables), but if profiling is on, spans from worker processes are collected too
+def profiled_map(map_function, function, *iterables):
+	if active_profiler == None:
+		return map_function(function, *iterables)
+	profiler = active_profiler
+	results = map_function(run_profiled, itertools.repeat(function), itertools.repeat(current_context), *iterables)
+	def unpack():
+		for result, events in results:
+			profiler.events.extend(events)
+			yield result
+	return unpack()
+
+# -------------------------------------------------------------------
+# --memory-report
+
+MEMORY_REPORT_TOP_SITES = 10
+MEMORY_REPORT_TOP_CLASSES = 10
+
+# Live objects by class name. Strings aren't tracked by the garbage collector, so the ones in lists (which is where MML tokens are) are counted separately.
+def count_objects():
+	objects = gc.get_objects()
+	counts = Counter()
+	for object_type, count in Counter(map(type, objects)).items():
+		counts[object_type.__name__] += count
+	strings = set()
+	for o in objects:
+		if type(o) is list:
+			strings.update(id(_) for _ in o if type(_) is str)
+	counts["str (in lists)"] = len(strings)
+	return counts
+
+# Highest resident memory the process has used so far, if the operating system can say
+def peak_resident_bytes():
+	try:
+		import resource # Not on Windows
+	except ImportError:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak if sys.platform == "darwin" else peak * 1024 # macOS says bytes, Linux says KiB
+
+class MemoryStage(object):
+	def __init__(self, tracker, stage, args):
+		self.tracker = tracker
+		self.stage = stage
+		self.args = args
+
+	def __enter__(self):
+		self.tracker.begin(self)
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.tracker.end(self)
+
+# Traces are cleared at the start of every stage, so the snapshot at the end only has what the stage allocated and kept.
+# That's much faster than comparing two snapshots of everything, but it means stages can't be inside other stages.
+class MemoryTracker(object):
+	def __init__(self):
+		self.current_stage = None
+		self.stages = []
+		self.ignored_files = {tracemalloc.__file__, __file__}
+		self.objects = None
+		tracemalloc.start()
+
+	def stop(self):
+		tracemalloc.stop()
+
+	def begin(self, stage):
+		if self.objects == None:
+			self.objects = count_objects()
+		stage.objects_before = self.objects # Counting objects is slow, so the count from the end of the last stage is reused
+		self.current_stage = stage
+		tracemalloc.clear_traces()
+
+	def end(self, stage):
+		retained, peak = tracemalloc.get_traced_memory()
+		statistics = [_ for _ in tracemalloc.take_snapshot().statistics("lineno") if _.traceback[0].filename not in self.ignored_files]
+		top_sites = [{"site": "%s:%d" % (os.path.basename(_.traceback[0].filename), _.traceback[0].lineno), "bytes": _.size, "blocks": _.count} for _ in statistics[:MEMORY_REPORT_TOP_SITES]]
+		statistics = None # So it isn't in the object counts
+		self.current_stage = None
+		self.objects = count_objects()
+		objects = self.objects.copy()
+		objects.subtract(stage.objects_before)
+		self.stages.append(dict(stage.args,
+			stage = stage.stage,
+			peak_bytes = peak,
+			retained_bytes = retained,
+			top_sites = top_sites,
+			new_objects = dict(_ for _ in objects.most_common(MEMORY_REPORT_TOP_CLASSES) if _[1] > 0),
+		))
+
+	def report(self):
+		return {"peak_resident_bytes": peak_resident_bytes(), "stages": self.stages}
+
+	# The MML can be going to stdout, so the table goes to stderr
+	def print_report(self, file=sys.stderr):
+		print("%-20s %-14s %12s %12s  %s" % ("Song", "Stage", "Peak", "Retained", "Biggest allocation site"), file=file)
+		for stage in self.stages:
+			site = stage["top_sites"][0] if stage["top_sites"] else None
+			print("%-20s %-14s %8.1f KiB %8.1f KiB  %s" % (stage.get("song") or "-", stage["stage"], stage["peak_bytes"] / 1024, stage["retained_bytes"] / 1024, "%s (%.1f KiB)" % (site["site"], site["bytes"] / 1024) if site else ""), file=file)
+		peak = peak_resident_bytes()
+		if peak:
+			print("Highest resident memory use: %.1f MiB" % (peak / 1024 / 1024), file=file)
+
+	def write(self, path):
+		with open(path, "w") as f:
+			json.dump(self.report(), f, indent="\t")
+
+def start_memory_tracking():
+	global active_memory_tracker
+	active_memory_tracker = MemoryTracker()
+	return active_memory_tracker
+
+def stop_memory_tracking():
+	global active_memory_tracker
+	tracker = active_memory_tracker
+	active_memory_tracker = None
+	if tracker:
+		tracker.stop()
+	return tracker
+
+# Use as "with track_memory(stage):" around one stage of the conversion for one song. Every stage takes a tracemalloc snapshot,
+# so these go around whole stages instead of every channel like profile() does.
+def track_memory(stage, **args):
+	if active_memory_tracker == None or active_memory_tracker.current_stage != None:
+		return NULL_SPAN
+	return MemoryStage(active_memory_tracker, stage, dict(current_context, **args))
@@ -0,0 +1,245 @@
+# synthetic_fur
+#
+# Copyright (c) 2025 NovaSquirrel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Writes random SNES Furnace modules for benchmarking the converter.
+# Only what fur2tad reads is filled in; see https://github.com/tildearrow/furnace/blob/master/papers/format.md
+import struct, zlib, random, argparse
+
+CHANNELS = 8
+FORMAT_VERSION = 200
+SNES_CHIP_ID = 0x87
+BRR_DEPTH = 9
+
+# Effects that get sprinkled onto notes, with parameters that make sense for them
+RANDOM_EFFECTS = [
+	(0x00, 0x37), # Arpeggio
+	(0x01, 0x10), # Pitch slide up
+	(0x02, 0x10), # Pitch slide down
+	(0x04, 0x34), # Vibrato
+	(0x0A, 0x20), # Volume slide
+	(0x12, 0x01), # Echo on
+	(0x80, 0x40), # Pan
+	(0xE1, 0x23), # Note slide up
+	(0xED, 0x01), # Note delay
+]
+
+def u8(v):
+	return struct.pack("<B", v)
+
+def u16(v):
+	return struct.pack("<H", v)
+
+def u32(v):
+	return struct.pack("<I", v)
+
+def i32(v):
+	return struct.pack("<i", v)
+
+def f32(v):
+	return struct.pack("<f", v)
+
+def string(text):
+	return text.encode() + b"\0"
+
+def block(name, data):
+	return name.encode() + u32(len(data)) + data
+
+class SyntheticModuleSettings(object):
+	def __init__(self, **kwargs):
+		self.seed = 1
+		self.subsongs = 2
+		self.order_length = 8
+		self.pattern_length = 64
+		self.patterns_per_channel = 6 # Different patterns each channel's orders pick from
+		self.note_density = 0.4       # Chance of a row having a note on it
+		self.effect_density = 0.2     # Chance of a note having an effect
+		self.groove = False           # Use a two step speed pattern, and switch between groove patterns with 09xx
+		self.instruments = 4
+		self.samples = 3
+		for key, value in kwargs.items():
+			if not hasattr(self, key):
+				raise TypeError("Unknown synthetic module setting: %s" % key)
+			setattr(self, key, value)
+
+	def to_dict(self):
+		return dict(vars(self))
+
+def song_start(pattern_length, order_length, speed):
+	# Time base, speed 1, speed 2, arpeggio time, ticks per second, pattern length, orders length, highlights
+	return u8(1) + u8(speed) + u8(speed) + u8(1) + f32(60.0) + u16(pattern_length) + u16(order_length) + u8(4) + u8(16)
+
+def song_orders(orders):
+	out = b"".join(bytes(column) for column in orders)
+	out += bytes([1] * CHANNELS)  # Effect columns
+	out += bytes(CHANNELS) * 2    # Hidden, collapsed
+	out += string("") * CHANNELS  # Channel names
+	out += string("") * CHANNELS  # Short channel names
+	return out
+
+def speed_pattern(settings):
+	speeds = [6, 5] if settings.groove else [6]
+	return u8(len(speeds)) + bytes(speeds + [0] * (16 - len(speeds)))
+
+def info_block(settings, orders):
+	pattern_count = settings.subsongs * CHANNELS * settings.patterns_per_channel
+	out = song_start(settings.pattern_length, settings.order_length, 6)
+	out += u16(settings.instruments) + u16(0) + u16(settings.samples) + u32(pattern_count)
+	out += bytes([SNES_CHIP_ID] + [0] * 31) # Chips
+	out += bytes(32) + bytes(32) + bytes(128) # Chip volumes, panning, flag pointers
+	out += string("Song0") + string("Synthetic")
+	out += f32(440.0) # A-4 tuning
+	out += bytes(20) # Compatibility flags
+	out += bytes(4 * settings.instruments) + bytes(4 * settings.samples) + bytes(4 * pattern_count) # Pointers; fur2tad doesn't use them
+	out += song_orders(orders[0])
+	out += string("") # Comment
+	out += f32(1.0) # Master volume
+	out += bytes(28) # More compatibility flags
+	out += u16(1) + u16(1) # Virtual tempo
+	out += string("") + string("") # First subsong name and comment
+	out += u8(settings.subsongs - 1) + bytes(3) + bytes(4 * (settings.subsongs - 1))
+	out += string("") * 6 # System, album and Japanese names
+	out += bytes(12) # Extra chip output settings
+	out += u32(0) + u8(0) # Patchbay
+	out += bytes(8) # Compatibility flags
+	out += speed_pattern(settings)
+	if settings.groove:
+		grooves = [[6, 5], [4, 3, 4, 5]]
+		out += u8(len(grooves))
+		for groove in grooves:
+			out += u8(len(groove)) + bytes(groove + [0] * (16 - len(groove)))
+	else:
+		out += u8(0)
+	return out
+
+def subsong_block(settings, song_index, orders):
+	out = song_start(settings.pattern_length, settings.order_length, 6)
+	out += u16(1) + u16(1) # Virtual tempo
+	out += string("Song%d" % song_index) + string("")
+	out += song_orders(orders)
+	out += speed_pattern(settings)
+	return out
+
+def instrument_block(settings, instrument_index):
+	name = "Inst%d" % instrument_index
+	if instrument_index % 4 == 3:
+		name += "!sample"
+	features = b"NA" + u16(len(string(name))) + string(name)
+	if instrument_index % 4 == 2: # Sample map across every sample, which becomes a set of TAD samples
+		sample_map = u16(instrument_index % settings.samples) + u8(3) + u8(0)
+		for note in range(120):
+			sample_map += u16(note) + u16(note % settings.samples)
+	else:
+		sample_map = u16(instrument_index % settings.samples) + u8(2) + u8(0)
+	features += b"SM" + u16(len(sample_map)) + sample_map
+	envelope = bytes([0x7f, 0xe0, 0, 0x7f, 0]) # Attack/decay, sustain/release, flags, gain, decay 2
+	features += b"SN" + u16(len(envelope)) + envelope
+	features += b"EN"
+	return u16(FORMAT_VERSION) + u16(29) + features # 29 is the SNES instrument type
+
+def sample_block(r, sample_index):
+	brr_blocks = r.randrange(4, 20)
+	data = bytearray()
+	for _ in range(brr_blocks):
+		data += bytes([0xb0]) + bytes(r.randrange(256) for _ in range(8))
+	length = brr_blocks * 16
+	loop_start, loop_end = (16, length) if sample_index % 2 == 0 else (-1, -1)
+	out = string("Smp%d" % sample_index)
+	out += u32(length) + u32(32000) + u32(r.choice([8000, 16000, 32000]))
+	out += u8(BRR_DEPTH) + u8(0) + u8(0) + u8(0) # Depth, loop direction, flags
+	out += i32(loop_start) + i32(loop_end)
+	out += bytes(16) # Sample presence bitfields
+	out += bytes(data)
+	return out
+
+def pattern_block(settings, r, song_index, channel, pattern_index):
+	out = u8(song_index) + u8(channel) + u16(pattern_index) + string("")
+	row = 0
+	while row < settings.pattern_length:
+		if r.random() >= settings.note_density:
+			out += u8(0x80) # Skip two rows
+			row += 2
+			continue
+		effects = []
+		if r.random() < settings.effect_density:
+			effects.append(r.choice(RANDOM_EFFECTS))
+		if settings.groove and channel == 0 and row == 0 and r.random() < 0.25:
+			effects.append((0x09, r.randrange(2))) # Switch groove pattern
+		b = 1 | 2 # Note, instrument
+		if len(effects) >= 1:
+			b |= 8 | 16
+		if len(effects) >= 2:
+			b |= 32
+		out += u8(b)
+		if len(effects) >= 2:
+			out += u8(4 | 8) # Second effect type and value
+		out += u8(r.randrange(84, 120)) + u8(r.randrange(settings.instruments))
+		for effect_type, effect_value in effects:
+			out += u8(effect_type) + u8(effect_value)
+		row += 1
+	out += u8(0xFF)
+	return out
+
+# Returns the bytes of a zlib compressed .fur file
+def generate_furnace_module(settings=None):
+	settings = settings or SyntheticModuleSettings()
+	r = random.Random(settings.seed)
+	orders = [[[r.randrange(settings.patterns_per_channel) for _ in range(settings.order_length)] for channel in range(CHANNELS)] for song in range(settings.subsongs)]
+
+	blocks = [block("INFO", info_block(settings, orders))]
+	for song_index in range(1, settings.subsongs):
+		blocks.append(block("SONG", subsong_block(settings, song_index, orders[song_index])))
+	for instrument_index in range(settings.instruments):
+		blocks.append(block("INS2", instrument_block(settings, instrument_index)))
+	for sample_index in range(settings.samples):
+		blocks.append(block("SMP2", sample_block(r, sample_index)))
+	for song_index in range(settings.subsongs):
+		for channel in range(CHANNELS):
+			for pattern_index in range(settings.patterns_per_channel):
+				blocks.append(block("PATN", pattern_block(settings, r, song_index, channel, pattern_index)))
+
+	header = b"-Furnace module-" + u16(FORMAT_VERSION) + u16(0) + u32(32) + bytes(8) # The song info starts right after the header
+	return zlib.compress(header + b"".join(blocks))
+
+def write_furnace_module(filename, settings=None):
+	data = generate_furnace_module(settings)
+	with open(filename, "wb") as f:
+		f.write(data)
+	return len(data)
+
+if __name__ == "__main__":
+	defaults = SyntheticModuleSettings()
+	parser = argparse.ArgumentParser(prog='synthetic_fur', description='Writes a random Furnace module for benchmarking fur2tad')
+	parser.add_argument('filename')
+	parser.add_argument('--seed', default=defaults.seed, type=int)
+	parser.add_argument('--subsongs', default=defaults.subsongs, type=int)
+	parser.add_argument('--order-length', default=defaults.order_length, type=int)
+	parser.add_argument('--pattern-length', default=defaults.pattern_length, type=int)
+	parser.add_argument('--patterns-per-channel', default=defaults.patterns_per_channel, type=int)
+	parser.add_argument('--note-density', default=defaults.note_density, type=float)
+	parser.add_argument('--effect-density', default=defaults.effect_density, type=float)
+	parser.add_argument('--groove', action='store_true')
+	parser.add_argument('--instruments', default=defaults.instruments, type=int)
+	parser.add_argument('--samples', default=defaults.samples, type=int)
+	args = parser.parse_args()
+
+	settings = SyntheticModuleSettings(**{key: getattr(args, key) for key in vars(defaults)})
+	print("Wrote %d bytes to %s" % (write_furnace_module(args.filename, settings), args.filename))